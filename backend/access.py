@@ -0,0 +1,33 @@
+import threading
+from backend.settings import ASYNC_DB
+
+
+class AccessDecisionEngine:
+    """Общий для всех считывателей механизм принятия решения о доступе"""
+
+    def __init__(self, async_db):
+        self.async_db = async_db
+        self._lock = threading.Lock()
+        self.granted = 0
+        self.denied = 0
+
+    async def decide(self, card_uid, reader_id=None):
+        """Возвращает (тип карты, доступ разрешён, данные карты) для UID"""
+        card_data = await self.async_db.find_card_by_uid(card_uid)
+        access_granted = card_data is not None
+        card_type = card_data["card_type"] if access_granted else "UNKNOWN"
+
+        with self._lock:
+            if access_granted:
+                self.granted += 1
+            else:
+                self.denied += 1
+        return card_type, access_granted, card_data
+
+    def stats(self):
+        """Возвращает счётчики решений"""
+        with self._lock:
+            return {"granted": self.granted, "denied": self.denied}
+
+
+access_engine = AccessDecisionEngine(ASYNC_DB)
@@ -0,0 +1,117 @@
+import asyncio
+import functools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from backend.profiling import current_span
+
+log = logging.getLogger("db")
+
+
+class DatabaseBusyError(Exception):
+    """БД не ответила вовремя или очередь запросов переполнена"""
+
+
+class AsyncCardDatabase:
+    """Асинхронный фасад над CardDatabase: запросы выполняются в выделенном пуле потоков"""
+
+    def __init__(self, card_db, max_workers=4, max_pending=256, timeout=5.0):
+        self.card_db = card_db
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="db")
+        self._lock = threading.Lock()
+        self._methods = {}
+        self.queued = 0
+        self.running = 0
+        self.max_depth = 0
+        self.completed = 0
+        self.timeouts = 0
+        self.rejected = 0
+
+    def _run(self, func, args, kwargs):
+        """Выполняет метод БД в потоке пула с учётом счётчиков очереди"""
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+
+    def _release_cancelled(self, work):
+        """Запрос, отменённый до начала выполнения (таймаут, отмена вызывающего), освобождает место в очереди"""
+        if work.cancelled():
+            with self._lock:
+                self.queued -= 1
+
+    async def call(self, name, *args, timeout=None, **kwargs):
+        """Вызывает метод CardDatabase в пуле потоков и ожидает результат с таймаутом"""
+        return await self.run(getattr(self.card_db, name), *args, timeout=timeout, **kwargs)
+
+    async def run(self, func, /, *args, timeout=None, **kwargs):
+        """Выполняет другую работу с БД (импорт, журнал сканирований) в том же пуле, с очередью и таймаутом"""
+        name = func.__name__
+        with self._lock:
+            depth = self.queued + self.running
+            if depth >= self.max_pending:
+                self.rejected += 1
+                raise DatabaseBusyError(f"Очередь запросов к БД переполнена ({depth})")
+            self.queued += 1
+            self.max_depth = max(self.max_depth, depth + 1)
+
+        work = self.executor.submit(self._run, func, args, kwargs)
+        work.add_done_callback(self._release_cancelled)
+        future = asyncio.wrap_future(work)
+        if timeout is None:
+            timeout = self.timeout
+        span = current_span.get()
+        try:
+            if span is None:
+                return await asyncio.wait_for(future, timeout)
+            started = time.perf_counter()
+            try:
+                return await asyncio.wait_for(future, timeout)
+            finally:
+                span.add(f"db.{name}", time.perf_counter() - started)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self.timeouts += 1
+            log.warning("Таймаут запроса к БД: %s", name)
+            raise DatabaseBusyError(f"Таймаут запроса к БД: {name}") from None
+
+    async def find_card_by_uid(self, uid):
+        """Поиск карты по UID; промах фильтра UID и попадание в кэш обслуживаются без перехода в пул потоков"""
+        found, card_data, uid_str, generation = self.card_db._fast_path(uid)
+        if found:
+            return card_data
+        return await self.call("load_card_by_uid", uid_str, generation)
+
+    def __getattr__(self, name):
+        if name.startswith("_") or not callable(getattr(self.card_db, name, None)):
+            raise AttributeError(name)
+        method = self._methods.get(name)
+        if method is None:
+            method = functools.partial(self.call, name)
+            self._methods[name] = method
+        return method
+
+    def stats(self):
+        """Возвращает метрики очереди запросов"""
+        with self._lock:
+            return {
+                "queued": self.queued,
+                "running": self.running,
+                "max_depth": self.max_depth,
+                "max_pending": self.max_pending,
+                "completed": self.completed,
+                "timeouts": self.timeouts,
+                "rejected": self.rejected
+            }
+
+    def shutdown(self):
+        """Останавливает пул потоков"""
+        self.executor.shutdown(wait=True)
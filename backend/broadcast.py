@@ -0,0 +1,116 @@
+import asyncio
+import json
+import logging
+import time
+import weakref
+from websockets.exceptions import ConnectionClosed
+from backend.metrics import BROADCAST_SECONDS
+
+log = logging.getLogger("ws")
+SLOW_CONSUMER_CODE = 1008
+
+
+class Broadcaster:
+    """Параллельная рассылка одного сообщения множеству клиентов WebSocket с вытеснением медленных"""
+
+    def __init__(self, send_timeout=1.0, max_buffer=1024 * 1024, max_strikes=50, max_in_flight=1000):
+        self.send_timeout = send_timeout
+        self.max_buffer = max_buffer
+        self.max_strikes = max_strikes
+        self.max_in_flight = max_in_flight
+        self._strikes = weakref.WeakKeyDictionary()
+        self._closing = set()
+        self._evicted = weakref.WeakSet()
+        self._in_flight = set()
+        self.broadcasts = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.evicted = 0
+        self.overflowed = 0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+
+    async def broadcast(self, clients, payload):
+        """Сериализует сообщение один раз и отправляет всем клиентам одновременно"""
+        if not clients:
+            return
+        message = payload if isinstance(payload, str) else json.dumps(payload)
+        targets = list(clients)
+        started = time.perf_counter()
+
+        results = await asyncio.gather(*(self._send(client, message) for client in targets))
+
+        for client, result in zip(targets, results):
+            if result == "delivered":
+                self.delivered += 1
+            elif result == "dropped":
+                self.dropped += 1
+            else:
+                self.evicted += 1
+                clients.discard(client)
+                if result == "slow":
+                    self._evict(client)
+
+        self.broadcasts += 1
+        self.last_duration = time.perf_counter() - started
+        self.max_duration = max(self.max_duration, self.last_duration)
+        BROADCAST_SECONDS.observe(self.last_duration)
+
+    def broadcast_nowait(self, clients, payload):
+        """Запускает рассылку в фоне, не дожидаясь медленных клиентов; False, если фоновых рассылок
+        уже max_in_flight и сообщение отброшено"""
+        if not clients:
+            return True
+        if len(self._in_flight) >= self.max_in_flight:
+            self.overflowed += 1
+            return False
+        task = asyncio.ensure_future(self.broadcast(clients, payload))
+        self._in_flight.add(task)
+        task.add_done_callback(self._broadcast_done)
+        return True
+
+    def _broadcast_done(self, task):
+        self._in_flight.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log.error("Ошибка фоновой рассылки: %s", task.exception())
+
+    async def _send(self, client, message):
+        """Отправка одному клиенту: delivered, dropped (буфер переполнен), slow или closed"""
+        transport = getattr(client, "transport", None)
+        if transport is not None and transport.get_write_buffer_size() > self.max_buffer:
+            strikes = self._strikes.get(client, 0) + 1
+            self._strikes[client] = strikes
+            return "slow" if strikes >= self.max_strikes else "dropped"
+
+        try:
+            await asyncio.wait_for(client.send(message), self.send_timeout)
+        except asyncio.TimeoutError:
+            return "slow"
+        except ConnectionClosed:
+            return "closed"
+        self._strikes.pop(client, None)
+        return "delivered"
+
+    def _evict(self, client):
+        """Закрывает соединение медленного клиента в фоне (один раз, даже если отстал в нескольких рассылках)"""
+        if client in self._evicted:
+            return
+        self._evicted.add(client)
+        address = getattr(client, "remote_address", None)
+        log.warning("Клиент %s не успевает принимать сообщения и отключён", address)
+        task = asyncio.ensure_future(client.close(SLOW_CONSUMER_CODE, "slow consumer"))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    def stats(self):
+        """Возвращает счётчики рассылки"""
+        return {
+            "broadcasts": self.broadcasts,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "evicted": self.evicted,
+            "in_flight": len(self._in_flight),
+            "overflowed": self.overflowed,
+            "last_duration_ms": round(self.last_duration * 1000, 3),
+            "max_duration_ms": round(self.max_duration * 1000, 3)
+        }
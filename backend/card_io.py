@@ -0,0 +1,158 @@
+import csv
+import io
+import itertools
+import json
+import os
+import re
+
+FORMATS = ("csv", "jsonl")
+EXPORT_FIELDS = ("card_type", "uid", "date_added", "image_filename")
+MAX_REPORTED_ERRORS = 20
+HEX_DIGIT_RE = re.compile(r"[0-9A-Fa-f]")
+
+
+class CardFormatError(ValueError):
+    """Файл импорта нельзя разобрать целиком (например, в заголовке CSV нет нужных столбцов)"""
+
+
+def _valid_uid(uid):
+    """UID из файла: строка с HEX-цифрами (остальные символы отбрасываются при сохранении) или список байтов 0-255"""
+    if isinstance(uid, str):
+        return HEX_DIGIT_RE.search(uid) is not None
+    return (isinstance(uid, list) and bool(uid)
+            and all(isinstance(part, int) and not isinstance(part, bool) and 0 <= part <= 255 for part in uid))
+
+
+def detect_format(filename, default="csv"):
+    """Формат файла по расширению: .jsonl/.ndjson - JSONL, иначе CSV"""
+    ext = os.path.splitext(filename or "")[1].lower()
+    if ext in (".jsonl", ".ndjson", ".json"):
+        return "jsonl"
+    if ext == ".csv":
+        return "csv"
+    return default
+
+
+class CardReader:
+    """Потоковый разбор CSV/JSONL с картами в пары (тип, UID); некорректные строки считаются и пропускаются"""
+
+    def __init__(self, stream, fmt="csv"):
+        if fmt not in FORMATS:
+            raise ValueError(f"Неизвестный формат: {fmt}")
+        self.stream = stream
+        self.fmt = fmt
+        self.rows = 0
+        self.invalid = 0
+        self.errors = []
+        self.type_index, self.uid_index = 0, 1
+        self.first_row = None
+        self.csv_rows = None
+
+    def read_header(self):
+        """Читает заголовок CSV до начала импорта; CardFormatError, если по нему не найти столбцы"""
+        if self.fmt != "csv" or self.csv_rows is not None:
+            return
+        self.csv_rows = enumerate(csv.reader(self.stream), 1)
+        for line_no, row in self.csv_rows:
+            if not row or not any(cell.strip() for cell in row):
+                continue
+            header = [cell.strip().lower() for cell in row]
+            if "uid" not in header:
+                # Файл без заголовка: первая строка - данные (тип, UID)
+                self.first_row = (line_no, row)
+                return
+            type_column = next((name for name in ("card_type", "type") if name in header), None)
+            if type_column is None:
+                raise CardFormatError("В заголовке CSV нет столбца card_type (или type)")
+            self.uid_index = header.index("uid")
+            self.type_index = header.index(type_column)
+            return
+
+    def __iter__(self):
+        return self._iter_jsonl() if self.fmt == "jsonl" else self._iter_csv()
+
+    def _reject(self, line_no, reason):
+        self.invalid += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({"line": line_no, "error": reason})
+
+    def _iter_jsonl(self):
+        for line_no, line in enumerate(self.stream, 1):
+            line = line.strip()
+            if not line:
+                continue
+            self.rows += 1
+            try:
+                record = json.loads(line)
+                card_type, uid = record.get("card_type"), record.get("uid")
+            except (ValueError, AttributeError):
+                self._reject(line_no, "некорректный JSON")
+                continue
+            if not card_type or not uid:
+                self._reject(line_no, "нет card_type или uid")
+                continue
+            if not isinstance(card_type, str) or not _valid_uid(uid):
+                self._reject(line_no, "card_type должен быть строкой, uid - HEX-строкой или списком байтов")
+                continue
+            yield card_type, uid
+
+    def _iter_csv(self):
+        self.read_header()
+        type_index, uid_index = self.type_index, self.uid_index
+        rows = self.csv_rows
+        if self.first_row is not None:
+            rows = itertools.chain((self.first_row,), rows)
+        for line_no, row in rows:
+            if not row or not any(cell.strip() for cell in row):
+                continue
+            self.rows += 1
+            if len(row) <= max(type_index, uid_index):
+                self._reject(line_no, "недостаточно столбцов")
+                continue
+            card_type, uid = row[type_index].strip(), row[uid_index].strip()
+            if not card_type or not uid:
+                self._reject(line_no, "пустой тип или UID")
+                continue
+            if not _valid_uid(uid):
+                self._reject(line_no, "UID без шестнадцатеричных цифр")
+                continue
+            yield card_type, uid
+
+
+def import_cards_stream(card_db, stream, fmt="csv", batch_size=5000):
+    """Импортирует карты из текстового потока; возвращает счётчики added/skipped/invalid и ошибки.
+    CardFormatError (до записи в БД), если заголовок CSV не подходит"""
+    reader = CardReader(stream, fmt)
+    reader.read_header()
+    result = card_db.import_cards(reader, batch_size=batch_size)
+    result["rows"] = reader.rows
+    result["invalid"] += reader.invalid
+    result["errors"] = reader.errors
+    return result
+
+
+def format_cards(cards, fmt="csv", header=False):
+    """Сериализует страницу карт в текст CSV или JSONL"""
+    if fmt == "jsonl":
+        return "".join(json.dumps({field: card.get(field) for field in EXPORT_FIELDS}, ensure_ascii=False) + "\n"
+                       for card in cards)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    if header:
+        writer.writerow(EXPORT_FIELDS)
+    writer.writerows([card.get(field) or "" for field in EXPORT_FIELDS] for card in cards)
+    return buffer.getvalue()
+
+
+def export_cards_stream(card_db, stream, fmt="csv", page_size=1000, **filters):
+    """Постранично выгружает карты в текстовый поток; возвращает число выгруженных карт"""
+    if fmt not in FORMATS:
+        raise ValueError(f"Неизвестный формат: {fmt}")
+    count = 0
+    cursor = None
+    while True:
+        cards, cursor = card_db.list_cards_page(page_size=page_size, cursor=cursor, **filters)
+        stream.write(format_cards(cards, fmt, header=(count == 0 and fmt == "csv")))
+        count += len(cards)
+        if cursor is None:
+            return count
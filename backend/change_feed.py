@@ -0,0 +1,142 @@
+import logging
+import threading
+import time
+from backend.settings import (
+    CARD_DB, CHANGE_FEED_INTERVAL, CHANGE_FEED_BATCH_SIZE, CHANGE_FEED_RETENTION_DAYS, CHANGE_FEED_PRUNE_INTERVAL
+)
+from backend.metrics import CHANGE_FEED_LAG_SECONDS, CHANGE_FEED_APPLIED
+
+log = logging.getLogger("db")
+
+
+class ChangeFeed:
+    """Применяет изменения карт, сделанные другими процессами с той же БД (журнал card_changes).
+
+    Опрос дешёвый: PRAGMA data_version меняется, только если в БД зафиксировал транзакцию кто-то, кроме
+    подключения потока опроса; журнал читается лишь тогда. Если нужные ревизии уже удалены очисткой,
+    кэш и фильтр UID сбрасываются целиком."""
+
+    def __init__(self, card_db, interval=0.2, batch_size=1000, retention_days=7, prune_interval=3600):
+        self.card_db = card_db
+        self.interval = interval
+        self.batch_size = batch_size
+        self.retention_days = retention_days
+        self.prune_interval = prune_interval
+        self.revision = None
+        self.data_version = None
+        self.polls = 0
+        self.applied = 0
+        self.own = 0
+        self.resyncs = 0
+        self.pruned = 0
+        self.last_lag_ms = None
+        self.thread = None
+        self.stopping = threading.Event()
+        self._applied_metrics = {}
+
+    def start(self):
+        """Запускает поток опроса; изменения после открытия БД (start_revision) применяются при первом опросе"""
+        if self.thread and self.thread.is_alive():
+            return
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run, name="change-feed", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=5.0):
+        if self.thread and self.thread.is_alive():
+            self.stopping.set()
+            self.thread.join(timeout)
+
+    def _run(self):
+        if self.revision is None:
+            self.revision = self.card_db.start_revision
+        next_prune = time.monotonic() + self.prune_interval
+        while not self.stopping.wait(self.interval):
+            try:
+                self.poll()
+                if time.monotonic() >= next_prune:
+                    next_prune = time.monotonic() + self.prune_interval
+                    self.prune()
+            except Exception as e:
+                log.error("Ошибка опроса журнала изменений карт: %s", e)
+
+    def poll(self):
+        """Применяет новые изменения других процессов; возвращает их число"""
+        self.polls += 1
+        conn = self.card_db.db.connection()
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version == self.data_version:
+            return 0
+        self.data_version = data_version
+
+        applied = 0
+        while True:
+            changes = self.card_db.read_changes(self.revision, self.batch_size)
+            if not changes:
+                return applied
+            if changes[0][0] != self.revision + 1:
+                self._resync(changes[0][0])
+            now_ms = time.time() * 1000
+            for revision, ts_ms, op, card_type, uid_str, origin in changes:
+                self.revision = revision
+                if origin == self.card_db.instance_id:
+                    self.own += 1
+                    continue
+                self.card_db.apply_remote_change(op, card_type, uid_str)
+                lag_ms = max(0.0, now_ms - ts_ms)
+                CHANGE_FEED_LAG_SECONDS.observe(lag_ms / 1000)
+                self._applied_metric(op).inc()
+                self.last_lag_ms = round(lag_ms, 1)
+                self.applied += 1
+                applied += 1
+            if len(changes) < self.batch_size:
+                return applied
+
+    def _resync(self, first_revision):
+        """Пропущенные ревизии уже удалены: состояние процесса сбрасывается целиком"""
+        self.resyncs += 1
+        log.warning("Журнал изменений карт: пропущены ревизии %s-%s, полный сброс кэша",
+                    self.revision + 1, first_revision - 1)
+        self.card_db.apply_remote_change("imported", None, None)
+
+    def _applied_metric(self, op):
+        metric = self._applied_metrics.get(op)
+        if metric is None:
+            metric = self._applied_metrics[op] = CHANGE_FEED_APPLIED.labels(op)
+        return metric
+
+    def prune(self, batch=10000):
+        """Удаляет записи журнала старше retention_days небольшими транзакциями"""
+        cutoff_ms = int((time.time() - self.retention_days * 86400) * 1000)
+        while not self.stopping.is_set():
+            with self.card_db.db.transaction() as conn:
+                cursor = conn.execute(
+                    "DELETE FROM card_changes WHERE revision IN "
+                    "(SELECT revision FROM card_changes WHERE ts_ms < ? ORDER BY ts_ms LIMIT ?)",
+                    (cutoff_ms, batch))
+                deleted = cursor.rowcount
+            self.pruned += deleted
+            if deleted < batch:
+                return
+
+    def stats(self):
+        """Возвращает счётчики журнала изменений"""
+        return {
+            "instance": self.card_db.instance_id,
+            "revision": self.revision,
+            "polls": self.polls,
+            "applied": self.applied,
+            "own": self.own,
+            "resyncs": self.resyncs,
+            "pruned": self.pruned,
+            "last_lag_ms": self.last_lag_ms
+        }
+
+
+change_feed = ChangeFeed(
+    CARD_DB,
+    interval=CHANGE_FEED_INTERVAL,
+    batch_size=CHANGE_FEED_BATCH_SIZE,
+    retention_days=CHANGE_FEED_RETENTION_DAYS,
+    prune_interval=CHANGE_FEED_PRUNE_INTERVAL
+)
@@ -1,16 +1,73 @@
 import time
 import sys
 import os
-from backend.settings import CARD_DB
+from datetime import datetime
+from backend.settings import CARD_DB, ASYNC_DB
+from backend.scan_journal import scan_journal
+from backend.card_io import CardFormatError, detect_format, import_cards_stream, export_cards_stream
+from backend.latency import scan_latency
+from backend.metrics import DB_QUERY_SECONDS, LOOP_LAG_SECONDS, BROADCAST_SECONDS, CHANGE_FEED_LAG_SECONDS
+from backend.profiling import profiler, slow_trace
+from backend.rate_limit import reader_limiter
+from backend.change_feed import change_feed
+
+LIST_PAGE_SIZE = 50
+HISTORY_LIMIT = 20
+
+def _format_histogram(child):
+    """Строка перцентилей гистограммы метрик (по границам корзин)"""
+    snapshot = child.snapshot()
+    count = snapshot[2]
+    if not count:
+        return "нет данных"
+    p50, p95, p99 = (child.percentile(p, snapshot) * 1000 for p in (50, 95, 99))
+    return f"n={count}, среднее {snapshot[1] / count * 1000:.2f} мс, p50<={p50:g} мс, p95<={p95:g} мс, p99<={p99:g} мс"
+
+def print_stats():
+    """Текущие перцентили задержек сканирований, запросов к БД, цикла событий и рассылки"""
+    print("\nЗадержка ответа считывателю:")
+    readers = scan_latency.snapshot()
+    if not readers:
+        print("  нет данных")
+    for reader, summary in readers.items():
+        print(f"  {reader}: n={summary['count']}, среднее {summary['avg_ms']} мс, p50 {summary['p50_ms']} мс, "
+              f"p95 {summary['p95_ms']} мс, p99 {summary['p99_ms']} мс, макс. {summary['max_ms']} мс")
+    print("Запросы к БД:")
+    for (method,), child in DB_QUERY_SECONDS.children():
+        if child.snapshot()[2]:
+            print(f"  {method}: {_format_histogram(child)}")
+    queue = ASYNC_DB.stats()
+    print(f"  очередь: выполняется {queue['running']}, ожидает {queue['queued']}, таймаутов {queue['timeouts']}, "
+          f"отклонено {queue['rejected']}")
+    uid_filter = CARD_DB.uid_filter.stats()
+    print(f"  фильтр UID: {'готов' if uid_filter['ready'] else 'не собран'}, UID {uid_filter['uids']}, "
+          f"отсечено {uid_filter['rejected']}, пропущено в БД {uid_filter['passed'] + uid_filter['bypassed']}")
+    changes = change_feed.stats()
+    print(f"  журнал изменений: ревизия {changes['revision']}, применено от других процессов {changes['applied']}, "
+          f"задержка {_format_histogram(CHANGE_FEED_LAG_SECONDS.labels())}")
+    limited = reader_limiter.stats()["limited"]
+    if limited:
+        print("Превышение частоты сканирований: " + ", ".join(f"{reader} {count}" for reader, count in limited.items()))
+    print(f"Запаздывание цикла событий: {_format_histogram(LOOP_LAG_SECONDS.labels())}")
+    print(f"Рассылка клиентам: {_format_histogram(BROADCAST_SECONDS.labels())}")
+    trace = slow_trace.stats()
+    if trace["threshold_ms"] is not None:
+        print(f"Трассировка: порог {trace['threshold_ms']:g} мс, медленных операций {trace['slow']} из {trace['traced']}")
 
 def console_handler():
     time.sleep(0.5)
     
     print("\n=== Консольное управление базой данных карт ===")
     print("Доступные команды:")
-    print("  list                           - показать все карты")
+    print("  list [тип]                     - показать карты (постранично)")
     print("  add <тип> <HEX_UID>            - добавить карту (например: add key 09250C05)")
     print("  del <тип> <HEX_UID>            - удалить карту")
+    print("  history [HEX_UID] [reader=ID] [hours=N] [limit=N] - журнал сканирований")
+    print("  import <файл.csv|файл.jsonl>   - массовый импорт карт (столбцы card_type, uid)")
+    print("  export <файл.csv|файл.jsonl> [тип] - выгрузка карт в файл")
+    print("  profile start [секунды] [cprofile|sample] | profile stop - профилирование в файл pstats")
+    print("  trace slow <мс> | trace off | trace - журнал операций дольше порога")
+    print("  stats                          - перцентили задержек")
     print("  help                           - показать эту справку")
     print("  exit                           - выйти из программы")
     print("Пример: add key 09250C05")
@@ -38,25 +95,37 @@ def console_handler():
                 
             elif cmd == "help":
                 print("\nДоступные команды:")
-                print("  list                           - показать все карты")
+                print("  list [тип]                     - показать карты (постранично)")
                 print("  add <тип> <HEX_UID>            - добавить карту")
                 print("  del <тип> <HEX_UID>            - удалить карту")
+                print("  history [HEX_UID] [reader=ID] [hours=N] [limit=N] - журнал сканирований")
+                print("  import <файл.csv|файл.jsonl>   - массовый импорт карт (столбцы card_type, uid)")
+                print("  export <файл.csv|файл.jsonl> [тип] - выгрузка карт в файл")
+                print("  profile start [секунды] [cprofile|sample] | profile stop - профилирование в файл pstats")
+                print("  trace slow <мс> | trace off | trace - журнал операций дольше порога")
+                print("  stats                          - перцентили задержек")
                 print("  help                           - показать эту справку")
                 print("  exit                           - выйти из программы")
                 print("Пример: add key 09250C05")
                 
             elif cmd == "list":
-                cards = CARD_DB.list_cards()
-                if not cards:
+                card_type = parts[1] if len(parts) >= 2 else None
+                total = CARD_DB.count_cards(card_type=card_type)
+                if not total:
                     print("База данных пуста")
                 else:
-                    print(f"\nСписок карт в БД ({len(cards)} шт.):")
-                    for i, card in enumerate(cards, 1):
-                        card_type = card["card_type"]
+                    print(f"\nСписок карт в БД ({total} шт.):")
+                    for i, card in enumerate(CARD_DB.iter_cards(page_size=LIST_PAGE_SIZE, card_type=card_type), 1):
+                        card_type_value = card["card_type"]
                         uid = card["uid"]
                         date_added = card.get("date_added", "неизвестно")
                         has_image = "Да" if card.get("has_image") else "Нет"
-                        print(f"{i}. Тип: {card_type}, UID: {uid}, Изображение: {has_image}, Добавлена: {date_added}")
+                        print(f"{i}. Тип: {card_type_value}, UID: {uid}, Изображение: {has_image}, Добавлена: {date_added}")
+                        if i % LIST_PAGE_SIZE == 0 and i < total:
+                            sys.stdout.write(f"-- показано {i} из {total}, Enter - далее, q - прервать -- ")
+                            sys.stdout.flush()
+                            if input().strip().lower() == "q":
+                                break
                 
             elif cmd == "add" and len(parts) >= 3:
                 card_type = parts[1]
@@ -82,10 +151,83 @@ def console_handler():
                 else:
                     print(f"Карта {card_type} с UID {uid_str} не найдена в БД")
                     
+            elif cmd == "history":
+                options = dict(part.split("=", 1) for part in parts[1:] if "=" in part)
+                uid_parts = [part for part in parts[1:] if "=" not in part]
+                hours = options.get("hours")
+                events, _ = scan_journal.history(
+                    uid=" ".join(uid_parts) or None,
+                    reader_id=options.get("reader"),
+                    since=time.time() - float(hours) * 3600 if hours else None,
+                    limit=int(options.get("limit", HISTORY_LIMIT))
+                )
+                if not events:
+                    print("Журнал сканирований пуст")
+                for event in events:
+                    when = datetime.fromtimestamp(event["timestamp"]).strftime("%Y-%m-%d %H:%M:%S")
+                    result = "доступ разрешён" if event["granted"] else "доступ запрещён"
+                    reader = event["reader_id"] or event["device_id"] or event["port"]
+                    print(f"{when}  UID: {event['uid']}, Тип: {event['card_type']}, Считыватель: {reader}, {result}")
+                
+            elif cmd == "import" and len(parts) >= 2:
+                path = parts[1]
+                started = time.perf_counter()
+                try:
+                    with open(path, newline="", encoding="utf-8-sig") as f:
+                        result = import_cards_stream(CARD_DB, f, detect_format(path))
+                except CardFormatError as e:
+                    print(f"Импорт из {path} отменён: {e}")
+                    continue
+                print(f"Импорт из {path} за {time.perf_counter() - started:.2f} с: строк {result['rows']}, "
+                      f"добавлено {result['added']}, уже были {result['skipped']}, некорректных {result['invalid']}")
+                for error in result["errors"]:
+                    print(f"  строка {error['line']}: {error['error']}")
+                
+            elif cmd == "export" and len(parts) >= 2:
+                path = parts[1]
+                card_type = parts[2] if len(parts) >= 3 else None
+                started = time.perf_counter()
+                with open(path, "w", newline="", encoding="utf-8") as f:
+                    count = export_cards_stream(CARD_DB, f, detect_format(path), card_type=card_type)
+                print(f"Выгружено карт: {count} в {path} за {time.perf_counter() - started:.2f} с")
+                
+            elif cmd == "profile" and len(parts) >= 2 and parts[1] == "start":
+                options = parts[2:]
+                seconds = next((float(option) for option in options if option.replace(".", "", 1).isdigit()), None)
+                mode = next((option for option in options if option in profiler.MODES), "cprofile")
+                profiler.start(mode, seconds)
+                print(f"Профилирование ({mode}) запущено" + (f" на {seconds:g} с" if seconds else ", остановка: profile stop"))
+                
+            elif cmd == "profile" and len(parts) >= 2 and parts[1] == "stop":
+                path = profiler.stop()
+                print(f"Профиль сохранён: {path} (просмотр: python -m pstats {path})")
+                
+            elif cmd == "trace" and len(parts) >= 3 and parts[1] == "slow":
+                slow_trace.enable(float(parts[2]))
+                print(f"Операции дольше {parts[2]} мс будут записываться в лог")
+                
+            elif cmd == "trace" and len(parts) >= 2 and parts[1] == "off":
+                slow_trace.disable()
+                print("Трассировка выключена")
+                
+            elif cmd == "trace":
+                if not slow_trace.recent:
+                    print("Медленных операций не зафиксировано")
+                for entry in slow_trace.recent:
+                    when = datetime.fromtimestamp(entry["time"]).strftime("%H:%M:%S")
+                    phases = ", ".join(f"{phase} {ms} мс" for phase, ms in entry["phases_ms"].items())
+                    print(f"{when} [{entry['kind']}] {entry['name']}: {entry['elapsed_ms']} мс" + (f" ({phases})" if phases else ""))
+                
+            elif cmd == "stats":
+                print_stats()
+                
             else:
                 print(f"Неизвестная команда: {command}")
                 print("Введите 'help' для получения справки")
                 
+        except EOFError:
+            # Нет интерактивного ввода (служба, фоновый запуск) - консоль не нужна
+            return
         except Exception as e:
             print(f"Ошибка при выполнении команды: {e}")
             import traceback
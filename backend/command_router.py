@@ -0,0 +1,214 @@
+import asyncio
+import json
+import logging
+import time
+from websockets.exceptions import ConnectionClosed
+from backend.async_db import DatabaseBusyError
+from backend.metrics import WS_COMMAND_SECONDS
+from backend.profiling import slow_trace
+
+log = logging.getLogger("ws")
+
+TYPE_NAMES = {str: "строкой", int: "числом", bool: "логическим значением", list: "списком", dict: "объектом"}
+
+
+class CommandError(Exception):
+    """Ошибка команды, о которой нужно сообщить клиенту"""
+
+
+class Command:
+    """Зарегистрированная команда: обработчик, обязательные поля и признак упорядоченного выполнения"""
+
+    __slots__ = ("name", "handler", "required", "ordered", "timer")
+
+    def __init__(self, name, handler, required, ordered):
+        self.name = name
+        self.handler = handler
+        self.required = required
+        self.ordered = ordered
+        self.timer = WS_COMMAND_SECONDS.labels(name)
+
+    def validate(self, data):
+        """Возвращает текст ошибки или None, если поля запроса корректны"""
+        missing = [field for field in self.required if data.get(field) in (None, "")]
+        if missing:
+            return f"Отсутствуют поля: {', '.join(missing)}"
+        for field, expected in self.required.items():
+            if expected is not None and not isinstance(data[field], expected):
+                names = " или ".join(TYPE_NAMES.get(kind, kind.__name__) for kind in
+                                     (expected if isinstance(expected, tuple) else (expected,)))
+                return f"Поле {field} должно быть {names}"
+        return None
+
+
+class Request:
+    """Запрос клиента: ответы на него помечаются request_id, если клиент его передал"""
+
+    __slots__ = ("websocket", "command", "request_id")
+
+    def __init__(self, websocket, command, request_id):
+        self.websocket = websocket
+        self.command = command
+        self.request_id = request_id
+
+    async def send(self, payload):
+        if self.request_id is not None:
+            payload["request_id"] = self.request_id
+        await self.websocket.send(json.dumps(payload))
+
+    async def error(self, message):
+        payload = {"status": "error", "message": message}
+        if self.command is not None:
+            payload["command"] = self.command
+        await self.send(payload)
+
+
+class CommandRouter:
+    """Маршрутизация команд WebSocket по зарегистрированным обработчикам.
+
+    Запросы с request_id выполняются параллельно (не больше max_in_flight на соединение) и могут завершаться
+    в любом порядке. Запросы без request_id и команды с ordered=True ждут завершения всех начатых запросов
+    и выполняются до чтения следующего сообщения - как при прежней последовательной обработке."""
+
+    def __init__(self, max_in_flight=8):
+        self.max_in_flight = max_in_flight
+        self.commands = {}
+        self.fallback = None
+        self.requests = 0
+        self.concurrent = 0
+        self.max_concurrent = 0
+        self.unknown = 0
+        self.bad_json = 0
+        self.invalid = 0
+        self.failed = 0
+
+    def command(self, name, required=None, ordered=False):
+        """Декоратор регистрации обработчика: async handler(request, data) -> ответ (dict) или None;
+        required - {поле: тип или None}"""
+        def decorator(handler):
+            if name in self.commands:
+                raise ValueError(f"Команда {name} уже зарегистрирована")
+            self.commands[name] = Command(name, handler, dict(required or {}), ordered)
+            return handler
+        return decorator
+
+    def set_fallback(self, handler):
+        """Обработчик сообщений без поля command (прежний протокол); выполняется упорядоченно"""
+        self.fallback = Command("card_state", handler, {}, True)
+        return handler
+
+    async def serve(self, websocket):
+        """Читает сообщения соединения до его закрытия"""
+        in_flight = set()
+        slots = asyncio.Semaphore(self.max_in_flight)
+        try:
+            async for message in websocket:
+                dispatch = await self._prepare(websocket, message)
+                if dispatch is None:
+                    continue
+                command, request, data = dispatch
+                if request.request_id is None or command.ordered:
+                    if in_flight:
+                        await asyncio.wait(in_flight)
+                    await self._run(command, request, data)
+                    continue
+                await slots.acquire()
+                task = asyncio.create_task(self._run(command, request, data))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+                task.add_done_callback(lambda _: slots.release())
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+    async def _prepare(self, websocket, message):
+        """Разбор и проверка сообщения; ошибки разбора и неизвестные команды отвечаются сразу"""
+        try:
+            data = json.loads(message)
+        except ValueError:
+            self.bad_json += 1
+            log.error("Невозможно разобрать JSON: %s", message)
+            await websocket.send('{"status": "error", "message": "Неверный формат JSON"}')
+            return None
+        if not isinstance(data, dict):
+            self.invalid += 1
+            await websocket.send('{"status": "error", "message": "Неизвестный формат сообщения"}')
+            return None
+
+        name = data.get("command")
+        request_id = data.get("request_id")
+        request = Request(websocket, name, request_id)
+        if request_id is not None and (isinstance(request_id, bool) or not isinstance(request_id, (str, int))):
+            self.invalid += 1
+            request.request_id = None
+            await request.error("request_id должен быть строкой или числом")
+            return None
+
+        if name is None:
+            command = self.fallback
+        else:
+            command = self.commands.get(name) if isinstance(name, str) else None
+            if command is None:
+                self.unknown += 1
+                await request.send({"status": "error", "message": f"Неизвестная команда: {name}"})
+                return None
+        if command is None:
+            self.invalid += 1
+            log.warning("Неизвестный формат сообщения: %s", data)
+            await request.send({"status": "error", "message": "Неизвестный формат сообщения"})
+            return None
+
+        problem = command.validate(data)
+        if problem:
+            self.invalid += 1
+            await request.error(problem)
+            return None
+        return command, request, data
+
+    async def _run(self, command, request, data):
+        """Выполняет обработчик и отправляет его ответ; ошибки обработчика не разрывают соединение"""
+        self.requests += 1
+        self.concurrent += 1
+        self.max_concurrent = max(self.max_concurrent, self.concurrent)
+        span, token = slow_trace.begin("ws", command.name)
+        started = time.perf_counter()
+        try:
+            response = await command.handler(request, data)
+            if response is not None:
+                await request.send(response)
+        except ConnectionClosed:
+            pass
+        except CommandError as e:
+            await self._reply_error(request, str(e))
+        except DatabaseBusyError as e:
+            log.error("БД недоступна при обработке команды %s: %s", command.name, e)
+            await self._reply_error(request, "База данных перегружена, повторите запрос")
+        except Exception as e:
+            self.failed += 1
+            log.exception("Ошибка обработки команды %s: %s", command.name, e)
+            await self._reply_error(request, f"Ошибка обработки команды: {e}")
+        finally:
+            self.concurrent -= 1
+            command.timer.observe(time.perf_counter() - started)
+            if span is not None:
+                slow_trace.finish(span, token, "handle")
+
+    @staticmethod
+    async def _reply_error(request, message):
+        try:
+            await request.error(message)
+        except ConnectionClosed:
+            pass
+
+    def stats(self):
+        """Возвращает счётчики маршрутизатора"""
+        return {
+            "commands": len(self.commands),
+            "requests": self.requests,
+            "in_flight": self.concurrent,
+            "max_in_flight": self.max_concurrent,
+            "unknown": self.unknown,
+            "bad_json": self.bad_json,
+            "invalid": self.invalid,
+            "failed": self.failed
+        }
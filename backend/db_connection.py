@@ -0,0 +1,89 @@
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+log = logging.getLogger("db")
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -16000,
+    "mmap_size": 64 * 1024 * 1024,
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,
+}
+
+
+class ConnectionManager:
+    """Долгоживущие потоково-локальные подключения к SQLite с WAL и кэшем подготовленных запросов"""
+
+    def __init__(self, db_file, pragmas=None, cached_statements=256):
+        self.db_file = db_file
+        self.pragmas = dict(DEFAULT_PRAGMAS)
+        if pragmas:
+            self.pragmas.update(pragmas)
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        """Открывает и настраивает новое подключение"""
+        conn = sqlite3.connect(
+            self.db_file,
+            timeout=self.pragmas["busy_timeout"] / 1000,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=self.cached_statements
+        )
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name}={value}")
+        with self._lock:
+            self._connections.append(conn)
+        log.debug("Открыто подключение к %s в потоке %s", self.db_file, threading.current_thread().name)
+        return conn
+
+    def connection(self):
+        """Возвращает подключение текущего потока, создавая его при первом обращении"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Транзакция записи (BEGIN IMMEDIATE); вложенные вызовы выполняются в рамках внешней"""
+        conn = self.connection()
+        if self._local.depth:
+            self._local.depth += 1
+            try:
+                yield conn
+            finally:
+                self._local.depth -= 1
+            return
+
+        conn.execute("BEGIN IMMEDIATE")
+        self._local.depth = 1
+        try:
+            yield conn
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+        finally:
+            self._local.depth = 0
+
+    def close_all(self):
+        """Закрывает все открытые подключения"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                log.error("Ошибка при закрытии подключения к БД: %s", e)
+        self._local = threading.local()
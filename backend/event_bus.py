@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import threading
+
+log = logging.getLogger("ws")
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+
+
+class Subscription:
+    """Подписка на события шины с ограниченной очередью"""
+
+    def __init__(self, bus, topics, maxsize, drop_policy):
+        if drop_policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError(f"Неизвестная политика отбрасывания: {drop_policy}")
+        self.bus = bus
+        self.topics = frozenset(topics) if topics else None
+        self.drop_policy = drop_policy
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.delivered = 0
+        self.dropped = 0
+
+    def _offer(self, topic, event):
+        """Кладёт событие в очередь, не ожидая подписчика"""
+        if self.queue.full():
+            self.dropped += 1
+            if self.drop_policy == DROP_NEWEST:
+                return
+            self.queue.get_nowait()
+        self.queue.put_nowait((topic, event))
+        self.delivered += 1
+
+    async def get(self):
+        """Ожидает следующее событие: (тема, данные)"""
+        return await self.queue.get()
+
+    def close(self):
+        """Отписывается от шины"""
+        self.bus.unsubscribe(self)
+
+
+class EventBus:
+    """Внутренняя шина событий между подсистемами; публикация никогда не ждёт подписчиков"""
+
+    def __init__(self):
+        self.loop = None
+        self._loop_thread = None
+        self._subscribers = ()
+        self.published = 0
+
+    def bind(self, loop):
+        """Привязывает шину к циклу событий, в котором живут подписчики"""
+        self.loop = loop
+        self._loop_thread = threading.get_ident()
+
+    def subscribe(self, topics=None, maxsize=256, drop_policy=DROP_OLDEST):
+        """Создаёт подписку на темы (None - на все); вызывается из потока цикла событий"""
+        subscription = Subscription(self, topics, maxsize, drop_policy)
+        self._subscribers = self._subscribers + (subscription,)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Удаляет подписку"""
+        self._subscribers = tuple(sub for sub in self._subscribers if sub is not subscription)
+
+    def publish(self, topic, event):
+        """Публикует событие из любого потока"""
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            return
+        if threading.get_ident() == self._loop_thread:
+            self._deliver(topic, event)
+        else:
+            try:
+                loop.call_soon_threadsafe(self._deliver, topic, event)
+            except RuntimeError:
+                log.debug("Шина событий остановлена, событие %s отброшено", topic)
+
+    def _deliver(self, topic, event):
+        self.published += 1
+        for subscription in self._subscribers:
+            if subscription.topics is None or topic in subscription.topics:
+                subscription._offer(topic, event)
+
+    def stats(self):
+        """Возвращает счётчики шины и подписчиков"""
+        return {
+            "published": self.published,
+            "subscribers": [
+                {
+                    "topics": sorted(sub.topics) if sub.topics else None,
+                    "queued": sub.queue.qsize(),
+                    "maxsize": sub.queue.maxsize,
+                    "delivered": sub.delivered,
+                    "dropped": sub.dropped
+                }
+                for sub in self._subscribers
+            ]
+        }
+
+
+event_bus = EventBus()
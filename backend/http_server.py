@@ -0,0 +1,415 @@
+import asyncio
+import email.utils
+import hashlib
+import http
+import json
+import logging
+import mimetypes
+import os
+import re
+from urllib.parse import parse_qs, unquote, urlsplit
+from websockets.asyncio.connection import Connection
+from websockets.asyncio.server import ServerConnection
+from websockets.datastructures import Headers
+from websockets.http11 import Response
+from backend.settings import CARD_DB, MAX_IMAGE_SIZE, MEDIA_CACHE, MEDIA_MAX_AGE
+from backend.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, render_metrics
+from backend.media_upload import CHUNK_SIZE, UploadError, receive_card_image
+
+log = logging.getLogger("ws")
+FRONTEND_DIR = "frontend"
+UPLOAD_PATH_RE = re.compile(r"/api/cards/([^/]+)/([^/]+)/image")
+MAX_HEAD_SIZE = 16 * 1024
+HEAD_TIMEOUT = 10.0
+BODY_READ_TIMEOUT = 30.0
+
+
+class StaticAsset:
+    """Файл фронтенда, заранее загруженный в память"""
+
+    __slots__ = ("body", "content_type", "etag", "last_modified")
+
+    def __init__(self, body, content_type, etag, last_modified):
+        self.body = body
+        self.content_type = content_type
+        self.etag = etag
+        self.last_modified = last_modified
+
+
+def _parse_range(header, size):
+    """Разбирает заголовок Range с одним диапазоном: (начало, конец) включительно, None или 'invalid'"""
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start, _, end = header[6:].strip().partition("-")
+    try:
+        if start:
+            start = int(start)
+            end = min(int(end), size - 1) if end else size - 1
+        else:
+            length = int(end)
+            if length <= 0:
+                return "invalid"
+            start, end = max(size - length, 0), size - 1
+    except ValueError:
+        return None
+    if start >= size or start > end:
+        return "invalid"
+    return start, end
+
+
+class RequestBody:
+    """Тело HTTP-запроса: приходит в цикле событий, читается потоком загрузки через read().
+
+    Пока поток не успевает записывать файл, чтение из сокета приостанавливается (буфер StreamReader)"""
+
+    def __init__(self, loop, transport, length, timeout=BODY_READ_TIMEOUT):
+        self.loop = loop
+        self.reader = asyncio.StreamReader(limit=CHUNK_SIZE, loop=loop)
+        self.reader.set_transport(transport)
+        self.remaining = length
+        self.timeout = timeout
+        if not length:
+            self.reader.feed_eof()
+
+    def feed(self, data):
+        """Принимает очередной фрагмент из сокета; байты сверх Content-Length отбрасываются"""
+        if self.remaining <= 0:
+            return
+        data = data[:self.remaining]
+        self.remaining -= len(data)
+        self.reader.feed_data(data)
+        if self.remaining <= 0:
+            self.reader.feed_eof()
+
+    def abort(self):
+        """Соединение закрыто до конца тела"""
+        if self.remaining > 0:
+            self.reader.set_exception(UploadError("Соединение закрыто во время загрузки"))
+
+    def read(self, size=-1):
+        """Блокирующее чтение из потока загрузки (не из цикла событий)"""
+        future = asyncio.run_coroutine_threadsafe(self.reader.read(size if size > 0 else CHUNK_SIZE), self.loop)
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise UploadError("Клиент слишком долго не передаёт тело запроса", 408) from None
+
+
+class HttpConnection(ServerConnection):
+    """Соединение на порту WebSocket, которое само обслуживает HTTP-запросы с телом.
+
+    websockets разбирает только GET, поэтому соединение передаётся серверу websockets лишь после начала
+    запроса: GET (рукопожатие или статика через process_request) уходит ему без изменений, а остальные
+    запросы, в том числе потоковую загрузку изображений, обрабатывает AsyncHttpFrontend"""
+
+    def __init__(self, *args, frontend, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.frontend = frontend
+        self.head = b""
+        self.head_timer = None
+        self.body = None
+        self.pending = None
+        self.request_task = None
+
+    def connection_made(self, transport):
+        # Регистрация в сервере websockets (и его таймаут рукопожатия) откладывается до начала запроса
+        Connection.connection_made(self, transport)
+        self.head_timer = self.loop.call_later(HEAD_TIMEOUT, transport.abort)
+
+    def data_received(self, data):
+        if self.head is None:
+            if self.request_task is None:
+                super().data_received(data)
+            elif self.body is not None:
+                self.body.feed(data)
+            elif self.pending is not None:
+                self.pending += data
+            return
+
+        self.head += data
+        if self.head.startswith(b"GET "):
+            data, self.head = self.head, None
+            self.head_timer.cancel()
+            self.server.start_connection_handler(self)
+            super().data_received(data)
+            return
+        end = self.head.find(b"\r\n\r\n")
+        if end < 0:
+            if len(self.head) > MAX_HEAD_SIZE:
+                self._reply(self.frontend.error_response(http.HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE))
+            return
+        # Начало тела копится в pending, пока AsyncHttpFrontend не создаст RequestBody
+        head, self.pending, self.head = self.head[:end], self.head[end + 4:], None
+        self.head_timer.cancel()
+        self.request_task = self.loop.create_task(self._serve_request(head))
+
+    async def _serve_request(self, head):
+        try:
+            response = await self.frontend.process_body_request(self, head)
+        except Exception as e:
+            log.error("Ошибка обработки HTTP-запроса: %s", e)
+            response = self.frontend.error_response(http.HTTPStatus.INTERNAL_SERVER_ERROR)
+        self._reply(response)
+
+    def _reply(self, response):
+        self.head = self.pending = None
+        if not self.transport.is_closing():
+            self.transport.write(response.serialize())
+            self.transport.close()
+
+    def connection_lost(self, exc):
+        if self.head_timer is not None:
+            self.head_timer.cancel()
+        if self.body is not None:
+            self.body.abort()
+        super().connection_lost(exc)
+
+
+class AsyncHttpFrontend:
+    """HTTP на порту WebSocket: статика из памяти, изображения из кэша горячих файлов и загрузка изображений.
+
+    GET обслуживается через process_request websockets, запросы с телом - через HttpConnection"""
+
+    def __init__(self, media_cache, media_max_age, card_db=None, max_upload_size=MAX_IMAGE_SIZE,
+                 frontend_dir=FRONTEND_DIR):
+        self.media_cache = media_cache
+        self.media_max_age = media_max_age
+        self.card_db = card_db
+        self.max_upload_size = max_upload_size
+        self.frontend_dir = frontend_dir
+        self.assets = {}
+        self.requests = 0
+        self.uploads = 0
+        self.not_modified = 0
+        self.partial = 0
+        self.not_found = 0
+        self.bytes_out = 0
+
+    def load_static(self):
+        """Загружает в память страницы, скрипты и /static с предвычисленными ETag"""
+        self.assets = {}
+        for url, relative in (("/", "index.html"), ("/index.html", "index.html"),
+                              ("/card-viewer.html", "card-viewer.html")):
+            self._add_asset(url, os.path.join(self.frontend_dir, relative))
+        for folder, prefix in (("src", "/src/"), ("static", "/static/")):
+            root = os.path.join(self.frontend_dir, folder)
+            for dirpath, _, filenames in os.walk(root):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    self._add_asset(prefix + os.path.relpath(path, root).replace(os.sep, "/"), path)
+        log.info("HTTP: загружено статических файлов: %s", len(self.assets))
+
+    def _add_asset(self, url, path):
+        if not os.path.isfile(path):
+            return
+        with open(path, "rb") as f:
+            body = f.read()
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        if content_type.startswith("text/") or content_type in ("application/javascript", "text/javascript"):
+            content_type += "; charset=utf-8"
+        self.assets[url] = StaticAsset(body, content_type, hashlib.sha256(body).hexdigest()[:32],
+                                       os.path.getmtime(path))
+
+    async def process_request(self, connection, request):
+        """Хук websockets: отвечает на обычные HTTP-запросы и пропускает рукопожатия WebSocket"""
+        if request.headers.get("Upgrade", "").lower() == "websocket":
+            return None
+
+        self.requests += 1
+        path = unquote(urlsplit(request.path).path)
+
+        if path.startswith("/media/"):
+            return await self._serve_media(request, path[len("/media/"):])
+        if path == "/metrics":
+            return self._metrics()
+
+        asset = self.assets.get(path)
+        if asset is None:
+            return self.error_response(http.HTTPStatus.NOT_FOUND)
+        return self._respond(request, asset.body, asset.content_type, asset.etag, asset.last_modified, "no-cache")
+
+    def create_connection(self, *args, **kwargs):
+        """Фабрика соединений для websockets.serve(create_connection=...)"""
+        return HttpConnection(*args, frontend=self, **kwargs)
+
+    async def process_body_request(self, connection, head):
+        """Запрос, который не разбирает websockets (не GET): загрузка изображения карты POST/PUT"""
+        self.requests += 1
+        try:
+            request_line, *header_lines = head.decode("latin-1").split("\r\n")
+            method, target, _ = request_line.split(" ")
+            headers = Headers()
+            for line in header_lines:
+                name, value = line.split(":", 1)
+                headers[name.strip()] = value.strip()
+        except ValueError:
+            return self.error_response(http.HTTPStatus.BAD_REQUEST)
+
+        match = UPLOAD_PATH_RE.fullmatch(urlsplit(target).path)
+        if match is None or method not in ("POST", "PUT"):
+            response = self.error_response(http.HTTPStatus.METHOD_NOT_ALLOWED)
+            response.headers["Allow"] = "GET" if match is None else "POST, PUT"
+            return response
+        if "Content-Length" not in headers or "Transfer-Encoding" in headers:
+            return self.error_response(http.HTTPStatus.LENGTH_REQUIRED)
+        length = headers["Content-Length"]
+        if not length.isdigit():
+            return self.error_response(http.HTTPStatus.BAD_REQUEST)
+        length = int(length)
+
+        connection.body = body = RequestBody(connection.loop, connection.transport, length)
+        body.feed(connection.pending)
+        connection.pending = None
+        if length <= self.max_upload_size and headers.get("Expect", "").lower() == "100-continue":
+            connection.transport.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+
+        full_type = headers.get("Content-Type", "")
+        environ = {
+            "REQUEST_METHOD": method,
+            "CONTENT_TYPE": full_type,
+            "CONTENT_LENGTH": str(length),
+            "wsgi.input": body
+        }
+        payload, status = await asyncio.to_thread(
+            receive_card_image, self.card_db, unquote(match.group(1)), unquote(match.group(2)),
+            full_type.split(";", 1)[0].strip().lower(), length, body, environ, self.max_upload_size,
+            headers.get("X-Filename") or parse_qs(urlsplit(target).query).get("filename", [None])[0]
+        )
+        if status < 300:
+            self.uploads += 1
+        return self._json(status, payload)
+
+    async def _serve_media(self, request, name):
+        media_file = self.media_cache.lookup(name)
+        if media_file is None:
+            media_file = await asyncio.to_thread(self.media_cache.load, name)
+        if media_file is None:
+            return self.error_response(http.HTTPStatus.NOT_FOUND)
+
+        body = media_file.data
+        if body is None:
+            body = await asyncio.to_thread(self._read_file, media_file.path)
+            if body is None:
+                self.media_cache.invalidate(name)
+                return self.error_response(http.HTTPStatus.NOT_FOUND)
+
+        if media_file.immutable:
+            cache_control = f"public, max-age={self.media_max_age}, immutable"
+        else:
+            cache_control = "no-cache"
+        return self._respond(request, body, media_file.content_type, media_file.etag, media_file.mtime, cache_control)
+
+    @staticmethod
+    def _read_file(path):
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _respond(self, request, body, content_type, etag, last_modified, cache_control):
+        """Ответ с учётом If-None-Match / If-Modified-Since и Range"""
+        quoted_etag = f'"{etag}"'
+        headers = Headers([
+            ("Date", email.utils.formatdate(usegmt=True)),
+            ("Connection", "close"),
+            ("ETag", quoted_etag),
+            ("Last-Modified", email.utils.formatdate(last_modified, usegmt=True)),
+            ("Cache-Control", cache_control),
+            ("Accept-Ranges", "bytes"),
+        ])
+
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match is not None:
+            candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            fresh = quoted_etag in candidates or "*" in candidates
+        else:
+            fresh = self._not_modified_since(request.headers.get("If-Modified-Since"), last_modified)
+        if fresh:
+            self.not_modified += 1
+            return self._build(http.HTTPStatus.NOT_MODIFIED, headers, b"")
+
+        status = http.HTTPStatus.OK
+        byte_range = _parse_range(request.headers.get("Range"), len(body))
+        if byte_range == "invalid":
+            headers["Content-Range"] = f"bytes */{len(body)}"
+            headers["Content-Length"] = "0"
+            return self._build(http.HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE, headers, b"")
+        if byte_range is not None:
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(body)}"
+            body = body[start:end + 1]
+            status = http.HTTPStatus.PARTIAL_CONTENT
+            self.partial += 1
+
+        headers["Content-Type"] = content_type
+        headers["Content-Length"] = str(len(body))
+        self.bytes_out += len(body)
+        return self._build(status, headers, body)
+
+    @staticmethod
+    def _not_modified_since(header, last_modified):
+        if not header:
+            return False
+        try:
+            since = email.utils.parsedate_to_datetime(header).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(last_modified) <= since
+
+    def _metrics(self):
+        body = render_metrics().encode()
+        headers = Headers([
+            ("Date", email.utils.formatdate(usegmt=True)),
+            ("Connection", "close"),
+            ("Cache-Control", "no-store"),
+            ("Content-Type", METRICS_CONTENT_TYPE),
+            ("Content-Length", str(len(body))),
+        ])
+        self.bytes_out += len(body)
+        return self._build(http.HTTPStatus.OK, headers, body)
+
+    def _json(self, status, payload):
+        body = json.dumps(payload).encode()
+        headers = Headers([
+            ("Date", email.utils.formatdate(usegmt=True)),
+            ("Connection", "close"),
+            ("Cache-Control", "no-store"),
+            ("Content-Type", "application/json"),
+            ("Content-Length", str(len(body))),
+        ])
+        status = http.HTTPStatus(status)
+        return self._build(status, headers, body)
+
+    def error_response(self, status):
+        """Текстовый ответ с кодом ошибки"""
+        if status == http.HTTPStatus.NOT_FOUND:
+            self.not_found += 1
+        body = f"{status.value} {status.phrase}\n".encode()
+        headers = Headers([
+            ("Date", email.utils.formatdate(usegmt=True)),
+            ("Connection", "close"),
+            ("Content-Type", "text/plain; charset=utf-8"),
+            ("Content-Length", str(len(body))),
+        ])
+        return self._build(status, headers, body)
+
+    @staticmethod
+    def _build(status, headers, body):
+        return Response(status.value, status.phrase, headers, body)
+
+    def stats(self):
+        """Возвращает счётчики HTTP-запросов"""
+        return {
+            "requests": self.requests,
+            "uploads": self.uploads,
+            "not_modified": self.not_modified,
+            "partial": self.partial,
+            "not_found": self.not_found,
+            "bytes_out": self.bytes_out,
+            "static_assets": len(self.assets)
+        }
+
+
+http_frontend = AsyncHttpFrontend(MEDIA_CACHE, MEDIA_MAX_AGE, CARD_DB, MAX_IMAGE_SIZE)
@@ -0,0 +1,88 @@
+import bisect
+import threading
+
+
+def _bucket_bounds(start=0.00001, end=60.0, factor=1.2):
+    """Границы корзин гистограммы (в секундах), растущие в геометрической прогрессии"""
+    bounds = []
+    value = start
+    while value < end:
+        bounds.append(value)
+        value *= factor
+    bounds.append(end)
+    return bounds
+
+
+BUCKET_BOUNDS = _bucket_bounds()
+
+
+class LatencyHistogram:
+    """Гистограмма задержек с логарифмическими корзинами (погрешность перцентилей ~20%)"""
+
+    def __init__(self, bounds=BUCKET_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        """Добавляет одно измерение"""
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """Возвращает верхнюю границу корзины, в которую попадает p-й перцентиль"""
+        if not self.count:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank and bucket_count:
+                return min(self.bounds[index], self.max) if index < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        """Сводка в миллисекундах: количество, среднее, p50/p95/p99, максимум"""
+        return {
+            "count": self.count,
+            "avg_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            "p50_ms": round(self.percentile(50) * 1000, 3),
+            "p95_ms": round(self.percentile(95) * 1000, 3),
+            "p99_ms": round(self.percentile(99) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3)
+        }
+
+
+class LatencyTracker:
+    """Набор гистограмм задержек по ключу (например, по считывателю)"""
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, key, seconds):
+        """Добавляет измерение для ключа"""
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, LatencyHistogram())
+        histogram.observe(seconds)
+
+    def snapshot(self):
+        """Сводка по всем ключам"""
+        with self._lock:
+            items = list(self._histograms.items())
+        return {str(key): histogram.snapshot() for key, histogram in items}
+
+    def reset(self):
+        """Сбрасывает все измерения"""
+        with self._lock:
+            self._histograms = {}
+
+
+scan_latency = LatencyTracker()
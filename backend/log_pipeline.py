@@ -0,0 +1,140 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from datetime import datetime
+from backend.metrics import LOG_RECORDS_DROPPED
+
+MAX_ITEMS = 20
+MAX_DEPTH = 3
+MAX_SAMPLE_KEYS = 10000
+
+
+def shorten(value, limit, depth=0):
+    """Копия значения с обрезанными длинными строками и коллекциями (например, base64 в image_data)"""
+    if isinstance(value, str):
+        return value if len(value) <= limit else f"{value[:limit]}...(+{len(value) - limit} символов)"
+    if isinstance(value, (bytes, bytearray)):
+        return value if len(value) <= limit else f"<{len(value)} байт>"
+    if depth >= MAX_DEPTH:
+        return value
+    if isinstance(value, dict):
+        items = list(value.items())
+        result = {key: shorten(item, limit, depth + 1) for key, item in items[:MAX_ITEMS]}
+        if len(items) > MAX_ITEMS:
+            result["..."] = f"+{len(items) - MAX_ITEMS}"
+        return result
+    if isinstance(value, (list, tuple)):
+        result = [shorten(item, limit, depth + 1) for item in value[:MAX_ITEMS]]
+        if len(value) > MAX_ITEMS:
+            result.append(f"...(+{len(value) - MAX_ITEMS})")
+        return tuple(result) if isinstance(value, tuple) else result
+    return value
+
+
+class StructuredFormatter(logging.Formatter):
+    """Форматирует запись в строку JSON (или текст) с обрезкой длинных аргументов"""
+
+    def __init__(self, json_lines=True, max_field=256):
+        super().__init__("%(asctime)s %(name)s %(message)s")
+        self.json_lines = json_lines
+        self.max_field = max_field
+
+    def format(self, record):
+        if record.args:
+            record.args = shorten(record.args, self.max_field)
+        message = shorten(record.getMessage(), self.max_field * 8)
+        if not self.json_lines:
+            text = f"{self.formatTime(record)} {record.name} {message}"
+            suppressed = getattr(record, "suppressed", 0)
+            if suppressed:
+                text += f" (пропущено похожих: {suppressed})"
+            if record.exc_info:
+                text += "\n" + self.formatException(record.exc_info)
+            return text
+
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": message
+        }
+        suppressed = getattr(record, "suppressed", 0)
+        if suppressed:
+            entry["suppressed"] = suppressed
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает не больше burst одинаковых записей (логгер + шаблон) за window секунд;
+    число пропущенных добавляется к первой записи следующего окна"""
+
+    def __init__(self, window=1.0, burst=20):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self.windows = {}
+
+    def filter(self, record):
+        if record.levelno >= logging.CRITICAL:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        state = self.windows.get(key)
+        if state is None or now - state[0] >= self.window:
+            if len(self.windows) >= MAX_SAMPLE_KEYS:
+                self.windows.clear()
+            if state is not None and state[2]:
+                record.suppressed = state[2]
+            self.windows[key] = [now, 1, 0]
+            return True
+        state[1] += 1
+        if state[1] <= self.burst:
+            return True
+        state[2] += 1
+        LOG_RECORDS_DROPPED.labels("sampled").inc()
+        return False
+
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """Кладёт запись в очередь без форматирования; при переполнении запись отбрасывается, а не ждёт"""
+
+    def prepare(self, record):
+        # Форматирование (и обрезка аргументов) выполняется в потоке QueueListener
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.labels("queue_full").inc()
+
+
+def setup_logging(level="INFO", subsystem_levels=None, json_lines=True, queue_size=10000, max_field=256,
+                  sample_window=1.0, sample_burst=20, stream=None):
+    """Настраивает корневой логгер: очередь в вызывающем потоке, форматирование и вывод в фоновом потоке"""
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(StructuredFormatter(json_lines=json_lines, max_field=max_field))
+
+    handler = AsyncQueueHandler(queue.Queue(maxsize=queue_size))
+    if sample_burst:
+        handler.addFilter(SamplingFilter(window=sample_window, burst=sample_burst))
+
+    root = logging.getLogger()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(handler)
+    root.setLevel(level)
+    for name, subsystem_level in (subsystem_levels or {}).items():
+        logging.getLogger(name).setLevel(subsystem_level)
+
+    listener = logging.handlers.QueueListener(handler.queue, output, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,135 @@
+import mimetypes
+import os
+import re
+import stat
+import threading
+from collections import OrderedDict
+from werkzeug.security import safe_join
+
+CONTENT_NAME_RE = re.compile(r"[0-9a-f]{2}/[0-9a-f]{2}/([0-9a-f]{64})(\.[a-z0-9]{1,8})?")
+
+
+class MediaFile:
+    """Метаданные (и, для небольших файлов, содержимое) одного файла изображения"""
+
+    __slots__ = ("name", "path", "size", "mtime", "etag", "content_type", "immutable", "data")
+
+    def __init__(self, name, path, size, mtime, etag, content_type, immutable, data):
+        self.name = name
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.etag = etag
+        self.content_type = content_type
+        self.immutable = immutable
+        self.data = data
+
+
+class HotFileCache:
+    """LRU-кэш горячих файлов изображений с ограничением по суммарному размеру"""
+
+    def __init__(self, root, max_bytes=64 * 1024 * 1024, max_file_size=2 * 1024 * 1024, max_entries=4096):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def lookup(self, name):
+        """Возвращает запись из кэша, не читая файл с диска (None, если записи нет)"""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                self._entries.move_to_end(name)
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        # Файлы хранилища неизменяемы; старые плоские имена перепроверяем по времени изменения
+        if entry is not None and not entry.immutable:
+            try:
+                st = os.stat(entry.path)
+            except OSError:
+                st = None
+            if st is None or st.st_mtime != entry.mtime or st.st_size != entry.size:
+                self.invalidate(name)
+                with self._lock:
+                    self.hits -= 1
+                    self.misses += 1
+                return None
+        return entry
+
+    def get(self, name):
+        """Возвращает MediaFile по относительному имени или None, если файла нет"""
+        entry = self.lookup(name)
+        return entry if entry is not None else self.load(name)
+
+    def load(self, name):
+        """Читает файл с диска в кэш после промаха lookup(), не учитывая промах повторно; None, если файла нет"""
+        path = safe_join(self.root, name)
+        if path is None:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if not stat.S_ISREG(st.st_mode):
+            return None
+
+        data = None
+        if st.st_size <= self.max_file_size:
+            with open(path, "rb") as f:
+                data = f.read()
+
+        match = CONTENT_NAME_RE.fullmatch(name)
+        entry = MediaFile(
+            name=name,
+            path=os.path.abspath(path),
+            size=st.st_size,
+            mtime=st.st_mtime,
+            etag=match.group(1) if match else f"{st.st_size:x}-{st.st_mtime_ns:x}",
+            content_type=mimetypes.guess_type(name)[0] or "application/octet-stream",
+            immutable=match is not None,
+            data=data
+        )
+
+        with self._lock:
+            previous = self._entries.pop(name, None)
+            if previous is not None:
+                self.bytes -= len(previous.data or b"")
+            self._entries[name] = entry
+            self.bytes += len(data or b"")
+            while self._entries and (self.bytes > self.max_bytes or len(self._entries) > self.max_entries):
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= len(evicted.data or b"")
+                self.evictions += 1
+        return entry
+
+    def invalidate(self, name):
+        """Удаляет запись о файле (например, после удаления его сборщиком мусора)"""
+        with self._lock:
+            entry = self._entries.pop(name, None)
+            if entry is not None:
+                self.bytes -= len(entry.data or b"")
+                self.invalidations += 1
+
+    def stats(self):
+        """Возвращает счётчики кэша"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "hit_ratio": self.hits / total if total else 0.0
+            }
@@ -0,0 +1,264 @@
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import shutil
+import time
+import uuid
+
+log = logging.getLogger("db")
+SHARD_COUNT = 256
+TEMP_PREFIX = ".upload-"
+
+
+def normalize_ext(filename):
+    """Безопасное расширение файла в нижнем регистре ('' если его нет или оно подозрительное)"""
+    ext = os.path.splitext(filename or "")[1].lower()
+    return ext if re.fullmatch(r"\.[a-z0-9]{1,8}", ext) else ""
+
+
+def content_name(digest, ext):
+    """Относительное имя файла в хранилище: ab/cd/<sha256><ext>"""
+    return f"{digest[:2]}/{digest[2:4]}/{digest}{ext}"
+
+
+class MediaStore:
+    """Контентно-адресуемое хранилище изображений со счётчиками ссылок в таблице media_files"""
+
+    def __init__(self, root, db, grace_period=3600, on_relink=None):
+        self.root = root
+        self.db = db
+        self.grace_period = grace_period
+        self.on_relink = on_relink
+        self.unlink_listeners = []
+        self._skipped_legacy = set()
+        self.stored = 0
+        self.deduplicated = 0
+        self.collected = 0
+        self.adopted = 0
+        self.checked_shards = 0
+        self.repaired = 0
+        self.missing = 0
+
+    def path(self, name):
+        """Путь на диске для относительного имени файла"""
+        return os.path.join(self.root, *name.split("/"))
+
+    def temp_path(self):
+        """Путь для временного файла загрузки на той же файловой системе, что и хранилище"""
+        return os.path.join(self.root, f"{TEMP_PREFIX}{uuid.uuid4().hex}.tmp")
+
+    def put_bytes(self, data, ext):
+        """Сохраняет содержимое и возвращает его относительное имя"""
+        digest = hashlib.sha256(data).hexdigest()
+        temp_path = self.temp_path()
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        return self.put_file(temp_path, ext, digest)
+
+    def put_file(self, temp_path, ext, digest=None):
+        """Переносит временный файл в хранилище (или удаляет его, если такое содержимое уже есть)"""
+        try:
+            if digest is None:
+                with open(temp_path, "rb") as f:
+                    digest = hashlib.file_digest(f, "sha256").hexdigest()
+            name = content_name(digest, ext)
+            path = self.path(name)
+            size = os.path.getsize(temp_path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            now = int(time.time())
+
+            # Под блокировкой записи сборщик мусора не удалит файл между проверкой и регистрацией
+            with self.db.transaction() as conn:
+                if os.path.exists(path):
+                    os.remove(temp_path)
+                    self.deduplicated += 1
+                else:
+                    os.replace(temp_path, path)
+                    self.stored += 1
+                conn.execute('''
+                    INSERT INTO media_files (filename, size, refcount, created_ts, orphaned_ts)
+                    VALUES (?, ?, 0, ?, ?)
+                    ON CONFLICT (filename) DO UPDATE SET
+                        size = excluded.size,
+                        orphaned_ts = CASE WHEN refcount = 0 THEN excluded.orphaned_ts ELSE orphaned_ts END
+                ''', (name, size, now, now))
+            return name
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def add_unlink_listener(self, listener):
+        """Подписывает listener(name) на удаление файлов из хранилища"""
+        self.unlink_listeners.append(listener)
+
+    def _unlink(self, name):
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+        for listener in self.unlink_listeners:
+            listener(name)
+
+    def collect_garbage(self, limit=100):
+        """Удаляет файлы без ссылок, пролежавшие дольше grace_period; возвращает число удалённых"""
+        cutoff = int(time.time()) - self.grace_period
+        with self.db.transaction() as conn:
+            names = [row[0] for row in conn.execute(
+                "SELECT filename FROM media_files WHERE refcount = 0 AND orphaned_ts <= ? LIMIT ?",
+                (cutoff, limit)
+            )]
+            for name in names:
+                conn.execute("DELETE FROM media_files WHERE filename = ?", (name,))
+                self._unlink(name)
+        if names:
+            self.collected += len(names)
+            log.info("Сборщик мусора медиа: удалено файлов без ссылок: %s", len(names))
+        return len(names)
+
+    def adopt_legacy(self, limit=50):
+        """Переносит файлы старого формата {тип}_{uid}_{время}.ext в хранилище и обновляет ссылки;
+        сами старые файлы ставятся в очередь сборщика мусора"""
+        conn = self.db.connection()
+        names = [row[0] for row in conn.execute(
+            "SELECT DISTINCT image_filename FROM media WHERE instr(image_filename, '/') = 0 LIMIT ?",
+            (limit + len(self._skipped_legacy),)
+        ) if row[0] not in self._skipped_legacy][:limit]
+
+        adopted = 0
+        for old_name in names:
+            old_path = os.path.join(self.root, old_name)
+            if not os.path.isfile(old_path):
+                log.warning("Файл изображения %s не найден, перенос в хранилище пропущен", old_name)
+                self._skipped_legacy.add(old_name)
+                continue
+            temp_path = self.temp_path()
+            shutil.copyfile(old_path, temp_path)
+            new_name = self.put_file(temp_path, normalize_ext(old_name))
+            # Триггер media_files_reref обнуляет счётчик ссылок старого имени: файл остаётся доступным
+            # по прежним imageUrl и удаляется сборщиком мусора через grace_period
+            with self.db.transaction() as conn:
+                conn.execute("UPDATE media SET image_filename = ? WHERE image_filename = ?", (new_name, old_name))
+            adopted += 1
+
+        if adopted:
+            self.adopted += adopted
+            log.info("Перенесено изображений старого формата в хранилище: %s", adopted)
+            if self.on_relink:
+                self.on_relink()
+        return adopted
+
+    def check_shards(self, count=8):
+        """Сверяет с диском очередные count шардов; позиция сохраняется в БД между запусками"""
+        conn = self.db.connection()
+        row = conn.execute("SELECT value FROM media_meta WHERE key = 'check_cursor'").fetchone()
+        cursor = int(row[0]) if row else 0
+        for _ in range(count):
+            self._check_shard(f"{cursor:02x}")
+            cursor = (cursor + 1) % SHARD_COUNT
+            if cursor == 0:
+                self._check_top_level()
+        with self.db.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO media_meta (key, value) VALUES ('check_cursor', ?)", (str(cursor),))
+        return cursor
+
+    def _check_shard(self, shard):
+        """Сверяет один шард: файлы на диске, таблица media_files и фактические ссылки из media"""
+        low, high = shard + "/", shard + "0"
+        now = int(time.time())
+        with self.db.transaction() as conn:
+            on_disk = {}
+            shard_dir = os.path.join(self.root, shard)
+            if os.path.isdir(shard_dir):
+                for sub in os.scandir(shard_dir):
+                    if not sub.is_dir():
+                        continue
+                    for entry in os.scandir(sub.path):
+                        if entry.is_file():
+                            on_disk[f"{shard}/{sub.name}/{entry.name}"] = entry.stat().st_size
+
+            references = dict(conn.execute(
+                "SELECT image_filename, COUNT(*) FROM media WHERE image_filename >= ? AND image_filename < ? "
+                "GROUP BY image_filename", (low, high)
+            ))
+            known = dict(conn.execute(
+                "SELECT filename, refcount FROM media_files WHERE filename >= ? AND filename < ?", (low, high)
+            ))
+
+            for name in on_disk.keys() | references.keys() | known.keys():
+                refs = references.get(name, 0)
+                if name not in on_disk:
+                    if refs:
+                        self.missing += 1
+                        log.warning("Файл изображения %s отсутствует на диске, ссылок: %s", name, refs)
+                    elif name in known:
+                        conn.execute("DELETE FROM media_files WHERE filename = ?", (name,))
+                        self.repaired += 1
+                        continue
+                if name not in known:
+                    conn.execute(
+                        "INSERT INTO media_files (filename, size, refcount, created_ts, orphaned_ts) VALUES (?, ?, ?, ?, ?)",
+                        (name, on_disk.get(name, 0), refs, now, None if refs else now)
+                    )
+                    self.repaired += 1
+                elif known[name] != refs:
+                    conn.execute(
+                        "UPDATE media_files SET refcount = ?, orphaned_ts = ? WHERE filename = ?",
+                        (refs, None if refs else now, name)
+                    )
+                    self.repaired += 1
+        self.checked_shards += 1
+
+    def _check_top_level(self):
+        """Ставит в очередь на удаление старые плоские файлы без ссылок и брошенные временные файлы"""
+        cutoff = time.time() - self.grace_period
+        now = int(time.time())
+        with self.db.transaction() as conn:
+            for entry in os.scandir(self.root):
+                if not entry.is_file() or entry.stat().st_mtime > cutoff:
+                    continue
+                if entry.name.startswith(TEMP_PREFIX):
+                    os.remove(entry.path)
+                    continue
+                if conn.execute("SELECT 1 FROM media WHERE image_filename = ?", (entry.name,)).fetchone():
+                    continue
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO media_files (filename, size, refcount, created_ts, orphaned_ts) "
+                    "VALUES (?, ?, 0, ?, ?)", (entry.name, entry.stat().st_size, now, now)
+                )
+                self.repaired += cursor.rowcount
+
+    def maintain(self, shards_per_pass=8):
+        """Один проход обслуживания: перенос старых файлов, сверка шардов, сборка мусора"""
+        self.adopt_legacy()
+        self.check_shards(shards_per_pass)
+        self.collect_garbage()
+
+    async def run(self, interval=60.0, shards_per_pass=8):
+        """Фоновое обслуживание хранилища в отдельном потоке каждые interval секунд"""
+        while True:
+            try:
+                await asyncio.to_thread(self.maintain, shards_per_pass)
+            except Exception as e:
+                log.error("Ошибка обслуживания хранилища изображений: %s", e)
+            await asyncio.sleep(interval)
+
+    def stats(self):
+        """Возвращает счётчики хранилища и сводку по таблице media_files"""
+        files, total_bytes, orphans = self.db.connection().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(refcount = 0), 0) FROM media_files"
+        ).fetchone()
+        return {
+            "files": files,
+            "bytes": total_bytes,
+            "orphans": orphans,
+            "stored": self.stored,
+            "deduplicated": self.deduplicated,
+            "collected": self.collected,
+            "adopted": self.adopted,
+            "checked_shards": self.checked_shards,
+            "repaired": self.repaired,
+            "missing": self.missing
+        }
@@ -0,0 +1,146 @@
+import hashlib
+import logging
+import os
+from werkzeug.formparser import parse_form_data
+
+log = logging.getLogger("ws")
+
+ALLOWED_IMAGE_TYPES = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+}
+CHUNK_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    """Ошибка загрузки изображения с HTTP-статусом ответа"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def detect_image_type(head):
+    """Определяет тип изображения по сигнатуре первых байт файла"""
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def check_declared_type(content_type):
+    """Отклоняет запрос с неподходящим Content-Type до чтения тела"""
+    if content_type not in ALLOWED_IMAGE_TYPES and content_type != "application/octet-stream":
+        raise UploadError(f"Неподдерживаемый тип файла: {content_type}", 415)
+
+
+def _finalize(temp_path, store, digest=None):
+    """Проверяет сигнатуру записанного файла и переносит его в хранилище изображений"""
+    with open(temp_path, "rb") as f:
+        image_type = detect_image_type(f.read(16))
+    if image_type is None:
+        raise UploadError("Файл не является изображением PNG, JPEG, GIF или WEBP", 415)
+    return store.put_file(temp_path, ALLOWED_IMAGE_TYPES[image_type], digest)
+
+
+def _discard(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def store_image_stream(stream, store, max_size):
+    """Потоково записывает тело запроса во временный файл; возвращает имя файла в хранилище"""
+    temp_path = store.temp_path()
+    digest = hashlib.sha256()
+    size = 0
+    head = b""
+    try:
+        with open(temp_path, "wb") as f:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    raise UploadError(f"Файл больше {max_size} байт", 413)
+                if len(head) < 16:
+                    head += chunk[:16]
+                    if len(head) >= 16 and detect_image_type(head) is None:
+                        raise UploadError("Файл не является изображением PNG, JPEG, GIF или WEBP", 415)
+                digest.update(chunk)
+                f.write(chunk)
+        if not size:
+            raise UploadError("Пустой файл")
+        return _finalize(temp_path, store, digest.hexdigest())
+    except BaseException:
+        _discard(temp_path)
+        raise
+
+
+def store_image_multipart(environ, store, max_size, field="image"):
+    """Потоково разбирает multipart/form-data, записывая файл сразу во временный файл"""
+    temp_path = store.temp_path()
+
+    def stream_factory(total_content_length, content_type, filename, content_length=None):
+        if content_type not in ALLOWED_IMAGE_TYPES:
+            raise UploadError(f"Неподдерживаемый тип файла: {content_type}", 415)
+        return open(temp_path, "wb+")
+
+    try:
+        _, _, files = parse_form_data(environ, stream_factory=stream_factory, max_content_length=max_size)
+        upload = files.get(field)
+        if upload is None:
+            raise UploadError(f"В запросе нет файла в поле '{field}'")
+        upload.close()
+        if not os.path.getsize(temp_path):
+            raise UploadError("Пустой файл")
+        return _finalize(temp_path, store)
+    except BaseException:
+        _discard(temp_path)
+        raise
+
+
+def receive_card_image(card_db, card_type, uid, content_type, content_length, stream, environ, max_size,
+                       original_name=None):
+    """Загрузка изображения карты из тела HTTP-запроса: сырое тело или multipart/form-data (поле image).
+
+    Общая для Flask и HTTP на порту WebSocket; вызывается вне цикла событий, возвращает (ответ JSON, статус)"""
+    if content_length is not None and content_length > max_size:
+        return _upload_error(f"Файл больше {max_size} байт", 413)
+    if not card_db.check_card(card_type, uid):
+        return _upload_error("Карта не существует", 404)
+
+    try:
+        if content_type == "multipart/form-data":
+            filename = store_image_multipart(environ, card_db.media, max_size)
+        else:
+            check_declared_type(content_type)
+            filename = store_image_stream(stream, card_db.media, max_size)
+    except UploadError as e:
+        return _upload_error(str(e), e.status)
+    except Exception as e:
+        if getattr(e, "code", None) == 413:
+            return _upload_error(f"Файл больше {max_size} байт", 413)
+        log.error("Ошибка загрузки изображения: %s", e)
+        return _upload_error(f"Ошибка: {e}", 500)
+
+    success, message = card_db.attach_card_image(card_type, uid, filename)
+    if not success:
+        # Файл без ссылок удалит сборщик мусора хранилища
+        return _upload_error(message, 404)
+
+    log.info("Загружено изображение %s (исходное имя: %s)", filename, original_name)
+    return {"status": "success", "command": "upload_image", "message": message, "image_filename": filename}, 201
+
+
+def _upload_error(message, status):
+    return {"status": "error", "command": "upload_image", "message": message}, status
@@ -0,0 +1,321 @@
+import asyncio
+import bisect
+import functools
+import math
+import threading
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class _Sharded:
+    """Значение, накапливаемое в отдельной ячейке для каждого потока; ячейки суммируются при чтении"""
+
+    __slots__ = ("_shards", "_lock", "_size")
+
+    def __init__(self, size):
+        self._shards = {}
+        self._lock = threading.Lock()
+        self._size = size
+
+    def shard(self):
+        """Ячейка текущего потока: запись в неё без блокировок, т.к. пишет только этот поток"""
+        shard = self._shards.get(threading.get_ident())
+        if shard is None:
+            with self._lock:
+                shard = self._shards.setdefault(threading.get_ident(), [0] * self._size)
+        return shard
+
+    def total(self):
+        """Сумма ячеек всех потоков"""
+        with self._lock:
+            shards = list(self._shards.values())
+        result = [0] * self._size
+        for shard in shards:
+            for index, value in enumerate(shard):
+                result[index] += value
+        return result
+
+
+class CounterChild(_Sharded):
+    """Счётчик с конкретными значениями меток"""
+
+    __slots__ = ()
+
+    def __init__(self):
+        super().__init__(1)
+
+    def inc(self, amount=1):
+        self.shard()[0] += amount
+
+    def value(self):
+        return self.total()[0]
+
+
+class GaugeChild:
+    """Показатель с конкретными значениями меток: последнее записанное значение или функция"""
+
+    __slots__ = ("_value", "_function")
+
+    def __init__(self):
+        self._value = 0
+        self._function = None
+
+    def set(self, value):
+        self._value = value
+
+    def set_function(self, function):
+        """Значение вычисляется при чтении (например, размер множества клиентов)"""
+        self._function = function
+
+    def value(self):
+        return self._function() if self._function else self._value
+
+
+class HistogramChild(_Sharded):
+    """Гистограмма с конкретными значениями меток; ячейка потока: [корзины..., +Inf, сумма]"""
+
+    __slots__ = ("bounds",)
+
+    def __init__(self, bounds):
+        super().__init__(len(bounds) + 2)
+        self.bounds = bounds
+
+    def observe(self, value):
+        shard = self.shard()
+        shard[bisect.bisect_left(self.bounds, value)] += 1
+        shard[-1] += value
+
+    def time(self):
+        """Контекстный менеджер, измеряющий длительность блока"""
+        return _Timer(self)
+
+    def percentile(self, p, snapshot=None):
+        """Верхняя граница корзины, в которую попадает p-й перцентиль (inf - за последней границей)"""
+        cumulative, _, count = snapshot or self.snapshot()
+        if not count:
+            return 0.0
+        rank = p / 100 * count
+        for bound, seen in zip(self.bounds, cumulative):
+            if seen >= rank:
+                return bound
+        return math.inf
+
+    def snapshot(self):
+        """(накопленные счётчики по границам включая +Inf, сумма, количество)"""
+        totals = self.total()
+        cumulative, seen = [], 0
+        for count in totals[:-1]:
+            seen += count
+            cumulative.append(seen)
+        return cumulative, totals[-1], seen
+
+
+class _Timer:
+    __slots__ = ("histogram", "started")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started)
+
+
+class Metric:
+    """Семейство метрик с общим именем и набором меток"""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self._children[()] = self._new_child()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """Метрика с заданными значениями меток (результат стоит сохранить для горячего пути)"""
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"Метрика {self.name} ожидает метки {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def children(self):
+        with self._lock:
+            return list(self._children.items())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in self.children():
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    def _render_child(self, values, child):
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value())}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return CounterChild()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return GaugeChild()
+
+    def set(self, value):
+        self._default.set(value)
+
+    def set_function(self, function):
+        self._default.set_function(function)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return HistogramChild(self.bounds)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+    def timed(self, label=None, tracer=None):
+        """Декоратор: время выполнения функции с меткой label (по умолчанию - имя функции);
+        tracer (SlowTracer) получает вызовы дольше своего порога"""
+        def decorator(func):
+            name = label or func.__name__
+            child = self.labels(name)
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    elapsed = time.perf_counter() - started
+                    child.observe(elapsed)
+                    if tracer is not None and tracer.threshold is not None:
+                        tracer.report(self.name, name, elapsed)
+            return wrapper
+        return decorator
+
+    def _render_child(self, values, child):
+        cumulative, total, count = child.snapshot()
+        lines = []
+        for bound, seen in zip(self.bounds + (math.inf,), cumulative):
+            labels = _format_labels(self.labelnames, values, ("le", _format_value(float(bound))))
+            lines.append(f"{self.name}_bucket{labels} {seen}")
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(float(total))}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class Registry:
+    """Набор метрик процесса и их вывод в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+            self._metrics[metric.name] = metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """Текст для /metrics (формат exposition 0.0.4)"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+SCANS = Counter("card_scans_total", "Сканирования карт по считывателю и результату", ("reader", "result"))
+DB_QUERY_SECONDS = Histogram("db_query_seconds", "Время выполнения методов CardDatabase", ("method",))
+SERIAL_BYTES = Counter("serial_bytes_total", "Байты через COM-порт", ("port", "direction"))
+SERIAL_FRAMES = Counter("serial_frames_total", "Кадры через COM-порт", ("port", "direction"))
+SERIAL_PARSE_ERRORS = Counter("serial_parse_errors_total", "Кадры с некорректным JSON", ("port",))
+SERIAL_OVERFLOWS = Counter("serial_buffer_overflows_total", "Переполнения буфера кадра COM-порта", ("port",))
+WS_COMMAND_SECONDS = Histogram("ws_command_seconds", "Время выполнения команд WebSocket", ("command",))
+WS_CLIENTS = Gauge("websocket_clients", "Подключённые клиенты WebSocket", ("kind",))
+BROADCAST_SECONDS = Histogram("broadcast_duration_seconds", "Длительность рассылки одного сообщения клиентам")
+LOOP_LAG_SECONDS = Histogram("event_loop_lag_seconds", "Запаздывание цикла событий asyncio")
+LOG_RECORDS_DROPPED = Counter("log_records_dropped_total", "Записи журнала, не попавшие в вывод", ("reason",))
+UID_FILTER_CHECKS = Counter("uid_filter_checks_total", "Проверки UID фильтром перед запросом к БД", ("result",))
+READER_RATE_LIMITED = Counter("reader_rate_limited_total", "Сканирования, отклонённые ограничением частоты",
+                              ("reader",))
+CHANGE_FEED_LAG_SECONDS = Histogram("card_change_apply_lag_seconds",
+                                    "Задержка применения изменений карт, сделанных другими процессами")
+CHANGE_FEED_APPLIED = Counter("card_changes_applied_total", "Применённые изменения карт других процессов", ("op",))
+
+
+async def monitor_loop_lag(interval=0.5):
+    """Фоновая задача: измеряет, насколько позже запланированного просыпается цикл событий"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        LOOP_LAG_SECONDS.observe(max(0.0, time.perf_counter() - started - interval))
+
+
+def render_metrics():
+    """Текст /metrics для реестра по умолчанию"""
+    return REGISTRY.render()
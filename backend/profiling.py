@@ -0,0 +1,253 @@
+import contextvars
+import cProfile
+import logging
+import marshal
+import os
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+log = logging.getLogger("ws")
+PROFILE_DIR = "profiles"
+SAMPLE_INTERVAL = 0.005
+
+current_span = contextvars.ContextVar("trace_span", default=None)
+
+
+class TraceSpan:
+    """Одна трассируемая операция: время начала и длительности этапов"""
+
+    __slots__ = ("kind", "name", "started", "last", "phases")
+
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self.started = self.last = time.perf_counter()
+        self.phases = {}
+
+    def mark(self, phase):
+        """Закрывает этап phase: время от предыдущей отметки"""
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def add(self, phase, seconds):
+        """Добавляет время вложенной операции (например, ожидания БД) без сдвига отметки"""
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+
+class SlowTracer:
+    """Трассировка медленных операций: всё, что дольше порога, пишется в лог с разбивкой по этапам"""
+
+    def __init__(self, history=100):
+        self.threshold = None
+        self.traced = 0
+        self.slow = 0
+        self.recent = deque(maxlen=history)
+
+    def enable(self, threshold_ms):
+        self.threshold = threshold_ms / 1000
+        log.info("Трассировка медленных операций включена: порог %s мс", threshold_ms)
+
+    def disable(self):
+        self.threshold = None
+        log.info("Трассировка медленных операций выключена")
+
+    def begin(self, kind, name=None):
+        """Начинает операцию; при выключенной трассировке возвращает (None, None) без выделения памяти"""
+        if self.threshold is None:
+            return None, None
+        span = TraceSpan(kind, name)
+        return span, current_span.set(span)
+
+    def finish(self, span, token, last_phase="other"):
+        """Завершает операцию, начатую begin"""
+        current_span.reset(token)
+        span.mark(last_phase)
+        self.report(span.kind, span.name, span.last - span.started, span.phases)
+
+    def report(self, kind, name, elapsed, phases=None):
+        """Записывает операцию, если она дольше порога"""
+        threshold = self.threshold
+        if threshold is None:
+            return
+        self.traced += 1
+        if elapsed < threshold:
+            return
+        self.slow += 1
+        entry = {
+            "time": time.time(),
+            "kind": kind,
+            "name": name,
+            "elapsed_ms": round(elapsed * 1000, 3),
+            "phases_ms": {phase: round(seconds * 1000, 3) for phase, seconds in (phases or {}).items()},
+            "thread": threading.current_thread().name
+        }
+        self.recent.append(entry)
+        breakdown = ", ".join(f"{phase} {ms:.1f} мс" for phase, ms in entry["phases_ms"].items())
+        log.warning("Медленная операция [%s] %s: %.1f мс (%s) в потоке %s",
+                    kind, name, elapsed * 1000, breakdown or "без разбивки", entry["thread"])
+
+    def stats(self):
+        return {
+            "threshold_ms": None if self.threshold is None else self.threshold * 1000,
+            "traced": self.traced,
+            "slow": self.slow
+        }
+
+
+class SamplingProfiler:
+    """Профилировщик по выборкам стеков всех потоков (sys._current_frames) с выводом в формате pstats"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = 0
+        self.leaf = {}
+        self.inclusive = {}
+        self.edges = {}
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def start(self):
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident != own:
+                    self._sample(frame)
+
+    @staticmethod
+    def _key(code):
+        return code.co_filename, code.co_firstlineno, code.co_name
+
+    def _sample(self, frame):
+        self.samples += 1
+        callee = self._key(frame.f_code)
+        self.leaf[callee] = self.leaf.get(callee, 0) + 1
+        seen = set()
+        while frame is not None:
+            key = self._key(frame.f_code)
+            if key not in seen:
+                seen.add(key)
+                self.inclusive[key] = self.inclusive.get(key, 0) + 1
+            caller = frame.f_back
+            if caller is not None:
+                edge = (key, self._key(caller.f_code))
+                self.edges[edge] = self.edges.get(edge, 0) + 1
+            frame = caller
+
+    def dump_stats(self, path):
+        """Сохраняет выборки как файл pstats: число выборок * интервал = время (по настенным часам)"""
+        stats = {}
+        for key, count in self.inclusive.items():
+            leaf_time = self.leaf.get(key, 0) * self.interval
+            stats[key] = [count, count, leaf_time, count * self.interval, {}]
+        for (callee, caller), count in self.edges.items():
+            seconds = count * self.interval
+            stats[callee][4][caller] = (count, count, seconds, seconds)
+        with open(path, "wb") as f:
+            marshal.dump({key: tuple(value) for key, value in stats.items()}, f)
+
+
+class Profiler:
+    """Профилирование по команде из консоли: cProfile в потоке цикла событий или выборки по всем потокам"""
+
+    MODES = ("cprofile", "sample")
+
+    def __init__(self, output_dir="profiles", sample_interval=0.005):
+        self.output_dir = output_dir
+        self.sample_interval = sample_interval
+        self.loop = None
+        self.mode = None
+        self.profile = None
+        self.started = None
+        self.timer = None
+        self._lock = threading.Lock()
+
+    def bind(self, loop):
+        """Цикл событий, в потоке которого работает cProfile"""
+        self.loop = loop
+
+    @property
+    def running(self):
+        return self.mode is not None
+
+    def start(self, mode="cprofile", seconds=None):
+        """Запускает профилирование; через seconds секунд оно остановится и сохранится само"""
+        if mode not in self.MODES:
+            raise ValueError(f"Неизвестный режим профилирования: {mode}")
+        with self._lock:
+            if self.mode is not None:
+                raise RuntimeError(f"Профилирование уже запущено ({self.mode})")
+            if mode == "cprofile":
+                if self.loop is None or self.loop.is_closed():
+                    raise RuntimeError("Цикл событий не запущен")
+                self.profile = cProfile.Profile()
+                self._run_in_loop(self.profile.enable)
+            else:
+                self.profile = SamplingProfiler(self.sample_interval)
+                self.profile.start()
+            self.mode = mode
+            self.started = time.monotonic()
+            if seconds:
+                self.timer = threading.Timer(seconds, self._auto_stop)
+                self.timer.daemon = True
+                self.timer.start()
+        log.info("Профилирование запущено (%s%s)", mode, f", {seconds} с" if seconds else "")
+
+    def stop(self):
+        """Останавливает профилирование и сохраняет файл pstats; возвращает путь к нему"""
+        with self._lock:
+            if self.mode is None:
+                raise RuntimeError("Профилирование не запущено")
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            profile, mode = self.profile, self.mode
+            if mode == "cprofile":
+                self._run_in_loop(profile.disable)
+            else:
+                profile.stop()
+            duration = time.monotonic() - self.started
+            self.profile = self.mode = None
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{mode}.pstats")
+        profile.dump_stats(path)
+        log.info("Профилирование остановлено через %.1f с, результат: %s", duration, path)
+        return path
+
+    def _auto_stop(self):
+        try:
+            self.stop()
+        except RuntimeError:
+            pass
+
+    def _run_in_loop(self, func):
+        """Выполняет func в потоке цикла событий и ждёт завершения (cProfile привязан к потоку)"""
+        done = threading.Event()
+
+        def call():
+            try:
+                func()
+            finally:
+                done.set()
+
+        self.loop.call_soon_threadsafe(call)
+        if not done.wait(5.0):
+            raise RuntimeError("Цикл событий не ответил")
+
+
+profiler = Profiler(PROFILE_DIR, SAMPLE_INTERVAL)
+slow_trace = SlowTracer()
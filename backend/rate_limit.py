@@ -0,0 +1,91 @@
+import time
+from backend.settings import READER_RATE_LIMIT, READER_RATE_BURST, READER_RATE_OVERFLOW, READER_MAX_IDS_PER_PORT
+from backend.metrics import READER_RATE_LIMITED
+
+OVERFLOW_ACTIONS = ("deny", "drop")
+OTHER_READERS = "other"
+
+
+class TokenBucket:
+    """Корзина токенов: rate токенов в секунду, не больше burst в запасе"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        """Забирает токен; False, если корзина пуста"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class ReaderRateLimiter:
+    """Ограничение частоты сканирований для каждого считывателя отдельно.
+
+    readerId приходит от устройства, поэтому на каждом порту учитываются не больше max_readers_per_port
+    разных readerId; остальные делят одну корзину порта с меткой "other" - смена readerId не обходит
+    лимит, а число корзин и меток метрик ограничено. rate = 0 отключает ограничение. overflow определяет
+    ответ на лишнее сканирование: "deny" - отказ в доступе без обращения к БД, "drop" - кадр игнорируется.
+    Вызывается только из потока цикла событий, поэтому блокировки не нужны."""
+
+    def __init__(self, rate=50.0, burst=100, overflow="deny", max_readers_per_port=16):
+        if overflow not in OVERFLOW_ACTIONS:
+            raise ValueError(f"Неизвестное действие при превышении частоты: {overflow}")
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.overflow = overflow
+        self.max_readers_per_port = max_readers_per_port
+        self.known = {}
+        self.buckets = {}
+        self.limited = {}
+        self.unknown_ids = 0
+
+    def reader_key(self, port, reader_id):
+        """Метка считывателя для лимита и метрик: readerId из известных на порту, "other" или сам порт"""
+        if reader_id is None:
+            return port
+        known = self.known.setdefault(port, set())
+        if reader_id in known:
+            return reader_id
+        if len(known) < self.max_readers_per_port:
+            known.add(reader_id)
+            return reader_id
+        self.unknown_ids += 1
+        return OTHER_READERS
+
+    def allow(self, port, reader_key):
+        """True, если сканирование считывателя (reader_key из reader_key()) на порту укладывается в лимит"""
+        if not self.rate:
+            return True
+        now = time.monotonic()
+        bucket = self.buckets.get((port, reader_key))
+        if bucket is None:
+            bucket = self.buckets[(port, reader_key)] = TokenBucket(self.rate, self.burst, now)
+        if bucket.take(now):
+            return True
+        self.limited[reader_key] = self.limited.get(reader_key, 0) + 1
+        READER_RATE_LIMITED.labels(reader_key).inc()
+        return False
+
+    def stats(self):
+        """Возвращает настройки и число отклонённых сканирований по считывателям"""
+        return {
+            "rate": self.rate,
+            "burst": self.burst,
+            "overflow": self.overflow,
+            "max_readers_per_port": self.max_readers_per_port,
+            "readers": len(self.buckets),
+            "unknown_ids": self.unknown_ids,
+            "limited": dict(self.limited)
+        }
+
+
+reader_limiter = ReaderRateLimiter(READER_RATE_LIMIT, READER_RATE_BURST, READER_RATE_OVERFLOW, READER_MAX_IDS_PER_PORT)
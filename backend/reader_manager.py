@@ -0,0 +1,155 @@
+import asyncio
+import fnmatch
+import logging
+from serial.tools import list_ports
+from backend.access import access_engine
+from backend.serial_handler import SerialHandler
+from backend.settings import (
+    SERIAL_PORTS, SERIAL_BAUDRATE, SERIAL_AUTODISCOVER, SERIAL_DISCOVERY_PATTERNS,
+    SERIAL_DISCOVERY_INTERVAL, SERIAL_RECONNECT_MIN, SERIAL_RECONNECT_MAX, READER_MAX_IDS_PER_PORT
+)
+
+log = logging.getLogger("serial")
+
+
+class ReaderManager:
+    """Управление несколькими считывателями ESP32 на общем цикле событий"""
+
+    def __init__(self, ports=None, baudrate=115200, autodiscover=False, discovery_patterns=(),
+                 discovery_interval=5.0, reconnect_min=0.5, reconnect_max=30.0, engine=access_engine,
+                 max_routes_per_port=16):
+        self.ports = list(ports or [])
+        self.baudrate = baudrate
+        self.autodiscover = autodiscover
+        self.discovery_patterns = tuple(discovery_patterns)
+        self.discovery_interval = discovery_interval
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
+        self.engine = engine
+        self.max_routes_per_port = max_routes_per_port
+        self.handlers = {}
+        self.routes = {}
+        self._port_routes = {}
+        self.running = False
+        self._tasks = {}
+
+    def discover_ports(self):
+        """Находит подключённые считыватели через список портов pyserial"""
+        found = []
+        for port_info in list_ports.comports():
+            if any(fnmatch.fnmatch(port_info.device, pattern) for pattern in self.discovery_patterns):
+                found.append(port_info.device)
+        return found
+
+    def add_port(self, port):
+        """Добавляет порт и запускает для него задачу чтения"""
+        if port in self.handlers:
+            return self.handlers[port]
+        handler = SerialHandler(port=port, baudrate=self.baudrate, engine=self.engine, manager=self)
+        self.handlers[port] = handler
+        if self.running:
+            self._tasks[port] = asyncio.create_task(self._run_port(handler))
+        log.info("Считыватель добавлен: %s", port)
+        return handler
+
+    async def remove_port(self, port):
+        """Останавливает чтение порта и удаляет его"""
+        handler = self.handlers.pop(port, None)
+        task = self._tasks.pop(port, None)
+        if handler:
+            handler.disconnect()
+        if task:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        self.routes = {key: value for key, value in self.routes.items() if value is not handler}
+        self._port_routes.pop(port, None)
+        log.info("Считыватель удалён: %s", port)
+
+    def register_route(self, handler, reader_id=None, device_id=None):
+        """Запоминает, через какой порт доступен считыватель с данным readerId/deviceId.
+
+        Идентификаторы приходят от устройства, поэтому на порт запоминается не больше max_routes_per_port"""
+        for key in (reader_id, device_id):
+            if not isinstance(key, (str, int)) or self.routes.get(key) is handler:
+                continue
+            keys = self._port_routes.setdefault(handler.port, set())
+            if len(keys) >= self.max_routes_per_port:
+                continue
+            previous = self.routes.get(key)
+            if previous is not None:
+                self._port_routes.get(previous.port, set()).discard(key)
+            keys.add(key)
+            self.routes[key] = handler
+            log.debug("Считыватель %s доступен через %s", key, handler.port)
+
+    async def send_to_reader(self, reader_id, data):
+        """Отправляет сообщение считывателю по readerId/deviceId"""
+        handler = self.routes.get(reader_id)
+        if handler is None:
+            log.warning("Нет маршрута до считывателя %s", reader_id)
+            return False
+        await handler.send_response(data)
+        return True
+
+    async def _run_port(self, handler):
+        """Чтение порта с переподключением и экспоненциальной задержкой"""
+        backoff = self.reconnect_min
+        while self.running and handler.port in self.handlers:
+            if handler.connect():
+                backoff = self.reconnect_min
+                await handler.start_reading()
+                handler.close()
+            if not self.running or handler.port not in self.handlers:
+                break
+            handler.stats["reconnects"] += 1
+            log.warning("Переподключение к %s через %.1f с", handler.port, backoff)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, self.reconnect_max)
+
+    async def _discovery_loop(self):
+        """Периодически добавляет новые и убирает исчезнувшие автообнаруженные порты"""
+        while self.running:
+            try:
+                discovered = set(await asyncio.get_running_loop().run_in_executor(None, self.discover_ports))
+                for port in discovered - set(self.handlers):
+                    self.add_port(port)
+                for port in set(self.handlers) - discovered - set(self.ports):
+                    if not self.handlers[port].is_connected:
+                        await self.remove_port(port)
+            except Exception as e:
+                log.error("Ошибка поиска COM-портов: %s", e)
+            await asyncio.sleep(self.discovery_interval)
+
+    async def run(self):
+        """Запускает чтение всех настроенных (и найденных) портов"""
+        self.running = True
+        for port in self.ports:
+            self.add_port(port)
+        for port, handler in self.handlers.items():
+            if port not in self._tasks:
+                self._tasks[port] = asyncio.create_task(self._run_port(handler))
+        if self.autodiscover:
+            self._tasks[None] = asyncio.create_task(self._discovery_loop())
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+    def stop(self):
+        """Останавливает чтение всех портов"""
+        self.running = False
+        for handler in self.handlers.values():
+            handler.disconnect()
+
+    def stats(self):
+        """Возвращает статистику по каждому порту"""
+        return {port: dict(handler.stats) for port, handler in self.handlers.items()}
+
+
+reader_manager = ReaderManager(
+    ports=SERIAL_PORTS,
+    baudrate=SERIAL_BAUDRATE,
+    autodiscover=SERIAL_AUTODISCOVER,
+    discovery_patterns=SERIAL_DISCOVERY_PATTERNS,
+    discovery_interval=SERIAL_DISCOVERY_INTERVAL,
+    reconnect_min=SERIAL_RECONNECT_MIN,
+    reconnect_max=SERIAL_RECONNECT_MAX,
+    max_routes_per_port=READER_MAX_IDS_PER_PORT
+)
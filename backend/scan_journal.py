@@ -0,0 +1,212 @@
+import logging
+import queue
+import threading
+import time
+from backend.setup_db import parse_cursor, uid_to_key
+from backend.settings import (
+    CARD_DB, JOURNAL_BATCH_SIZE, JOURNAL_FLUSH_INTERVAL, JOURNAL_QUEUE_SIZE,
+    JOURNAL_RETENTION_DAYS, JOURNAL_PRUNE_INTERVAL, JOURNAL_PRUNE_BATCH
+)
+
+log = logging.getLogger("db")
+_STOP = object()
+
+
+class ScanJournal:
+    """Журнал сканирований: события копятся в очереди и пишутся пакетами в фоновом потоке"""
+
+    def __init__(self, card_db, batch_size=500, flush_interval=0.05, max_queue=100000,
+                 retention_days=90, prune_interval=3600, prune_batch=10000):
+        self.card_db = card_db
+        self.db = card_db.db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retention_days = retention_days
+        self.prune_interval = prune_interval
+        self.prune_batch = prune_batch
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = None
+        self.last_prune = 0.0
+        self.recorded = 0
+        self.dropped = 0
+        self.written = 0
+        self.batches = 0
+        self.max_batch = 0
+        self.failed = 0
+        self.pruned = 0
+
+    def record(self, uid, card_type, granted, reader_id=None, device_id=None, port=None, latency=None):
+        """Добавляет событие сканирования в очередь; никогда не ждёт записи в БД"""
+        try:
+            self.queue.put_nowait((int(time.time() * 1000), uid, reader_id, device_id, port, card_type,
+                                   granted, latency))
+            self.recorded += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        """Запускает поток записи журнала"""
+        if self.thread and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self._run, name="scan-journal", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=5.0):
+        """Дописывает накопленные события и останавливает поток записи"""
+        if self.thread and self.thread.is_alive():
+            self.queue.put(_STOP)
+            self.thread.join(timeout)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            try:
+                item = self.queue.get(timeout=self.prune_interval)
+            except queue.Empty:
+                self._maybe_prune()
+                continue
+            if item is _STOP:
+                break
+
+            # Групповая фиксация: ждём до flush_interval, пока не наберётся batch_size событий
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._write(batch)
+            self._maybe_prune()
+
+    def _write(self, batch):
+        normalize = self.card_db._normalize_uid_for_search
+        rows = []
+        for ts_ms, uid, reader_id, device_id, port, card_type, granted, latency in batch:
+            uid_str = normalize(uid)
+            rows.append((
+                ts_ms, uid_str, uid_to_key(uid_str),
+                None if reader_id is None else str(reader_id),
+                None if device_id is None else str(device_id),
+                port, card_type, 1 if granted else 0,
+                None if latency is None else int(latency * 1_000_000)
+            ))
+        try:
+            with self.db.transaction() as conn:
+                conn.executemany('''
+                    INSERT INTO scan_events (ts_ms, uid, uid_key, reader_id, device_id, port, card_type, granted, latency_us)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', rows)
+        except Exception as e:
+            self.failed += len(rows)
+            log.error("Ошибка записи журнала сканирований (%s событий): %s", len(rows), e)
+            return
+        self.written += len(rows)
+        self.batches += 1
+        self.max_batch = max(self.max_batch, len(rows))
+
+    def _maybe_prune(self):
+        if not self.retention_days or time.monotonic() - self.last_prune < self.prune_interval:
+            return
+        self.last_prune = time.monotonic()
+        try:
+            self.prune()
+        except Exception as e:
+            log.error("Ошибка очистки журнала сканирований: %s", e)
+
+    def prune(self, older_than=None):
+        """Удаляет события старше срока хранения порциями по prune_batch; возвращает число удалённых"""
+        if older_than is None:
+            older_than = time.time() - self.retention_days * 86400
+        cutoff_ms = int(older_than * 1000)
+        total = 0
+        while True:
+            with self.db.transaction() as conn:
+                deleted = conn.execute('''
+                    DELETE FROM scan_events WHERE id IN (
+                        SELECT id FROM scan_events WHERE ts_ms < ? ORDER BY ts_ms LIMIT ?
+                    )
+                ''', (cutoff_ms, self.prune_batch)).rowcount
+            total += deleted
+            if deleted < self.prune_batch:
+                break
+        if total:
+            self.pruned += total
+            log.info("Журнал сканирований: удалено устаревших событий: %s", total)
+        return total
+
+    def history(self, uid=None, reader_id=None, since=None, until=None, limit=100, cursor=None):
+        """Возвращает (события, курсор следующей страницы) от новых к старым; время - Unix-секунды"""
+        where, params = [], []
+        if uid:
+            uid_str = self.card_db._normalize_uid_for_search(uid)
+            where.append("uid_key = ? AND uid = ?")
+            params += [uid_to_key(uid_str), uid_str]
+        if reader_id is not None:
+            where.append("reader_id = ?")
+            params.append(str(reader_id))
+        if since is not None:
+            where.append("ts_ms >= ?")
+            params.append(int(float(since) * 1000))
+        if until is not None:
+            where.append("ts_ms < ?")
+            params.append(int(float(until) * 1000))
+        if cursor not in (None, ""):
+            cursor_ts, cursor_id = parse_cursor(cursor)
+            where.append("(ts_ms < ? OR (ts_ms = ? AND id < ?))")
+            params += [cursor_ts, cursor_ts, cursor_id]
+
+        rows = self.db.connection().execute(f'''
+            SELECT id, ts_ms, uid, reader_id, device_id, port, card_type, granted, latency_us
+            FROM scan_events
+            {"WHERE " + " AND ".join(where) if where else ""}
+            ORDER BY ts_ms DESC, id DESC
+            LIMIT ?
+        ''', (*params, limit)).fetchall()
+
+        events = [
+            {
+                "id": event_id,
+                "timestamp": ts_ms / 1000,
+                "uid": uid_str,
+                "reader_id": reader,
+                "device_id": device,
+                "port": port,
+                "card_type": card_type,
+                "granted": bool(granted),
+                "latency_ms": None if latency_us is None else latency_us / 1000
+            }
+            for event_id, ts_ms, uid_str, reader, device, port, card_type, granted, latency_us in rows
+        ]
+        next_cursor = f"{rows[-1][1]}:{rows[-1][0]}" if len(rows) == limit else None
+        return events, next_cursor
+
+    def stats(self):
+        """Возвращает счётчики журнала"""
+        return {
+            "recorded": self.recorded,
+            "queued": self.queue.qsize(),
+            "dropped": self.dropped,
+            "written": self.written,
+            "batches": self.batches,
+            "max_batch": self.max_batch,
+            "failed": self.failed,
+            "pruned": self.pruned
+        }
+
+
+scan_journal = ScanJournal(
+    CARD_DB,
+    batch_size=JOURNAL_BATCH_SIZE,
+    flush_interval=JOURNAL_FLUSH_INTERVAL,
+    max_queue=JOURNAL_QUEUE_SIZE,
+    retention_days=JOURNAL_RETENTION_DAYS,
+    prune_interval=JOURNAL_PRUNE_INTERVAL,
+    prune_batch=JOURNAL_PRUNE_BATCH
+)
@@ -2,111 +2,234 @@ import serial
 import json
 import logging
 import asyncio
-import threading
+import time
 from datetime import datetime
-from backend.settings import CARD_DB
+from backend.access import access_engine
+from backend.async_db import DatabaseBusyError
+from backend.rate_limit import reader_limiter
+from backend.event_bus import event_bus
+from backend.latency import scan_latency
+from backend.scan_journal import scan_journal
+from backend.profiling import slow_trace
+from backend.metrics import SCANS, SERIAL_BYTES, SERIAL_FRAMES, SERIAL_PARSE_ERRORS, SERIAL_OVERFLOWS
+
+log = logging.getLogger("serial")
+MAX_FRAME_SIZE = 4096
+WORK_QUEUE_SIZE = 64
+READ_CHUNK_SIZE = 4096
+POLL_TIMEOUT = 0.05
 
 class SerialHandler:
-    def __init__(self, port='/dev/ttyACM0', baudrate=115200):
+    def __init__(self, port='/dev/ttyACM0', baudrate=115200, engine=access_engine, manager=None,
+                 max_frame_size=MAX_FRAME_SIZE, queue_size=WORK_QUEUE_SIZE, limiter=reader_limiter):
         self.port = port
         self.baudrate = baudrate
+        self.engine = engine
+        self.limiter = limiter
+        self.manager = manager
+        self.max_frame_size = max_frame_size
+        self.queue_size = queue_size
         self.serial_conn = None
         self.running = False
-        self.data_buffer = ""
+        self.data_buffer = bytearray()
+        self.discarding = False
+        self.work_queue = None
         self.loop = None
+        self.reading_done = None
+        self.background_tasks = set()
+        self.stats = {
+            "connected": False,
+            "connects": 0,
+            "reconnects": 0,
+            "frames_in": 0,
+            "frames_out": 0,
+            "bytes_in": 0,
+            "bytes_out": 0,
+            "errors": 0,
+            "parse_errors": 0,
+            "overflows": 0,
+            "dropped": 0,
+            "last_seen": None
+        }
+        self.bytes_in_metric = SERIAL_BYTES.labels(port, "in")
+        self.bytes_out_metric = SERIAL_BYTES.labels(port, "out")
+        self.frames_in_metric = SERIAL_FRAMES.labels(port, "in")
+        self.frames_out_metric = SERIAL_FRAMES.labels(port, "out")
+        self.parse_errors_metric = SERIAL_PARSE_ERRORS.labels(port)
+        self.overflows_metric = SERIAL_OVERFLOWS.labels(port)
         
     def connect(self):
-        """Подключение к COM-порту"""
+        """Подключение к COM-порту (путь устройства или URL pyserial, например loop://)"""
         try:
-            self.serial_conn = serial.Serial(
-                port=self.port,
+            self.serial_conn = serial.serial_for_url(
+                self.port,
                 baudrate=self.baudrate,
-                timeout=1
+                timeout=0
             )
-            logging.info(f"Подключено к {self.port} с Baudrate {self.baudrate}")
+            self.data_buffer.clear()
+            self.discarding = False
+            self.stats["connected"] = True
+            self.stats["connects"] += 1
+            log.info("Подключено к %s с Baudrate %s", self.port, self.baudrate)
             return True
         except Exception as e:
-            logging.error(f"Ошибка подключения к {self.port}: {e}")
+            self.stats["errors"] += 1
+            log.error("Ошибка подключения к %s: %s", self.port, e)
             return False
     
     def disconnect(self):
         """Отключение от COM-порта"""
         self.running = False
+        self.close()
+    
+    def close(self):
+        """Закрывает COM-порт без остановки обработчика (для переподключения)"""
+        self.stats["connected"] = False
         if self.serial_conn and self.serial_conn.is_open:
             self.serial_conn.close()
-            logging.info("COM-порт закрыт")
+            log.info("COM-порт %s закрыт", self.port)
+        if self.loop and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._finish_reading)
+    
+    def _finish_reading(self):
+        """Завершает ожидание в start_reading"""
+        if self.reading_done and not self.reading_done.done():
+            self.reading_done.set_result(None)
+    
+    @property
+    def is_connected(self):
+        return self.serial_conn is not None and self.serial_conn.is_open
     
-    async def process_message(self, message):
-        """Обработка входящих сообщений от ESP32"""
+    async def process_message(self, message, data=None, received_at=None):
+        """Обработка входящих сообщений от ESP32 (data - уже разобранный JSON кадра)"""
+        started = time.perf_counter()
+        if received_at is None:
+            received_at = started
         try:
-            await self.send_to_monitor(message, "incoming")
-            
-            data = json.loads(message)
-            logging.info(f"Получено сообщение от ESP32: {data}")
+            if data is None:
+                data = json.loads(message)
+            log.debug("Получено сообщение от ESP32: %s", data)
             
             message_type = data.get("type")
             device_id = data.get("deviceId")
             card_uid = data.get("cardUID")
             reader_id = data.get("readerId")
             
-            if message_type == "cardData":
-                if card_uid:
-                    card_exists = False
-                    card_type = "UNKNOWN"
-                    
-                    for check_type in ["KEY", "WORKER", "SECURITY"]:
-                        if CARD_DB.check_card(check_type, card_uid):
-                            card_exists = True
-                            card_type = check_type
-                            break
-                    
-                    access_granted = card_exists
-                    
-                    await self.send_card_scanned_event(card_uid, card_type, access_granted)
-                    
-                    response = {
-                        "type": "cardResponse",
-                        "cardType": card_type,
-                        "accessGranted": access_granted,
-                        "timestamp": int(datetime.now().timestamp())
-                    }
-                    
-                    await self.send_response(response)
-                    logging.info(f"Ответ отправлен: {response}")
-                    
+            if self.manager and (reader_id or device_id):
+                self.manager.register_route(self, reader_id, device_id)
+            
+            if message_type == "cardData" and card_uid:
+                reader_key = self.limiter.reader_key(self.port, reader_id or device_id)
+                if not self.limiter.allow(self.port, reader_key):
+                    self.reject_rate_limited(message, reader_id, reader_key)
+                    return
+                try:
+                    card_type, access_granted, card_data = await self.engine.decide(card_uid, reader_id)
+                except DatabaseBusyError as e:
+                    self.reject_db_busy(message, reader_id, reader_key, e)
+                    return
+                decided = time.perf_counter()
+                
+                response = {
+                    "type": "cardResponse",
+                    "cardType": card_type,
+                    "accessGranted": access_granted,
+                    "timestamp": int(datetime.now().timestamp())
+                }
+                if reader_id is not None:
+                    response["readerId"] = reader_id
+                
+                payload = self.write_frame(response)
+                latency = time.perf_counter() - received_at
+                if slow_trace.threshold is not None:
+                    slow_trace.report("serial", f"cardData {card_uid} ({self.port})", latency, {
+                        "queue": started - received_at,
+                        "decide": decided - started,
+                        "write": received_at + latency - decided
+                    })
+                scan_latency.observe(reader_key, latency)
+                SCANS.labels(reader_key, "granted" if access_granted else "denied").inc()
+                scan_journal.record(card_uid, card_type, access_granted, reader_id, device_id, self.port, latency)
+                
+                self.send_to_monitor(message, "incoming")
+                if payload:
+                    self.send_to_monitor(payload, "outgoing")
+                self.defer(self.send_card_scanned_event(card_uid, card_type, access_granted, card_data))
+                log.debug("Ответ отправлен: %s", response)
+                
             elif message_type == "ping":
                 response = {
                     "type": "pong",
                     "deviceId": device_id,
                     "timestamp": int(datetime.now().timestamp())
                 }
-                await self.send_response(response)
-                logging.info(f"Pong отправлен: {response}")
+                payload = self.write_frame(response)
+                self.send_to_monitor(message, "incoming")
+                if payload:
+                    self.send_to_monitor(payload, "outgoing")
+                log.debug("Pong отправлен: %s", response)
+            
+            else:
+                self.send_to_monitor(message, "incoming")
                 
         except json.JSONDecodeError as e:
-            logging.error(f"Ошибка разбора JSON: {e}, данные: {message}")
-            await self.send_to_monitor(f"INVALID JSON: {message}", "error")
+            self.parse_errors_metric.inc()
+            log.error("Ошибка разбора JSON: %s, данные: %s", e, message)
+            self.send_to_monitor(f"INVALID JSON: {message}", "error")
         except Exception as e:
-            logging.error(f"Ошибка обработки сообщения: {e}")
-            await self.send_to_monitor(f"ERROR: {str(e)}", "error")
+            log.error("Ошибка обработки сообщения: %s", e)
+            self.send_to_monitor(f"ERROR: {str(e)}", "error")
     
-    async def send_card_scanned_event(self, card_uid, card_type, access_granted):
+    def reject_rate_limited(self, message, reader_id, reader_key):
+        """Ответ на сканирование сверх лимита частоты считывателя: отказ без БД или молчание"""
+        self.send_to_monitor(message, "incoming")
+        if self.limiter.overflow == "drop":
+            self.send_to_monitor(f"RATE LIMITED {reader_key}: кадр отброшен", "error")
+            return
+        self.send_denial(reader_id, rateLimited=True)
+    
+    def reject_db_busy(self, message, reader_id, reader_key, error):
+        """БД перегружена или не ответила вовремя: считыватель получает явный отказ, а не тишину"""
+        log.warning("Отказ в доступе без решения (%s): %s", reader_key, error)
+        self.send_to_monitor(message, "incoming")
+        self.send_to_monitor(f"DB BUSY {reader_key}: {error}", "error")
+        self.send_denial(reader_id, dbBusy=True)
+    
+    def send_denial(self, reader_id, **flags):
+        """Отправляет считывателю cardResponse с отказом в доступе и причиной в flags"""
+        response = {
+            "type": "cardResponse",
+            "cardType": "UNKNOWN",
+            "accessGranted": False,
+            **flags,
+            "timestamp": int(datetime.now().timestamp())
+        }
+        if reader_id is not None:
+            response["readerId"] = reader_id
+        payload = self.write_frame(response)
+        if payload:
+            self.send_to_monitor(payload, "outgoing")
+    
+    def defer(self, coro):
+        """Выполняет некритичную работу (события UI, изображения) в фоне после ответа считывателю"""
+        task = asyncio.ensure_future(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
+    
+    async def send_card_scanned_event(self, card_uid, card_type, access_granted, card_data=None):
         """Отправка события сканирования карты"""
         try:
-            from backend.views import SERIAL_MONITOR_CLIENTS
-            from backend.settings import HTTP_PORT
+            from backend.settings import HTTP_BASE_URL
             
-            card_data = None
-            for check_type in ["KEY", "WORKER", "SECURITY"]:
-                card_data = CARD_DB.get_card_with_image(check_type, card_uid)
-                if card_data:
-                    break
+            if card_data is None and access_granted:
+                card_data = await self.engine.async_db.find_card_by_uid(card_uid)
             
             image_url = None
             has_image = False
             if card_data and card_data.get("has_image") and card_data.get("image_filename"):
                 has_image = True
-                image_url = f"http://localhost:{HTTP_PORT}/media/{card_data['image_filename']}"
+                image_url = f"{HTTP_BASE_URL}/media/{card_data['image_filename']}"
             
             event_data = {
                 "type": "card_scanned",
@@ -118,100 +241,180 @@ class SerialHandler:
                 "timestamp": datetime.now().isoformat()
             }
             
-            disconnected_clients = set()
-            for client in SERIAL_MONITOR_CLIENTS:
-                try:
-                    await client.send(json.dumps(event_data))
-                except:
-                    disconnected_clients.add(client)
-            
-            for client in disconnected_clients:
-                SERIAL_MONITOR_CLIENTS.remove(client)
+            event_bus.publish("card_scanned", event_data)
                 
         except Exception as e:
-            logging.error(f"Ошибка отправки события карты: {e}")
+            log.error("Ошибка отправки события карты: %s", e)
     
-    async def send_response(self, data):
-        """Отправка ответа в COM-порт"""
+    def write_frame(self, data):
+        """Синхронная запись кадра в COM-порт; возвращает отправленный JSON или None"""
         try:
             if self.serial_conn and self.serial_conn.is_open:
-                message = json.dumps(data) + '\n'
-                self.serial_conn.write(message.encode('utf-8'))
-                self.serial_conn.flush()
-                logging.info(f"Отправлено в COM-порт: {data}")
-                
-                await self.send_to_monitor(json.dumps(data), "outgoing")
+                payload = json.dumps(data)
+                message = (payload + '\n').encode('utf-8')
+                self.serial_conn.write(message)
+                self.stats["frames_out"] += 1
+                self.stats["bytes_out"] += len(message)
+                self.frames_out_metric.inc()
+                self.bytes_out_metric.inc(len(message))
+                log.debug("Отправлено в COM-порт: %s", data)
+                return payload
         except Exception as e:
-            logging.error(f"Ошибка отправки в COM-порт: {e}")
+            self.stats["errors"] += 1
+            log.error("Ошибка отправки в COM-порт: %s", e)
+        return None
     
-    def read_serial_data(self):
-        """Чтение данных из COM-порта"""
+    async def send_response(self, data):
+        """Отправка ответа в COM-порт"""
+        payload = self.write_frame(data)
+        if payload:
+            self.send_to_monitor(payload, "outgoing")
+    
+    def _fileno(self):
+        """Файловый дескриптор порта или None для транспортов без него (loop:// и т.п.)"""
         try:
-            if self.serial_conn and self.serial_conn.is_open:
-                data = self.serial_conn.readline().decode('utf-8').strip()
-                if data:
-                    return data
-        except Exception as e:
-            logging.error(f"Ошибка чтения из COM-порта: {e}")
-        return None
+            return self.serial_conn.fileno()
+        except Exception:
+            return None
+    
+    def _on_readable(self):
+        """Чтение всех доступных байт, когда порт готов к чтению"""
+        try:
+            data = self.serial_conn.read(self.serial_conn.in_waiting or 1)
+        except (serial.SerialException, OSError) as e:
+            self.stats["errors"] += 1
+            log.error("Ошибка чтения из COM-порта %s: %s", self.port, e)
+            self.close()
+            return
+        if data:
+            self.feed(data)
+    
+    def feed(self, data):
+        """Добавляет байты в буфер и выделяет из него кадры по символу новой строки"""
+        received_at = time.perf_counter()
+        self.stats["bytes_in"] += len(data)
+        self.bytes_in_metric.inc(len(data))
+        self.stats["last_seen"] = time.time()
+        buffer = self.data_buffer
+        scan_from = len(buffer)
+        buffer += data
+        
+        while True:
+            end = buffer.find(b'\n', scan_from)
+            if end < 0:
+                if len(buffer) > self.max_frame_size:
+                    self.stats["overflows"] += 1
+                    self.overflows_metric.inc()
+                    if not self.discarding:
+                        log.warning("Кадр из %s длиннее %s байт, отбрасывается", self.port, self.max_frame_size)
+                        self._report_overflow(bytes(buffer[:64]))
+                    self.discarding = True
+                    buffer.clear()
+                return
+            
+            frame = bytes(buffer[:end]).strip()
+            del buffer[:end + 1]
+            scan_from = 0
+            
+            if self.discarding:
+                self.discarding = False
+                continue
+            if len(frame) > self.max_frame_size:
+                self.stats["overflows"] += 1
+                self.overflows_metric.inc()
+                self._report_overflow(frame[:64])
+                continue
+            if frame:
+                self._dispatch_frame(frame, received_at)
+    
+    def _dispatch_frame(self, frame, received_at):
+        """Разбирает кадр (один раз) и ставит его в очередь обработки"""
+        self.stats["frames_in"] += 1
+        self.frames_in_metric.inc()
+        message = frame.decode('utf-8', errors='replace')
+        try:
+            data = json.loads(frame)
+        except ValueError as e:
+            self.stats["parse_errors"] += 1
+            self.parse_errors_metric.inc()
+            log.error("Ошибка разбора JSON: %s, данные: %s", e, message)
+            self.send_to_monitor(f"INVALID JSON: {message}", "error")
+            return
+        if not isinstance(data, dict):
+            self.stats["parse_errors"] += 1
+            self.parse_errors_metric.inc()
+            self.send_to_monitor(f"INVALID FRAME: {message}", "error")
+            return
+        
+        try:
+            self.work_queue.put_nowait((message, data, received_at))
+        except asyncio.QueueFull:
+            self.stats["dropped"] += 1
+            log.warning("Очередь обработки %s переполнена, кадр отброшен: %s", self.port, message)
+    
+    def _report_overflow(self, head):
+        """Сообщает в монитор о слишком длинном кадре"""
+        preview = head.decode('utf-8', errors='replace')
+        self.send_to_monitor(f"FRAME TOO LONG from {self.port}: {preview}...", "error")
+    
+    async def _process_queue(self):
+        """Последовательная обработка кадров одного считывателя"""
+        while True:
+            message, data, received_at = await self.work_queue.get()
+            try:
+                await self.process_message(message, data, received_at)
+            finally:
+                self.work_queue.task_done()
+    
+    def _blocking_read(self):
+        """Ждёт первый байт не дольше POLL_TIMEOUT и дочитывает всё, что уже пришло"""
+        data = self.serial_conn.read(1)
+        if data and self.serial_conn.in_waiting:
+            data += self.serial_conn.read(min(self.serial_conn.in_waiting, READ_CHUNK_SIZE))
+        return data
+    
+    async def _poll_reading(self):
+        """Чтение для транспортов без файлового дескриптора (loop://, rfc2217:// и т.п.)"""
+        self.serial_conn.timeout = POLL_TIMEOUT
+        loop = asyncio.get_running_loop()
+        while self.running and self.is_connected:
+            try:
+                data = await loop.run_in_executor(None, self._blocking_read)
+            except (serial.SerialException, OSError) as e:
+                self.stats["errors"] += 1
+                log.error("Ошибка чтения из COM-порта %s: %s", self.port, e)
+                self.close()
+                return
+            if data:
+                self.feed(data)
     
     async def start_reading(self):
-        """Асинхронный запуск чтения COM-порта"""
+        """Чтение COM-порта до отключения или ошибки порта"""
         self.running = True
         
-        if not self.connect():
-            logging.error("Не удалось подключиться к COM-порту")
+        if not self.is_connected and not self.connect():
+            log.error("Не удалось подключиться к COM-порту %s", self.port)
             return
         
-        logging.info("Начало чтения COM-порта...")
+        log.info("Начало чтения COM-порта %s...", self.port)
         
-        while self.running:
-            try:
-                data = await asyncio.get_event_loop().run_in_executor(
-                    None, self.read_serial_data
-                )
-                
-                if data:
-                    lines = data.split('\n')
-                    for line in lines:
-                        line = line.strip()
-                        if line:
-                            try:
-                                json.loads(line)
-                                asyncio.create_task(self.process_message(line))
-                            except json.JSONDecodeError:
-                                self.data_buffer += line
-                                try:
-                                    json.loads(self.data_buffer)
-                                    asyncio.create_task(self.process_message(self.data_buffer))
-                                    self.data_buffer = ""
-                                except json.JSONDecodeError:
-                                    if len(self.data_buffer) > 1000:
-                                        self.data_buffer = ""
-                    
-            except Exception as e:
-                logging.error(f"Ошибка в цикле чтения: {e}")
-                await asyncio.sleep(1)
-            
-            await asyncio.sleep(0.01)
-    
-    async def send_to_monitor(self, message, direction="incoming"):
-        """Отправка данных в монитор порта"""
+        self.loop = asyncio.get_running_loop()
+        self.reading_done = self.loop.create_future()
+        self.work_queue = asyncio.Queue(maxsize=self.queue_size)
+        worker = asyncio.create_task(self._process_queue())
+        fd = self._fileno()
         try:
-            from backend.views import send_serial_monitor_message
-            await send_serial_monitor_message(message, direction)
-        except Exception as e:
-            logging.error(f"Ошибка отправки в монитор: {e}")
-    
-    def start_background(self):
-        """Запуск в фоновом потоке"""
-        def run():
-            self.loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(self.loop)
-            self.loop.run_until_complete(self.start_reading())
-        
-        thread = threading.Thread(target=run, daemon=True)
-        thread.start()
-        return thread
-
-serial_handler = SerialHandler()
\ No newline at end of file
+            if fd is not None:
+                self.loop.add_reader(fd, self._on_readable)
+                await self.reading_done
+            else:
+                await self._poll_reading()
+        finally:
+            if fd is not None:
+                self.loop.remove_reader(fd)
+            worker.cancel()
+            await asyncio.gather(worker, return_exceptions=True)
+    
+    def send_to_monitor(self, message, direction="incoming"):
+        """Публикация строки монитора порта [время в мс, направление, сообщение] (не ожидает подписчиков)"""
+        event_bus.publish("serial_data", [int(time.time() * 1000), direction, message])
@@ -0,0 +1,110 @@
+import asyncio
+import math
+import time
+import weakref
+from collections import deque
+
+
+class MonitorFeed:
+    """Пакетная рассылка трафика COM-портов клиентам монитора с буфером последних сообщений"""
+
+    def __init__(self, clients, broadcaster, flush_interval=0.1, batch_lines=200, history_size=500,
+                 client_max_rate=0):
+        self.clients = clients
+        self.broadcaster = broadcaster
+        self.flush_interval = flush_interval
+        self.batch_lines = batch_lines
+        self.client_max_rate = client_max_rate
+        self.history = deque(maxlen=history_size)
+        self.pending = []
+        self._buckets = weakref.WeakKeyDictionary()
+        self._wake = None
+        self.lines = 0
+        self.frames = 0
+        self.sampled_out = 0
+
+    def add(self, entry):
+        """Добавляет строку монитора вида [время, направление, сообщение]"""
+        self.history.append(entry)
+        self.pending.append(entry)
+        if len(self.pending) >= self.batch_lines and self._wake:
+            self._wake.set()
+
+    def replay_frame(self):
+        """Кадр с недавними сообщениями для только что подключившегося клиента.
+
+        Строки из pending в кадр не входят - клиент получит их следующим пакетом, поэтому его нужно
+        добавить в clients сразу после вызова, без await между ними."""
+        history = list(self.history)
+        return {"type": "serial_batch", "messages": history[:max(0, len(history) - len(self.pending))], "replay": True}
+
+    async def run(self):
+        """Сбрасывает накопленные строки каждые flush_interval или по достижении batch_lines"""
+        self._wake = asyncio.Event()
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Отправляет накопленный пакет всем клиентам монитора"""
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        self.lines += len(batch)
+        if not self.clients:
+            return
+        self.frames += 1
+
+        if not self.client_max_rate:
+            await self.broadcaster.broadcast(self.clients, {"type": "serial_batch", "messages": batch})
+            return
+
+        groups = {}
+        for client in list(self.clients):
+            stride = self._stride(client, len(batch))
+            if stride is None:
+                self.sampled_out += len(batch)
+                continue
+            groups.setdefault(stride, set()).add(client)
+        await asyncio.gather(*(self._send_sampled(group, batch, stride) for stride, group in groups.items()))
+
+    async def _send_sampled(self, group, batch, stride):
+        """Отправляет группе клиентов каждую stride-ю строку пакета"""
+        messages = batch[::stride]
+        frame = {"type": "serial_batch", "messages": messages}
+        if stride > 1:
+            frame["skipped"] = len(batch) - len(messages)
+            self.sampled_out += frame["skipped"] * len(group)
+        members = set(group)
+        await self.broadcaster.broadcast(group, frame)
+        for client in members - group:
+            self.clients.discard(client)
+
+    def _stride(self, client, count):
+        """Шаг прореживания для клиента по его лимиту строк в секунду (None - пропустить пакет)"""
+        now = time.monotonic()
+        tokens, last = self._buckets.get(client, (self.client_max_rate, now))
+        tokens = min(self.client_max_rate, tokens + (now - last) * self.client_max_rate)
+        if tokens >= count:
+            self._buckets[client] = (tokens - count, now)
+            return 1
+        if tokens < 1:
+            self._buckets[client] = (tokens, now)
+            return None
+        stride = math.ceil(count / tokens)
+        self._buckets[client] = (tokens - math.ceil(count / stride), now)
+        return stride
+
+    def stats(self):
+        """Возвращает счётчики монитора"""
+        return {
+            "lines": self.lines,
+            "frames": self.frames,
+            "pending": len(self.pending),
+            "history": len(self.history),
+            "sampled_out": self.sampled_out
+        }
@@ -1,8 +1,87 @@
 from backend.setup_db import CardDatabase
+from backend.async_db import AsyncCardDatabase
+from backend.media_cache import HotFileCache
+from backend.initial_media import IMAGE_DIR
+
+LOG_LEVEL = "INFO"
+# Уровни подсистем: serial - COM-порты, ws - WebSocket/HTTP, db - база данных и хранилища
+LOG_LEVELS = {"serial": "INFO", "ws": "INFO", "db": "INFO"}
+LOG_JSON = True
+LOG_QUEUE_SIZE = 10000
+LOG_MAX_FIELD = 256
+LOG_SAMPLE_WINDOW = 1.0
+LOG_SAMPLE_BURST = 20
 
 PORT = 8765
 HTTP_PORT = 8080
+# "asyncio" - HTTP на порту WebSocket (PORT), включая загрузку изображений; "flask" - прежний сервер Flask
+# в отдельном потоке на HTTP_PORT
+HTTP_SERVER = "asyncio"
+HTTP_BASE_URL = f"http://localhost:{PORT if HTTP_SERVER == 'asyncio' else HTTP_PORT}"
 DB_FILE = "cards.db"
-CARD_DB = CardDatabase(DB_FILE)
+CARD_CACHE_SIZE = 10000
+MEDIA_GC_GRACE = 3600
+MEDIA_GC_INTERVAL = 60.0
+MEDIA_CHECK_SHARDS = 8
+MEDIA_CACHE_BYTES = 64 * 1024 * 1024
+MEDIA_CACHE_MAX_FILE = 2 * 1024 * 1024
+MEDIA_MAX_AGE = 365 * 24 * 3600
+# Фильтр Блума UID карт доступа: доля ложных срабатываний и минимальная ёмкость
+UID_FILTER_ERROR_RATE = 0.001
+UID_FILTER_CAPACITY = 100000
+CARD_DB = CardDatabase(DB_FILE, cache_size=CARD_CACHE_SIZE, media_grace_period=MEDIA_GC_GRACE,
+                       uid_filter_error_rate=UID_FILTER_ERROR_RATE, uid_filter_capacity=UID_FILTER_CAPACITY)
+MEDIA_CACHE = HotFileCache(IMAGE_DIR, max_bytes=MEDIA_CACHE_BYTES, max_file_size=MEDIA_CACHE_MAX_FILE)
+CARD_DB.media.add_unlink_listener(MEDIA_CACHE.invalidate)
+DB_WORKERS = 4
+DB_MAX_PENDING = 256
+DB_TIMEOUT = 5.0
+# Таймаут импорта карт в пуле БД: импорт большого файла идёт заметно дольше обычного запроса
+IMPORT_TIMEOUT = 300.0
+ASYNC_DB = AsyncCardDatabase(CARD_DB, max_workers=DB_WORKERS, max_pending=DB_MAX_PENDING, timeout=DB_TIMEOUT)
 CONNECTED_CLIENTS = set()
+# Параллельных запросов (с request_id) на одно соединение WebSocket
+WS_MAX_IN_FLIGHT = 8
+JOURNAL_BATCH_SIZE = 500
+JOURNAL_FLUSH_INTERVAL = 0.05
+JOURNAL_QUEUE_SIZE = 100000
+JOURNAL_RETENTION_DAYS = 90
+JOURNAL_PRUNE_INTERVAL = 3600
+JOURNAL_PRUNE_BATCH = 10000
+# Журнал изменений карт для нескольких процессов с общей БД: период опроса (с) - он же верхняя граница
+# задержки отзыва карты в других процессах, размер пачки чтения, срок хранения и период очистки
+CHANGE_FEED_INTERVAL = 0.2
+CHANGE_FEED_BATCH_SIZE = 1000
+CHANGE_FEED_RETENTION_DAYS = 7
+CHANGE_FEED_PRUNE_INTERVAL = 3600
+MAX_IMAGE_SIZE = 10 * 1024 * 1024
+METRICS_LOOP_LAG_INTERVAL = 0.5
+EVENT_QUEUE_SIZE = 1024
+EVENT_DROP_POLICY = "drop_oldest"
+BROADCAST_SEND_TIMEOUT = 1.0
+BROADCAST_MAX_BUFFER = 1024 * 1024
+BROADCAST_MAX_STRIKES = 50
+# Фоновых рассылок событий одновременно; сверх этого события отбрасываются
+BROADCAST_MAX_IN_FLIGHT = 1000
+MONITOR_FLUSH_INTERVAL = 0.1
+MONITOR_BATCH_LINES = 200
+MONITOR_HISTORY_SIZE = 500
+MONITOR_CLIENT_MAX_RATE = 0
+
+# Сканирований в секунду на один readerId (0 - без ограничения), запас и ответ на превышение:
+# "deny" - отказ в доступе без обращения к БД, "drop" - кадр игнорируется
+READER_RATE_LIMIT = 50.0
+READER_RATE_BURST = 100
+READER_RATE_OVERFLOW = "deny"
+# Разных readerId/deviceId на один порт с отдельным лимитом, метками метрик и маршрутом; остальные считаются
+# как "other" и в таблицу маршрутов не попадают
+READER_MAX_IDS_PER_PORT = 16
+
+SERIAL_PORTS = ['/dev/ttyACM0']
+SERIAL_BAUDRATE = 115200
+SERIAL_AUTODISCOVER = False
+SERIAL_DISCOVERY_PATTERNS = ('/dev/ttyACM*', '/dev/ttyUSB*', 'COM*')
+SERIAL_DISCOVERY_INTERVAL = 5.0
+SERIAL_RECONNECT_MIN = 0.5
+SERIAL_RECONNECT_MAX = 30.0
 
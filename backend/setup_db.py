@@ -1,200 +1,497 @@
 import logging
-import sqlite3
 import re
 import os
-from datetime import datetime
+import sqlite3
 import time
+import uuid
+from datetime import datetime
 from backend.initial_media import IMAGE_DIR
+from backend.card_cache import CardCache
+from backend.media_store import MediaStore, normalize_ext
+from backend.db_connection import ConnectionManager
+from backend.uid_filter import UidFilter
+from backend.metrics import DB_QUERY_SECONDS
+from backend.profiling import slow_trace
+
+log = logging.getLogger("db")
+ACCESS_CARD_TYPES = ("KEY", "WORKER", "SECURITY")
+HEX_UID_RE = re.compile(r"[0-9A-F]+")
+SCHEMA_VERSION = 5
+
+
+def uid_to_key(uid_str):
+    """Компактный двоичный ключ нормализованного HEX UID для индекса"""
+    if len(uid_str) % 2:
+        uid_str = "0" + uid_str
+    try:
+        return bytes.fromhex(uid_str)
+    except ValueError:
+        return uid_str.encode("utf-8")
+
+
+def parse_cursor(cursor):
+    """Разбирает курсор страницы вида "<ts>:<id>"; ValueError, если он некорректен"""
+    parts = cursor.split(":") if isinstance(cursor, str) else ()
+    if len(parts) != 2 or not all(part.isdigit() for part in parts):
+        raise ValueError(f"некорректный курсор {cursor!r}, ожидается строка из next_cursor")
+    return int(parts[0]), int(parts[1])
+
+
+def _local_timestamp(date_str):
+    """Переводит дату вида 'YYYY-MM-DD HH:MM:SS' (локальное время) в Unix-время"""
+    try:
+        return int(datetime.strptime(date_str, "%Y-%m-%d %H:%M:%S").timestamp())
+    except (TypeError, ValueError):
+        return 0
+
+
+def _migrate_v1(conn):
+    """Исходная схема: карты и изображения с ключом (card_type, uid)"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS cards (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        card_type TEXT NOT NULL,
+        uid TEXT NOT NULL,
+        date_added TEXT,
+        UNIQUE(card_type, uid)
+    )
+    ''')
+    
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS media (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        card_type TEXT NOT NULL,
+        uid TEXT NOT NULL,
+        image_filename TEXT NOT NULL,
+        date_uploaded TEXT DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (card_type, uid) REFERENCES cards (card_type, uid),
+        UNIQUE(card_type, uid)
+    )
+    ''')
+
+
+def _migrate_v2(conn):
+    """Двоичный ключ UID с индексом, целочисленное время добавления, изображения по id карты"""
+    conn.execute('''
+    CREATE TABLE cards_v2 (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        card_type TEXT NOT NULL,
+        uid TEXT NOT NULL,
+        uid_key BLOB NOT NULL,
+        date_added TEXT,
+        added_ts INTEGER NOT NULL DEFAULT 0,
+        UNIQUE(card_type, uid)
+    )
+    ''')
+    conn.execute('''
+    INSERT INTO cards_v2 (id, card_type, uid, uid_key, date_added, added_ts)
+    SELECT id, card_type, uid, uid_key(uid), date_added, local_ts(date_added) FROM cards
+    ''')
+    
+    conn.execute('''
+    CREATE TABLE media_v2 (
+        card_id INTEGER PRIMARY KEY REFERENCES cards (id) ON DELETE CASCADE,
+        image_filename TEXT NOT NULL,
+        date_uploaded TEXT,
+        uploaded_ts INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    conn.execute('''
+    INSERT OR REPLACE INTO media_v2 (card_id, image_filename, date_uploaded, uploaded_ts)
+    SELECT c.id, m.image_filename, m.date_uploaded, local_ts(m.date_uploaded)
+    FROM media m JOIN cards c ON c.card_type = m.card_type AND c.uid = m.uid
+    ORDER BY m.id
+    ''')
+    
+    conn.execute("DROP TABLE media")
+    conn.execute("DROP TABLE cards")
+    conn.execute("ALTER TABLE cards_v2 RENAME TO cards")
+    conn.execute("ALTER TABLE media_v2 RENAME TO media")
+    conn.execute("CREATE INDEX idx_cards_uid_key ON cards (uid_key)")
+    conn.execute("CREATE INDEX idx_cards_added ON cards (added_ts DESC, id DESC)")
+
+
+def _migrate_v3(conn):
+    """Контентно-адресуемое хранилище: файлы изображений со счётчиками ссылок, которые ведут триггеры"""
+    conn.execute('''
+    CREATE TABLE media_files (
+        filename TEXT PRIMARY KEY,
+        size INTEGER NOT NULL DEFAULT 0,
+        refcount INTEGER NOT NULL DEFAULT 0,
+        created_ts INTEGER NOT NULL DEFAULT 0,
+        orphaned_ts INTEGER
+    ) WITHOUT ROWID
+    ''')
+    conn.execute("CREATE INDEX idx_media_files_orphaned ON media_files (orphaned_ts) WHERE refcount = 0")
+    conn.execute("CREATE INDEX idx_media_filename ON media (image_filename)")
+    conn.execute("CREATE TABLE media_meta (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute('''
+    INSERT INTO media_files (filename, refcount, created_ts)
+    SELECT image_filename, COUNT(*), MIN(uploaded_ts) FROM media GROUP BY image_filename
+    ''')
+
+    now = "CAST(strftime('%s', 'now') AS INTEGER)"
+    # Политика конфликтов внешнего оператора (UPSERT) переопределяет OR IGNORE внутри триггера
+    add_ref = f'''
+        INSERT INTO media_files (filename, created_ts) SELECT NEW.image_filename, {now}
+        WHERE NOT EXISTS (SELECT 1 FROM media_files WHERE filename = NEW.image_filename);
+        UPDATE media_files SET refcount = refcount + 1, orphaned_ts = NULL WHERE filename = NEW.image_filename;
+    '''
+    drop_ref = f'''
+        UPDATE media_files SET refcount = refcount - 1,
+            orphaned_ts = CASE WHEN refcount <= 1 THEN {now} ELSE orphaned_ts END
+        WHERE filename = OLD.image_filename;
+    '''
+    conn.execute(f"CREATE TRIGGER media_files_ref AFTER INSERT ON media BEGIN {add_ref} END")
+    conn.execute(f"CREATE TRIGGER media_files_unref AFTER DELETE ON media BEGIN {drop_ref} END")
+    conn.execute(f'''
+    CREATE TRIGGER media_files_reref AFTER UPDATE OF image_filename ON media
+    WHEN OLD.image_filename IS NOT NEW.image_filename
+    BEGIN {add_ref} {drop_ref} END
+    ''')
+
+
+def _migrate_v4(conn):
+    """Журнал сканирований карт с индексами по времени, UID и считывателю"""
+    conn.execute('''
+    CREATE TABLE scan_events (
+        id INTEGER PRIMARY KEY,
+        ts_ms INTEGER NOT NULL,
+        uid TEXT NOT NULL,
+        uid_key BLOB NOT NULL,
+        reader_id TEXT,
+        device_id TEXT,
+        port TEXT,
+        card_type TEXT,
+        granted INTEGER NOT NULL,
+        latency_us INTEGER
+    )
+    ''')
+    conn.execute("CREATE INDEX idx_scan_events_ts ON scan_events (ts_ms)")
+    conn.execute("CREATE INDEX idx_scan_events_uid ON scan_events (uid_key, ts_ms)")
+    conn.execute("CREATE INDEX idx_scan_events_reader ON scan_events (reader_id, ts_ms)")
+
+
+def _migrate_v5(conn):
+    """Журнал изменений карт: ревизия пишется в той же транзакции, что и изменение"""
+    conn.execute('''
+    CREATE TABLE card_changes (
+        revision INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts_ms INTEGER NOT NULL,
+        op TEXT NOT NULL,
+        card_type TEXT,
+        uid TEXT,
+        origin TEXT
+    )
+    ''')
+    conn.execute("CREATE INDEX idx_card_changes_ts ON card_changes (ts_ms)")
+
+
+MIGRATIONS = [
+    (1, _migrate_v1),
+    (2, _migrate_v2),
+    (3, _migrate_v3),
+    (4, _migrate_v4),
+    (5, _migrate_v5),
+]
+
 
 class CardDatabase:
-    def __init__(self, db_file):
+    def __init__(self, db_file, cache_size=10000, media_grace_period=3600, uid_filter_error_rate=0.001,
+                 uid_filter_capacity=100000):
         self.db_file = db_file
+        self.db = ConnectionManager(db_file)
+        # Отличает изменения этого процесса в журнале card_changes от изменений других экземпляров
+        self.instance_id = uuid.uuid4().hex[:12]
+        self.card_cache = CardCache(cache_size)
+        self.media = MediaStore(IMAGE_DIR, self.db, grace_period=media_grace_period, on_relink=self.card_cache.clear)
+        self.uid_filter = UidFilter(self._load_access_uids, ACCESS_CARD_TYPES,
+                                    error_rate=uid_filter_error_rate, min_capacity=uid_filter_capacity)
+        self.change_listeners = [self.uid_filter.on_card_changed]
         self.init_database()
         
     def init_database(self):
         """Инициализация базы данных SQLite"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS cards (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            card_type TEXT NOT NULL,
-            uid TEXT NOT NULL,
-            date_added TEXT,
-            UNIQUE(card_type, uid)
-        )
-        ''')
-        
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS media (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            card_type TEXT NOT NULL,
-            uid TEXT NOT NULL,
-            image_filename TEXT NOT NULL,
-            date_uploaded TEXT DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (card_type, uid) REFERENCES cards (card_type, uid),
-            UNIQUE(card_type, uid)
-        )
-        ''')
-        
-        conn.commit()
-        conn.close()
-        logging.info(f"База данных SQLite инициализирована: {self.db_file}")
+        self.migrate()
+        log.info("База данных SQLite инициализирована: %s (схема v%s)", self.db_file, SCHEMA_VERSION)
         
         os.makedirs(IMAGE_DIR, exist_ok=True)
+        # Ревизия до сборки фильтра UID и заполнения кэша: журнал изменений применяется начиная с неё
+        self.start_revision = self.latest_revision()
+        self.uid_filter.schedule_rebuild()
+    
+    def migrate(self):
+        """Применяет недостающие миграции схемы по PRAGMA user_version"""
+        conn = self.db.connection()
+        conn.create_function("uid_key", 1, uid_to_key, deterministic=True)
+        conn.create_function("local_ts", 1, _local_timestamp, deterministic=True)
+        
+        with self.db.transaction():
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for target, migration in MIGRATIONS:
+                if target <= version:
+                    continue
+                log.info("Миграция схемы БД: v%s -> v%s", version, target)
+                migration(conn)
+                conn.execute(f"PRAGMA user_version = {target}")
+                version = target
     
+    @DB_QUERY_SECONDS.timed(tracer=slow_trace)
     def check_card(self, card_type, uid):
         """Проверяет наличие карты в базе данных"""
-        conn = sqlite3.connect(self.db_file)
-        cursor = conn.cursor()
-        
         uid_str = self._normalize_uid_for_search(uid)
         
-        cursor.execute("SELECT COUNT(*) FROM cards WHERE card_type = ? AND uid = ?", 
-                     (card_type, uid_str))
-        count = cursor.fetchone()[0]
-        
-        conn.close()
-        return count > 0
+        cursor = self.db.connection().execute(
+            "SELECT EXISTS(SELECT 1 FROM cards WHERE card_type = ? AND uid = ?)", 
+            (card_type, uid_str))
+        return cursor.fetchone()[0] == 1
     
+    @DB_QUERY_SECONDS.timed(tracer=slow_trace)
     def add_card(self, card_type, uid):
         """Добавляет карту в базу данных"""
         try:
             uid_str = self._normalize_uid_for_storage(uid)
+            now = datetime.now()
             
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
+            with self.db.transaction() as conn:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO cards (card_type, uid, uid_key, date_added, added_ts) VALUES (?, ?, ?, ?, ?)", 
+                    (card_type, uid_str, uid_to_key(uid_str), now.strftime("%Y-%m-%d %H:%M:%S"), int(now.timestamp())))
+                inserted = cursor.rowcount > 0
+                if inserted:
+                    self._log_change(conn, "added", card_type, self._normalize_uid_for_search(uid))
             
-            cursor.execute("SELECT COUNT(*) FROM cards WHERE card_type = ? AND uid = ?", 
-                        (card_type, uid_str))
-            if cursor.fetchone()[0] > 0:
-                logging.warning(f"Карта {card_type} с UID {uid_str} уже существует в БД")
-                conn.close()
+            if not inserted:
+                log.warning("Карта %s с UID %s уже существует в БД", card_type, uid_str)
                 return False
             
-            date_added = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            cursor.execute("INSERT INTO cards (card_type, uid, date_added) VALUES (?, ?, ?)", 
-                        (card_type, uid_str, date_added))
-            conn.commit()
-            conn.close()
+            self._card_changed("added", card_type, self._normalize_uid_for_search(uid))
             
-            logging.info(f"Карта {card_type} с UID {uid_str} добавлена в БД")
+            log.info("Карта %s с UID %s добавлена в БД", card_type, uid_str)
             return True
         except Exception as e:
-            logging.error(f"Ошибка при добавлении карты: {e}")
+            log.error("Ошибка при добавлении карты: %s", e)
             return False
     
+    @DB_QUERY_SECONDS.timed(tracer=slow_trace)
+    def import_cards(self, cards, batch_size=5000):
+        """Массово добавляет карты из итератора пар (тип, UID) пакетами INSERT OR IGNORE"""
+        result = {"added": 0, "skipped": 0, "invalid": 0}
+        batch = []
+        for card in cards:
+            batch.append(card)
+            if len(batch) >= batch_size:
+                self._import_batch(batch, result)
+                batch = []
+        if batch:
+            self._import_batch(batch, result)
+        
+        if result["added"]:
+            self.card_cache.clear()
+            self._card_changed("imported", None, None)
+        log.info("Импорт карт: добавлено %s, пропущено %s, некорректных %s",
+                 result["added"], result["skipped"], result["invalid"])
+        return result
+    
+    def _import_batch(self, batch, result):
+        """Нормализует пакет UID и вставляет его одной транзакцией"""
+        now = datetime.now()
+        date_added = now.strftime("%Y-%m-%d %H:%M:%S")
+        added_ts = int(now.timestamp())
+        rows = []
+        for card_type, uid in batch:
+            card_type = str(card_type).strip()
+            uid_str = self._normalize_uid_for_storage(uid)
+            if not card_type or not HEX_UID_RE.fullmatch(uid_str):
+                # CardReader уже отсеивает такие строки с номером строки; здесь - защита для других источников
+                result["invalid"] += 1
+                continue
+            rows.append((card_type, uid_str, uid_to_key(uid_str), date_added, added_ts))
+        
+        with self.db.transaction() as conn:
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO cards (card_type, uid, uid_key, date_added, added_ts) VALUES (?, ?, ?, ?, ?)",
+                rows)
+            added = conn.total_changes - before
+            if added:
+                self._log_change(conn, "imported", None, None)
+        result["added"] += added
+        result["skipped"] += len(rows) - added
+    
+    @DB_QUERY_SECONDS.timed(tracer=slow_trace)
     def remove_card(self, card_type, uid):
         """Удаляет карту из базы данных"""
         try:
             uid_str = self._normalize_uid_for_search(uid)
             
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-            
-            cursor.execute("DELETE FROM media WHERE card_type = ? AND uid = ?", 
-                        (card_type, uid_str))
-            
-            cursor.execute("DELETE FROM cards WHERE card_type = ? AND uid = ?", 
-                        (card_type, uid_str))
-            deleted = cursor.rowcount > 0
-            
-            conn.commit()
-            conn.close()
+            with self.db.transaction() as conn:
+                conn.execute("DELETE FROM media WHERE card_id IN (SELECT id FROM cards WHERE card_type = ? AND uid = ?)", 
+                            (card_type, uid_str))
+                
+                cursor = conn.execute("DELETE FROM cards WHERE card_type = ? AND uid = ?", 
+                                    (card_type, uid_str))
+                deleted = cursor.rowcount > 0
+                if deleted:
+                    self._log_change(conn, "removed", card_type, uid_str)
             
             if deleted:
-                logging.info(f"Карта {card_type} с UID {uid_str} удалена из БД")
+                self._card_changed("removed", card_type, uid_str)
+                log.info("Карта %s с UID %s удалена из БД", card_type, uid_str)
             else:
-                logging.warning(f"Карта {card_type} с UID {uid_str} не найдена в БД")
+                log.warning("Карта %s с UID %s не найдена в БД", card_type, uid_str)
                 
             return deleted
         except Exception as e:
-            logging.error(f"Ошибка при удалении карты: {e}")
+            log.error("Ошибка при удалении карты: %s", e)
             return False
     
-    def list_cards(self):
-        """Возвращает список всех карт с информацией об изображениях"""
+    def list_cards(self, card_type=None, uid_prefix=None, has_image=None):
+        """Возвращает список всех карт (с учётом фильтров) с информацией об изображениях"""
+        return list(self.iter_cards(card_type=card_type, uid_prefix=uid_prefix, has_image=has_image))
+    
+    def iter_cards(self, page_size=500, **filters):
+        """Лениво перебирает карты страницами по page_size"""
+        cursor = None
+        while True:
+            cards, cursor = self.list_cards_page(page_size=page_size, cursor=cursor, **filters)
+            yield from cards
+            if cursor is None:
+                return
+    
+    @DB_QUERY_SECONDS.timed(tracer=slow_trace)
+    def list_cards_page(self, page_size=100, cursor=None, card_type=None, uid_prefix=None, has_image=None):
+        """Возвращает страницу карт и курсор следующей страницы (None, если страница последняя);
+        ValueError при некорректном курсоре"""
+        if cursor not in (None, ""):
+            cursor = parse_cursor(cursor)
         try:
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
+            where, params = self._card_filters(card_type, uid_prefix, has_image)
+            if cursor:
+                cursor_ts, cursor_id = cursor
+                where.append("(c.added_ts < ? OR (c.added_ts = ? AND c.id < ?))")
+                params.extend([cursor_ts, cursor_ts, cursor_id])
             
-            cursor.execute('''
-                SELECT c.card_type, c.uid, c.date_added, ci.image_filename 
+            where_sql = f"WHERE {' AND '.join(where)}" if where else ""
+            rows = self.db.connection().execute(f'''
+                SELECT c.id, c.added_ts, c.card_type, c.uid, c.date_added, ci.image_filename 
                 FROM cards c 
-                LEFT JOIN media ci ON c.card_type = ci.card_type AND c.uid = ci.uid 
-                ORDER BY c.date_added DESC
-            ''')
-            rows = cursor.fetchall()
+                LEFT JOIN media ci ON ci.card_id = c.id 
+                {where_sql}
+                ORDER BY c.added_ts DESC, c.id DESC
+                LIMIT ?
+            ''', (*params, page_size + 1)).fetchall()
             
             cards = []
-            for row in rows:
-                card_type, uid_str, date_added, image_filename = row
+            for row in rows[:page_size]:
+                card_id, added_ts, card_type_value, uid_str, date_added, image_filename = row
                 cards.append({
-                    "card_type": card_type,
+                    "card_type": card_type_value,
                     "uid": uid_str,
                     "date_added": date_added,
                     "image_filename": image_filename,
                     "has_image": image_filename is not None
                 })
             
-            conn.close()
-            return cards
+            next_cursor = None
+            if len(rows) > page_size:
+                card_id, added_ts = rows[page_size - 1][:2]
+                next_cursor = f"{added_ts}:{card_id}"
+            return cards, next_cursor
         except Exception as e:
-            logging.error(f"Ошибка при получении списка карт: {e}")
-            return []
+            log.error("Ошибка при получении списка карт: %s", e)
+            return [], None
     
+    @DB_QUERY_SECONDS.timed(tracer=slow_trace)
+    def count_cards(self, card_type=None, uid_prefix=None, has_image=None):
+        """Возвращает количество карт, удовлетворяющих фильтрам"""
+        try:
+            where, params = self._card_filters(card_type, uid_prefix, has_image)
+            if has_image is None:
+                sql = "SELECT COUNT(*) FROM cards c"
+            else:
+                sql = "SELECT COUNT(*) FROM cards c LEFT JOIN media ci ON ci.card_id = c.id"
+            if where:
+                sql += f" WHERE {' AND '.join(where)}"
+            return self.db.connection().execute(sql, params).fetchone()[0]
+        except Exception as e:
+            log.error("Ошибка при подсчёте карт: %s", e)
+            return 0
+    
+    def _card_filters(self, card_type, uid_prefix, has_image):
+        """Собирает условия WHERE для выборки карт"""
+        where, params = [], []
+        if card_type:
+            where.append("c.card_type = ?")
+            params.append(card_type)
+        if uid_prefix:
+            prefix = self._normalize_uid_for_search(uid_prefix)
+            if prefix:
+                where.append("c.uid >= ? AND c.uid < ?")
+                params.extend([prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)])
+        if has_image is not None:
+            where.append("ci.card_id IS NOT NULL" if has_image else "ci.card_id IS NULL")
+        return where, params
+    
+    @DB_QUERY_SECONDS.timed(tracer=slow_trace)
     def save_card_image(self, card_type, uid, image_data, filename):
         """Сохраняет изображение для карты"""
         try:
-            uid_str = self._normalize_uid_for_search(uid)
-            
             if not self.check_card(card_type, uid):
                 return False, "Карта не существует"
             
-            file_ext = os.path.splitext(filename)[1]
-            safe_filename = f"{card_type}_{uid_str}_{int(time.time())}{file_ext}"
-            image_path = os.path.join(IMAGE_DIR, safe_filename)
-            
-            with open(image_path, 'wb') as f:
-                f.write(image_data)
+            image_filename = self.media.put_bytes(image_data, normalize_ext(filename))
             
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
+            return self.attach_card_image(card_type, uid, image_filename)
             
-            cursor.execute("DELETE FROM media WHERE card_type = ? AND uid = ?", 
-                          (card_type, uid_str))
+        except Exception as e:
+            log.error("Ошибка при сохранении изображения карты: %s", e)
+            return False, f"Ошибка: {str(e)}"
+    
+    @DB_QUERY_SECONDS.timed(tracer=slow_trace)
+    def attach_card_image(self, card_type, uid, image_filename):
+        """Привязывает файл из хранилища изображений к карте (ссылку на прежний файл снимает триггер)"""
+        try:
+            uid_str = self._normalize_uid_for_search(uid)
+            now = datetime.now()
+            with self.db.transaction() as conn:
+                cursor = conn.execute('''
+                    INSERT INTO media (card_id, image_filename, date_uploaded, uploaded_ts)
+                    SELECT id, ?, ?, ? FROM cards WHERE card_type = ? AND uid = ?
+                    ON CONFLICT (card_id) DO UPDATE SET
+                        image_filename = excluded.image_filename,
+                        date_uploaded = excluded.date_uploaded,
+                        uploaded_ts = excluded.uploaded_ts
+                ''', (image_filename, now.strftime("%Y-%m-%d %H:%M:%S"), int(now.timestamp()), card_type, uid_str))
+                attached = cursor.rowcount > 0
+                if attached:
+                    self._log_change(conn, "image", card_type, uid_str)
             
-            date_uploaded = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            cursor.execute("INSERT INTO media (card_type, uid, image_filename, date_uploaded) VALUES (?, ?, ?, ?)", 
-                          (card_type, uid_str, safe_filename, date_uploaded))
+            if not attached:
+                return False, "Карта не существует"
             
-            conn.commit()
-            conn.close()
+            self._card_changed("image", card_type, uid_str)
             
-            logging.info(f"Изображение сохранено для карты {card_type} с UID {uid_str}")
+            log.info("Изображение сохранено для карты %s с UID %s", card_type, uid_str)
             return True, "Изображение успешно сохранено"
             
         except Exception as e:
-            logging.error(f"Ошибка при сохранении изображения карты: {e}")
+            log.error("Ошибка при сохранении изображения карты: %s", e)
             return False, f"Ошибка: {str(e)}"
     
+    @DB_QUERY_SECONDS.timed(tracer=slow_trace)
     def get_card_image_info(self, card_type, uid):
         """Получает информацию об изображении карты"""
         try:
             uid_str = self._normalize_uid_for_search(uid)
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
+            cursor = self.db.connection().execute('''
                 SELECT ci.image_filename, ci.date_uploaded, c.date_added 
                 FROM media ci 
-                JOIN cards c ON ci.card_type = c.card_type AND ci.uid = c.uid 
-                WHERE ci.card_type = ? AND ci.uid = ?
+                JOIN cards c ON ci.card_id = c.id 
+                WHERE c.card_type = ? AND c.uid = ?
             ''', (card_type, uid_str))
             
             result = cursor.fetchone()
-            conn.close()
             
             if result:
                 image_filename, date_uploaded, date_added = result
@@ -207,25 +504,22 @@ class CardDatabase:
             return None
             
         except Exception as e:
-            logging.error(f"Ошибка при получении информации об изображении карты: {e}")
+            log.error("Ошибка при получении информации об изображении карты: %s", e)
             return None
     
+    @DB_QUERY_SECONDS.timed(tracer=slow_trace)
     def get_card_with_image(self, card_type, uid):
         """Получает полные данные карты с информацией об изображении"""
         try:
             uid_str = self._normalize_uid_for_search(uid)
-            conn = sqlite3.connect(self.db_file)
-            cursor = conn.cursor()
-            
-            cursor.execute('''
+            cursor = self.db.connection().execute('''
                 SELECT c.card_type, c.uid, c.date_added, ci.image_filename, ci.date_uploaded
                 FROM cards c 
-                LEFT JOIN media ci ON c.card_type = ci.card_type AND c.uid = ci.uid
+                LEFT JOIN media ci ON ci.card_id = c.id
                 WHERE c.card_type = ? AND c.uid = ?
             ''', (card_type, uid_str))
             
             result = cursor.fetchone()
-            conn.close()
             
             if result:
                 card_type, uid_str, date_added, image_filename, date_uploaded = result
@@ -240,9 +534,148 @@ class CardDatabase:
             return None
             
         except Exception as e:
-            logging.error(f"Ошибка при получении карты с изображением: {e}")
+            log.error("Ошибка при получении карты с изображением: %s", e)
             return None
     
+    @DB_QUERY_SECONDS.timed(tracer=slow_trace)
+    def find_card_by_uid(self, uid):
+        """Находит карту по UID среди типов доступа (KEY, WORKER, SECURITY) с учётом кэша"""
+        found, card_data, uid_str, generation = self._fast_path(uid)
+        if found:
+            return card_data
+        return self.load_card_by_uid(uid_str, generation)
+    
+    def _fast_path(self, uid):
+        """Поиск без запроса к БД (фильтр UID, затем кэш): (найдено, данные карты, нормализованный UID, поколение
+        кэша); если не найдено, карту читает load_card_by_uid(uid_str, generation)"""
+        uid_str = self._normalize_uid_for_search(uid)
+        if not self.uid_filter.might_contain(uid_str):
+            return True, None, uid_str, None
+        generation = self.card_cache.generation
+        found, card_data = self.card_cache.get(uid_str)
+        return found, card_data, uid_str, generation
+    
+    @DB_QUERY_SECONDS.timed(tracer=slow_trace)
+    def load_card_by_uid(self, uid_str, generation=None):
+        """Читает карту по нормализованному UID из БД и сохраняет результат в кэш"""
+        try:
+            cursor = self.db.connection().execute('''
+                SELECT c.card_type, c.uid, c.date_added, ci.image_filename, ci.date_uploaded
+                FROM cards c 
+                LEFT JOIN media ci ON ci.card_id = c.id
+                WHERE c.uid_key = ? AND c.uid = ? AND c.card_type IN (?, ?, ?)
+                ORDER BY CASE c.card_type WHEN ? THEN 0 WHEN ? THEN 1 ELSE 2 END
+                LIMIT 1
+            ''', (uid_to_key(uid_str), uid_str, *ACCESS_CARD_TYPES, *ACCESS_CARD_TYPES[:2]))
+            
+            result = cursor.fetchone()
+        except Exception as e:
+            log.error("Ошибка при поиске карты по UID: %s", e)
+            return None
+        
+        card_data = None
+        if result:
+            card_type, stored_uid, date_added, image_filename, date_uploaded = result
+            card_data = {
+                "card_type": card_type,
+                "uid": stored_uid,
+                "date_added": date_added,
+                "image_filename": image_filename,
+                "date_uploaded": date_uploaded,
+                "has_image": image_filename is not None
+            }
+        self.card_cache.put(uid_str, card_data, generation)
+        return card_data
+
+    @DB_QUERY_SECONDS.timed(tracer=slow_trace)
+    def lookup_cards(self, items, chunk_size=5000):
+        """Пакетная проверка карт: items - пары (тип или None, UID); UID читаются запросами
+        uid_key IN (...) по chunk_size штук. Возвращает результаты в порядке items"""
+        requested = [(card_type, self._normalize_uid_for_search(uid)) for card_type, uid in items]
+        found = {}
+        conn = self.db.connection()
+        chunk_size = max(1, min(chunk_size, conn.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)))
+        keys = list({uid_to_key(uid_str): uid_str for _, uid_str in requested if uid_str})
+        for start in range(0, len(keys), chunk_size):
+            chunk = keys[start:start + chunk_size]
+            cursor = conn.execute(f'''
+                SELECT c.card_type, c.uid, c.date_added, ci.image_filename, ci.date_uploaded
+                FROM cards c
+                LEFT JOIN media ci ON ci.card_id = c.id
+                WHERE c.uid_key IN ({",".join("?" * len(chunk))})
+            ''', chunk)
+            for card_type, stored_uid, date_added, image_filename, date_uploaded in cursor:
+                found.setdefault(stored_uid, {})[card_type] = {
+                    "card_type": card_type,
+                    "date_added": date_added,
+                    "image_filename": image_filename,
+                    "date_uploaded": date_uploaded,
+                    "has_image": image_filename is not None
+                }
+
+        results = []
+        for card_type, uid_str in requested:
+            cards = found.get(uid_str, {})
+            if card_type is None:
+                # Без типа: все карты с этим UID, типы доступа первыми
+                ordered = sorted(cards.values(), key=lambda card: (
+                    ACCESS_CARD_TYPES.index(card["card_type"]) if card["card_type"] in ACCESS_CARD_TYPES
+                    else len(ACCESS_CARD_TYPES), card["card_type"]))
+                results.append({"uid": uid_str, "state": 1 if ordered else 0, "cards": ordered})
+                continue
+            card = cards.get(card_type)
+            entry = {"card_type": card_type, "uid": uid_str, "state": 1 if card else 0}
+            if card:
+                entry.update(card)
+            results.append(entry)
+        return results
+
+    def _load_access_uids(self):
+        """UID всех карт доступа для сборки фильтра UID"""
+        cursor = self.db.connection().execute(
+            "SELECT DISTINCT uid FROM cards WHERE card_type IN (?, ?, ?)", ACCESS_CARD_TYPES)
+        return [row[0] for row in cursor]
+
+    def _log_change(self, conn, op, card_type, uid_str):
+        """Записывает изменение в card_changes внутри текущей транзакции"""
+        conn.execute(
+            "INSERT INTO card_changes (ts_ms, op, card_type, uid, origin) VALUES (?, ?, ?, ?, ?)",
+            (int(time.time() * 1000), op, card_type, uid_str, self.instance_id))
+
+    def latest_revision(self):
+        """Последняя выданная ревизия журнала изменений (0 - изменений не было); очистка журнала её не сбрасывает"""
+        row = self.db.connection().execute("SELECT seq FROM sqlite_sequence WHERE name = 'card_changes'").fetchone()
+        return row[0] if row else 0
+
+    def read_changes(self, after, limit=1000):
+        """Изменения с ревизией больше after: [(ревизия, ts_ms, операция, тип, UID, источник), ...]"""
+        return self.db.connection().execute(
+            "SELECT revision, ts_ms, op, card_type, uid, origin FROM card_changes WHERE revision > ? "
+            "ORDER BY revision LIMIT ?", (after, limit)).fetchall()
+
+    def apply_remote_change(self, op, card_type, uid_str):
+        """Применяет изменение, сделанное другим процессом: сброс кэша, фильтр UID, уведомления"""
+        if op == "imported":
+            self.card_cache.clear()
+        self._card_changed(op, card_type, uid_str)
+
+    def add_change_listener(self, listener):
+        """Регистрирует обработчик изменений карт: listener(операция, тип карты, UID)"""
+        self.change_listeners.append(listener)
+    
+    def _card_changed(self, op, card_type, uid_str):
+        """Сбрасывает кэш UID и уведомляет обработчиков об изменении карты"""
+        self.card_cache.invalidate(uid_str)
+        for listener in self.change_listeners:
+            try:
+                listener(op, card_type, uid_str)
+            except Exception as e:
+                log.error("Ошибка обработчика изменений карт: %s", e)
+    
+    def close(self):
+        """Закрывает подключения к базе данных"""
+        self.db.close_all()
+    
     def _normalize_uid_for_storage(self, uid):
         """Нормализует UID для сохранения в базу данных"""
         if isinstance(uid, list):
@@ -284,5 +717,5 @@ class CardDatabase:
                 if numbers:
                     return [int(num) for num in numbers]
             except ValueError as e:
-                logging.error(f"Ошибка при извлечении чисел из UID: {e}")
+                log.error("Ошибка при извлечении чисел из UID: %s", e)
         return None
\ No newline at end of file
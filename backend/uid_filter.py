@@ -0,0 +1,168 @@
+import hashlib
+import logging
+import math
+import struct
+import threading
+from backend.metrics import UID_FILTER_CHECKS
+
+log = logging.getLogger("db")
+MAX_HASHES = 16
+
+
+class BloomFilter:
+    """Фильтр Блума по строкам: ложные срабатывания возможны, пропуски добавленных строк - нет"""
+
+    __slots__ = ("capacity", "size", "hashes", "bits", "count", "_unpack")
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = max(1, capacity)
+        self.size = max(64, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = min(MAX_HASHES, max(1, round(self.size / self.capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+        self._unpack = struct.Struct(f"<{self.hashes}I").unpack
+
+    def _positions(self, value):
+        # k независимых 32-битных хешей из одного дайджеста blake2b (до 64 байт)
+        digest = hashlib.blake2b(value.encode("utf-8"), digest_size=4 * self.hashes).digest()
+        return self._unpack(digest)
+
+    def add(self, value):
+        bits, size = self.bits, self.size
+        for position in self._positions(value):
+            position %= size
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value):
+        bits, size = self.bits, self.size
+        for position in self._positions(value):
+            position %= size
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+
+class UidFilter:
+    """Фильтр UID карт доступа для отсечения заведомо неизвестных UID без запроса к БД.
+
+    Добавления попадают в фильтр сразу, удаления только копятся: фильтр пересобирается из БД в фоновом
+    потоке, когда удалений или карт становится слишком много, и после массового импорта.
+    До первой сборки и во время сборки после импорта фильтр пропускает все UID."""
+
+    def __init__(self, loader, card_types=None, error_rate=0.001, min_capacity=100000, rebuild_ratio=0.25):
+        self.loader = loader
+        self.card_types = card_types
+        self.error_rate = error_rate
+        self.min_capacity = min_capacity
+        self.rebuild_ratio = rebuild_ratio
+        self.bloom = None
+        self.removed = 0
+        self.rebuilds = 0
+        self.epoch = 0
+        self.rejected = UID_FILTER_CHECKS.labels("rejected")
+        self.passed = UID_FILTER_CHECKS.labels("passed")
+        self.bypassed = UID_FILTER_CHECKS.labels("bypassed")
+        self._pending = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def might_contain(self, uid_str):
+        """False - UID точно нет среди карт доступа; True - нужно проверить по БД"""
+        bloom = self.bloom
+        if bloom is None:
+            self.bypassed.inc()
+            return True
+        if uid_str in bloom:
+            self.passed.inc()
+            return True
+        self.rejected.inc()
+        return False
+
+    def on_card_changed(self, op, card_type, uid_str):
+        """Обработчик изменений CardDatabase"""
+        if op == "imported":
+            # UID импорта неизвестны: до пересборки фильтр не должен отвергать ни один из них
+            with self._lock:
+                self.bloom = None
+                self.epoch += 1
+            self.schedule_rebuild()
+        elif self.card_types is not None and card_type not in self.card_types:
+            return
+        elif op == "added":
+            with self._lock:
+                if self._pending is not None:
+                    self._pending.append(uid_str)
+                bloom = self.bloom
+                if bloom is None:
+                    return
+                bloom.add(uid_str)
+            if bloom.count > bloom.capacity:
+                self.schedule_rebuild()
+        elif op == "removed":
+            with self._lock:
+                self.removed += 1
+                bloom = self.bloom
+            if bloom is not None and self.removed > bloom.count * self.rebuild_ratio:
+                self.schedule_rebuild()
+
+    def schedule_rebuild(self):
+        """Запрашивает пересборку в фоновом потоке (повторные запросы объединяются)"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="uid-filter", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            try:
+                self.rebuild()
+            except Exception as e:
+                log.error("Ошибка пересборки фильтра UID: %s", e)
+
+    def rebuild(self):
+        """Собирает новый фильтр по всем UID из loader() и атомарно заменяет им текущий"""
+        with self._lock:
+            self._pending = []
+            removed = self.removed
+            epoch = self.epoch
+        try:
+            uids = self.loader()
+            bloom = BloomFilter(max(self.min_capacity, len(uids) * 2), self.error_rate)
+            for uid_str in uids:
+                bloom.add(uid_str)
+            with self._lock:
+                # Карты, добавленные во время чтения из БД, могли не попасть в выборку
+                for uid_str in self._pending:
+                    bloom.add(uid_str)
+                if epoch != self.epoch:
+                    # Импорт во время чтения: выборка неполная, следующая пересборка уже запрошена
+                    return
+                self.bloom = bloom
+                self.removed -= removed
+                self.rebuilds += 1
+        finally:
+            with self._lock:
+                self._pending = None
+        log.info("Фильтр UID пересобран: %s UID, %s КБ, %s хеш-функций",
+                 bloom.count, len(bloom.bits) // 1024, bloom.hashes)
+
+    def stats(self):
+        """Возвращает состояние фильтра"""
+        bloom = self.bloom
+        return {
+            "ready": bloom is not None,
+            "uids": bloom.count if bloom else 0,
+            "capacity": bloom.capacity if bloom else 0,
+            "bytes": len(bloom.bits) if bloom else 0,
+            "hashes": bloom.hashes if bloom else 0,
+            "removed_since_rebuild": self.removed,
+            "rebuilds": self.rebuilds,
+            "rejected": self.rejected.value(),
+            "passed": self.passed.value(),
+            "bypassed": self.bypassed.value()
+        }
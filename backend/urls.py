@@ -1,6 +1,7 @@
-from flask import send_from_directory, abort, Blueprint
-import os
-from backend.initial_media import IMAGE_DIR
+from flask import send_from_directory, send_file, abort, Blueprint, request, jsonify, Response
+from backend.settings import CARD_DB, MAX_IMAGE_SIZE, MEDIA_CACHE, MEDIA_MAX_AGE
+from backend.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, render_metrics
+from backend.media_upload import receive_card_image
 
 app_urls = Blueprint('urls', __name__,)
 
@@ -23,8 +24,40 @@ def serve_card_viewer_js():
 
 @app_urls.route('/media/<path:path>')
 def serve_image(path):
-    image_path = os.path.join(IMAGE_DIR, path)
-    if os.path.exists(image_path) and os.path.isfile(image_path):
-        return send_from_directory(IMAGE_DIR, path)
+    media_file = MEDIA_CACHE.get(path)
+    if media_file is None:
+        abort(404, description="Image not found")
+    
+    if media_file.data is not None:
+        response = Response(media_file.data, mimetype=media_file.content_type)
+        response.set_etag(media_file.etag)
+        response.last_modified = media_file.mtime
+        response.make_conditional(request, accept_ranges=True, complete_length=media_file.size)
     else:
-        abort(404, description="Image not found")
\ No newline at end of file
+        response = send_file(media_file.path, mimetype=media_file.content_type, etag=media_file.etag,
+                             last_modified=media_file.mtime, conditional=True, max_age=None)
+    
+    # Имя файла в хранилище - хеш содержимого, поэтому его можно кэшировать навсегда
+    if media_file.immutable:
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = MEDIA_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+@app_urls.route('/metrics')
+def serve_metrics():
+    response = Response(render_metrics(), content_type=METRICS_CONTENT_TYPE)
+    response.cache_control.no_store = True
+    return response
+
+@app_urls.route('/api/cards/<card_type>/<uid>/image', methods=['POST', 'PUT'])
+def upload_card_image(card_type, uid):
+    """Потоковая загрузка изображения карты: сырое тело запроса или multipart/form-data (поле image)"""
+    payload, status = receive_card_image(
+        CARD_DB, card_type, uid, request.mimetype, request.content_length, request.stream, request.environ,
+        MAX_IMAGE_SIZE, request.headers.get('X-Filename') or request.args.get('filename')
+    )
+    return jsonify(payload), status
@@ -1,239 +1,426 @@
-import json
+import asyncio
 import logging
 import websockets
 import base64
+import io
 from datetime import datetime
-from backend.settings import CONNECTED_CLIENTS, CARD_DB, HTTP_PORT
+from backend.settings import (
+    CONNECTED_CLIENTS, CARD_DB, ASYNC_DB, HTTP_BASE_URL, EVENT_QUEUE_SIZE, EVENT_DROP_POLICY,
+    BROADCAST_SEND_TIMEOUT, BROADCAST_MAX_BUFFER, BROADCAST_MAX_STRIKES, BROADCAST_MAX_IN_FLIGHT,
+    MONITOR_FLUSH_INTERVAL, MONITOR_BATCH_LINES, MONITOR_HISTORY_SIZE, MONITOR_CLIENT_MAX_RATE,
+    MAX_IMAGE_SIZE, WS_MAX_IN_FLIGHT, IMPORT_TIMEOUT
+)
+from backend.broadcast import Broadcaster
+from backend.serial_monitor import MonitorFeed
+from backend.event_bus import event_bus
+from backend.async_db import DatabaseBusyError
+from backend.reader_manager import reader_manager
+from backend.rate_limit import reader_limiter
+from backend.latency import scan_latency
+from backend.scan_journal import scan_journal
+from backend.setup_db import parse_cursor
+from backend.change_feed import change_feed
+from backend.card_io import FORMATS, CardFormatError, import_cards_stream, format_cards
+from backend.metrics import WS_CLIENTS
+from backend.command_router import CommandRouter, CommandError
 
+log = logging.getLogger("ws")
 SERIAL_MONITOR_CLIENTS = set()
+broadcaster = Broadcaster(
+    send_timeout=BROADCAST_SEND_TIMEOUT,
+    max_buffer=BROADCAST_MAX_BUFFER,
+    max_strikes=BROADCAST_MAX_STRIKES,
+    max_in_flight=BROADCAST_MAX_IN_FLIGHT
+)
+monitor_feed = MonitorFeed(
+    SERIAL_MONITOR_CLIENTS,
+    broadcaster,
+    flush_interval=MONITOR_FLUSH_INTERVAL,
+    batch_lines=MONITOR_BATCH_LINES,
+    history_size=MONITOR_HISTORY_SIZE,
+    client_max_rate=MONITOR_CLIENT_MAX_RATE
+)
+WS_CLIENTS.labels("all").set_function(lambda: len(CONNECTED_CLIENTS))
+WS_CLIENTS.labels("serial_monitor").set_function(lambda: len(SERIAL_MONITOR_CLIENTS))
+LIST_PAGE_SIZE = 500
+LIST_MAX_PAGE_SIZE = 5000
+HISTORY_PAGE_SIZE = 100
+HISTORY_MAX_PAGE_SIZE = 1000
+LOOKUP_MAX_UIDS = 100000
+
+router = CommandRouter(max_in_flight=WS_MAX_IN_FLIGHT)
 
 async def handle_connection(websocket):
     """Обработка подключения клиента"""
     CONNECTED_CLIENTS.add(websocket)
     client_ip = websocket.remote_address[0]
-    logging.info(f"Новое подключение от {client_ip}")
+    log.info("Новое подключение от %s", client_ip)
     
     try:
-        async for message in websocket:
-            try:
-                data = json.loads(message)
-                logging.info(f"Получено сообщение от {client_ip}: {data}")
-                
-                if "command" in data:
-                    command = data.get("command")
-                    logging.info(f"Обработка команды: {command}")
-                    
-                    if command == "start_serial_monitor":
-                        SERIAL_MONITOR_CLIENTS.add(websocket)
-                        response = {
-                            "status": "success",
-                            "command": "start_serial_monitor",
-                            "message": "Монитор порта активирован"
-                        }
-                        await websocket.send(json.dumps(response))
-                        continue
-                    
-                    elif command == "get_card_details_by_uid":
-                        uid = data.get("uid")
-                        if uid:
-                            card_data = None
-                            for card_type in ["KEY", "WORKER", "SECURITY"]:
-                                card_data = CARD_DB.get_card_with_image(card_type, uid)
-                                if card_data:
-                                    break
-                            
-                            if card_data:
-                                image_url = None
-                                if card_data.get("has_image") and card_data.get("image_filename"):
-                                    image_url = f"http://localhost:{HTTP_PORT}/media/{card_data['image_filename']}"
-                                
-                                response = {
-                                    "type": "card_scanned",
-                                    "cardUID": uid,
-                                    "cardType": card_data["card_type"],
-                                    "accessGranted": True,
-                                    "hasImage": card_data.get("has_image", False),
-                                    "imageUrl": image_url,
-                                    "timestamp": datetime.now().isoformat()
-                                }
-                            else:
-                                response = {
-                                    "type": "card_scanned",
-                                    "cardUID": uid,
-                                    "cardType": "UNKNOWN",
-                                    "accessGranted": False,
-                                    "hasImage": False,
-                                    "timestamp": datetime.now().isoformat()
-                                }
-                            
-                            await websocket.send(json.dumps(response))
-                        continue
-                    
-                    elif command == "list_cards":
-                        cards = CARD_DB.list_cards()
-                        response = {
-                            "status": "success",
-                            "command": "list_cards",
-                            "cards": cards,
-                            "count": len(cards)
-                        }
-                        await websocket.send(json.dumps(response))
-                        continue
-                        
-                    elif command == "upload_image":
-                        card_type = data.get("card_type")
-                        uid = data.get("uid")
-                        image_data = data.get("image_data")
-                        filename = data.get("filename")
-                        
-                        logging.info(f"Загрузка изображения: тип={card_type}, UID={uid}, файл={filename}")
-                        
-                        if card_type and uid and image_data and filename:
-                            try:
-                                if ',' in image_data:
-                                    image_data = image_data.split(',')[1]
-                                
-                                image_bytes = base64.b64decode(image_data)
-                                logging.info(f"Изображение декодировано, размер: {len(image_bytes)} байт")
-                                
-                                success, message = CARD_DB.save_card_image(card_type, uid, image_bytes, filename)
-                                
-                                response = {
-                                    "status": "success" if success else "error",
-                                    "command": "upload_image",
-                                    "message": message
-                                }
-                                logging.info(f"Результат загрузки: {message}")
-                                
-                            except Exception as e:
-                                logging.error(f"Ошибка загрузки изображения: {str(e)}")
-                                response = {
-                                    "status": "error",
-                                    "command": "upload_image",
-                                    "message": f"Ошибка обработки изображения: {str(e)}"
-                                }
-                        else:
-                            missing = []
-                            if not card_type: missing.append("card_type")
-                            if not uid: missing.append("uid")
-                            if not image_data: missing.append("image_data")
-                            if not filename: missing.append("filename")
-                            response = {
-                                "status": "error",
-                                "command": "upload_image",
-                                "message": f"Отсутствуют поля: {', '.join(missing)}"
-                            }
-                        await websocket.send(json.dumps(response))
-                        continue
-                    
-                    elif command == "get_card_details":
-                        card_type = data.get("card_type")
-                        uid = data.get("uid")
-                        
-                        if card_type and uid:
-                            card_data = CARD_DB.get_card_with_image(card_type, uid)
-                            if card_data:
-                                response = {
-                                    "status": "success",
-                                    "command": "get_card_details",
-                                    "card": card_data
-                                }
-                            else:
-                                response = {
-                                    "status": "error",
-                                    "command": "get_card_details",
-                                    "message": "Карта не найдена"
-                                }
-                        else:
-                            response = {
-                                "status": "error",
-                                "command": "get_card_details",
-                                "message": "Отсутствуют card_type или uid"
-                            }
-                        await websocket.send(json.dumps(response))
-                        continue
-                        
-                    else:
-                        response = {
-                            "status": "error",
-                            "message": f"Неизвестная команда: {command}"
-                        }
-                        await websocket.send(json.dumps(response))
-                        continue
-                
-                elif "card_type" in data and "uid" in data and "state" in data:
-                    card_type = data.get("card_type")
-                    uid = data.get("uid")
-                    incoming_state = data.get("state")
-                    
-                    if incoming_state == "" or incoming_state is None:
-                        exists = CARD_DB.check_card(card_type, uid)
-                        state = 1 if exists else 0
-                        
-                        logging.info(f"Проверка карты: тип={card_type}, UID={uid}, результат={state}")
-                        
-                        response = {
-                            "card_type": card_type,
-                            "uid": uid,
-                            "state": state
-                        }
-                        await websocket.send(json.dumps(response))
-                        
-                    elif isinstance(incoming_state, (int, bool, str)) and str(incoming_state) in ["1", "true", "True"]:
-                        success = CARD_DB.add_card(card_type, uid)
-                        
-                        response = {
-                            "status": "success" if success else "error",
-                            "message": f"Карта {card_type} с UID {uid} {'добавлена' if success else 'уже существует'}"
-                        }
-                        await websocket.send(json.dumps(response))
-                        
-                    elif isinstance(incoming_state, (int, bool, str)) and str(incoming_state) in ["0", "false", "False"]:
-                        success = CARD_DB.remove_card(card_type, uid)
-                        
-                        response = {
-                            "status": "success" if success else "error",
-                            "message": f"Карта {card_type} с UID {uid} {'удалена' if success else 'не найдена'}"
-                        }
-                        await websocket.send(json.dumps(response))
-                    
-                else:
-                    logging.warning(f"Неизвестный формат сообщения: {data}")
-                    response = {
-                        "status": "error",
-                        "message": "Неизвестный формат сообщения"
-                    }
-                    await websocket.send(json.dumps(response))
-                    
-            except json.JSONDecodeError:
-                logging.error(f"Невозможно разобрать JSON: {message}")
-                await websocket.send(json.dumps({
-                    "status": "error", 
-                    "message": "Неверный формат JSON"
-                }))
+        await router.serve(websocket)
     except websockets.exceptions.ConnectionClosed as e:
-        logging.info(f"Соединение с {client_ip} закрыто: {e}")
+        log.info("Соединение с %s закрыто: %s", client_ip, e)
     finally:
-        CONNECTED_CLIENTS.remove(websocket)
+        CONNECTED_CLIENTS.discard(websocket)
         SERIAL_MONITOR_CLIENTS.discard(websocket)
-        logging.info(f"Клиент {client_ip} отключен")
-
-async def send_serial_monitor_message(message, direction="incoming"):
-    """Отправка сообщения всем клиентам монитора порта"""
-    if SERIAL_MONITOR_CLIENTS:
-        monitor_message = {
-            "type": "serial_data",
-            "message": message,
-            "direction": direction,
+        log.info("Клиент %s отключен", client_ip)
+
+@router.command("start_serial_monitor", ordered=True)
+async def start_serial_monitor(request, data):
+    await request.send({
+        "status": "success",
+        "command": "start_serial_monitor",
+        "message": "Монитор порта активирован"
+    })
+    # Снимок истории и подписка в одном шаге цикла событий: строки не теряются и не повторяются
+    replay = monitor_feed.replay_frame() if data.get("replay", True) else None
+    SERIAL_MONITOR_CLIENTS.add(request.websocket)
+    if replay:
+        await request.send(replay)
+
+@router.command("get_card_details_by_uid", required={"uid": str})
+async def get_card_details_by_uid(request, data):
+    uid = data["uid"]
+    card_data = await ASYNC_DB.find_card_by_uid(uid)
+    
+    if card_data:
+        image_url = None
+        if card_data.get("has_image") and card_data.get("image_filename"):
+            image_url = f"{HTTP_BASE_URL}/media/{card_data['image_filename']}"
+        
+        return {
+            "type": "card_scanned",
+            "cardUID": uid,
+            "cardType": card_data["card_type"],
+            "accessGranted": True,
+            "hasImage": card_data.get("has_image", False),
+            "imageUrl": image_url,
             "timestamp": datetime.now().isoformat()
         }
+    return {
+        "type": "card_scanned",
+        "cardUID": uid,
+        "cardType": "UNKNOWN",
+        "accessGranted": False,
+        "hasImage": False,
+        "timestamp": datetime.now().isoformat()
+    }
+
+@router.command("upload_image", required={"card_type": str, "uid": str, "image_data": str, "filename": str})
+async def upload_image(request, data):
+    card_type = data["card_type"]
+    uid = data["uid"]
+    image_data = data["image_data"]
+    filename = data["filename"]
+    
+    log.info("Загрузка изображения: тип=%s, UID=%s, файл=%s", card_type, uid, filename)
+    
+    try:
+        if ',' in image_data:
+            image_data = image_data.split(',')[1]
+        
+        if len(image_data) * 3 // 4 > MAX_IMAGE_SIZE:
+            raise ValueError(f"файл больше {MAX_IMAGE_SIZE} байт")
+        image_bytes = await asyncio.to_thread(base64.b64decode, image_data)
+        log.info("Изображение декодировано, размер: %s байт", len(image_bytes))
+        
+        success, message = await ASYNC_DB.save_card_image(card_type, uid, image_bytes, filename)
+        log.info("Результат загрузки: %s", message)
+        return {
+            "status": "success" if success else "error",
+            "command": "upload_image",
+            "message": message
+        }
+    except DatabaseBusyError:
+        raise
+    except Exception as e:
+        log.error("Ошибка загрузки изображения: %s", e)
+        raise CommandError(f"Ошибка обработки изображения: {e}")
+
+@router.command("get_card_details", required={"card_type": str, "uid": str})
+async def get_card_details(request, data):
+    card_data = await ASYNC_DB.get_card_with_image(data["card_type"], data["uid"])
+    if not card_data:
+        raise CommandError("Карта не найдена")
+    return {
+        "status": "success",
+        "command": "get_card_details",
+        "card": card_data
+    }
+
+@router.command("lookup_cards", required={"uids": list})
+async def lookup_cards(request, data):
+    """Пакетная проверка: uids - строки UID или объекты {uid, card_type}; ответ одним сообщением"""
+    uids = data["uids"]
+    if len(uids) > LOOKUP_MAX_UIDS:
+        raise CommandError(f"Не больше {LOOKUP_MAX_UIDS} UID в одном запросе")
+    default_type = data.get("card_type")
+    items = []
+    for item in uids:
+        if isinstance(item, str):
+            items.append((default_type, item))
+        elif isinstance(item, dict) and isinstance(item.get("uid"), str):
+            items.append((item.get("card_type", default_type), item["uid"]))
+        else:
+            raise CommandError(f"Некорректный элемент uids: {item!r}")
+        if items[-1][0] is not None and not isinstance(items[-1][0], str):
+            raise CommandError(f"card_type должен быть строкой: {item!r}")
+    results = await ASYNC_DB.lookup_cards(items)
+    found = sum(result["state"] for result in results)
+    return {
+        "status": "success",
+        "command": "lookup_cards",
+        "found": found,
+        "missing": len(results) - found,
+        "cards": results
+    }
+
+@router.command("list_cards")
+async def list_cards(request, data):
+    await send_card_list(request, data)
+
+@router.command("get_reader_stats")
+async def get_reader_stats(request, data):
+    return {
+        "status": "success",
+        "command": "get_reader_stats",
+        "readers": reader_manager.stats(),
+        "routes": {str(key): handler.port for key, handler in reader_manager.routes.items()},
+        "rate_limit": reader_limiter.stats()
+    }
+
+@router.command("get_scan_latency")
+async def get_scan_latency(request, data):
+    response = {
+        "status": "success",
+        "command": "get_scan_latency",
+        "readers": scan_latency.snapshot()
+    }
+    if data.get("reset"):
+        scan_latency.reset()
+    return response
+
+@router.command("import_cards", required={"data": str})
+async def import_cards(request, data):
+    fmt = data.get("format", "csv")
+    if fmt not in FORMATS:
+        raise CommandError(f"Нужны поля data (текст) и format ({', '.join(FORMATS)})")
+    try:
+        result = await ASYNC_DB.run(import_cards_stream, CARD_DB, io.StringIO(data["data"]), fmt,
+                                    timeout=IMPORT_TIMEOUT)
+    except CardFormatError as e:
+        raise CommandError(str(e))
+    return {"status": "success", "command": "import_cards", **result}
+
+@router.command("export_cards")
+async def export_cards(request, data):
+    await send_card_export(request, data)
+
+@router.command("scan_history")
+async def scan_history(request, data):
+    try:
+        limit = max(1, min(int(data.get("limit") or HISTORY_PAGE_SIZE), HISTORY_MAX_PAGE_SIZE))
+        events, next_cursor = await ASYNC_DB.run(
+            scan_journal.history,
+            uid=data.get("uid"),
+            reader_id=data.get("reader_id"),
+            since=data.get("since"),
+            until=data.get("until"),
+            limit=limit,
+            cursor=data.get("cursor")
+        )
+    except (TypeError, ValueError) as e:
+        raise CommandError(f"Некорректные параметры запроса: {e}")
+    return {
+        "status": "success",
+        "command": "scan_history",
+        "events": events,
+        "next_cursor": next_cursor,
+        "journal": scan_journal.stats()
+    }
+
+@router.command("get_broadcast_stats")
+async def get_broadcast_stats(request, data):
+    return {
+        "status": "success",
+        "command": "get_broadcast_stats",
+        "broadcast": broadcaster.stats(),
+        "monitor": monitor_feed.stats(),
+        "event_bus": event_bus.stats(),
+        "router": router.stats(),
+        "clients": len(CONNECTED_CLIENTS),
+        "monitor_clients": len(SERIAL_MONITOR_CLIENTS)
+    }
+
+@router.command("get_db_stats")
+async def get_db_stats(request, data):
+    return {
+        "status": "success",
+        "command": "get_db_stats",
+        "queue": ASYNC_DB.stats(),
+        "cache": ASYNC_DB.card_db.card_cache.stats(),
+        "uid_filter": ASYNC_DB.card_db.uid_filter.stats(),
+        "changes": change_feed.stats(),
+        "media": await asyncio.to_thread(ASYNC_DB.card_db.media.stats)
+    }
+
+@router.set_fallback
+async def card_state(request, data):
+    """Прежний протокол без command: {card_type, uid, state} - проверка, добавление или удаление карты"""
+    if not ("card_type" in data and "uid" in data and "state" in data):
+        log.warning("Неизвестный формат сообщения: %s", data)
+        return {
+            "status": "error",
+            "message": "Неизвестный формат сообщения"
+        }
+    
+    card_type = data.get("card_type")
+    uid = data.get("uid")
+    incoming_state = data.get("state")
+    
+    if incoming_state == "" or incoming_state is None:
+        exists = await ASYNC_DB.check_card(card_type, uid)
+        state = 1 if exists else 0
+        
+        log.debug("Проверка карты: тип=%s, UID=%s, результат=%s", card_type, uid, state)
+        
+        return {
+            "card_type": card_type,
+            "uid": uid,
+            "state": state
+        }
+        
+    elif isinstance(incoming_state, (int, bool, str)) and str(incoming_state) in ["1", "true", "True"]:
+        success = await ASYNC_DB.add_card(card_type, uid)
+        
+        return {
+            "status": "success" if success else "error",
+            "message": f"Карта {card_type} с UID {uid} {'добавлена' if success else 'уже существует'}"
+        }
         
-        disconnected_clients = set()
-        for client in SERIAL_MONITOR_CLIENTS:
-            try:
-                await client.send(json.dumps(monitor_message))
-            except:
-                disconnected_clients.add(client)
+    elif isinstance(incoming_state, (int, bool, str)) and str(incoming_state) in ["0", "false", "False"]:
+        success = await ASYNC_DB.remove_card(card_type, uid)
         
-        for client in disconnected_clients:
-            SERIAL_MONITOR_CLIENTS.remove(client)
\ No newline at end of file
+        return {
+            "status": "success" if success else "error",
+            "message": f"Карта {card_type} с UID {uid} {'удалена' if success else 'не найдена'}"
+        }
+
+async def send_card_list(request, data):
+    """Отправка списка карт: одна страница по курсору или поток фрагментов с маркером окончания"""
+    filters = {
+        "card_type": data.get("card_type") or None,
+        "uid_prefix": data.get("uid_prefix") or None,
+        "has_image": data.get("has_image")
+    }
+    try:
+        page_size = max(1, min(int(data.get("page_size") or LIST_PAGE_SIZE), LIST_MAX_PAGE_SIZE))
+    except (TypeError, ValueError):
+        page_size = LIST_PAGE_SIZE
+    if data.get("cursor") not in (None, ""):
+        try:
+            parse_cursor(data["cursor"])
+        except ValueError as e:
+            raise CommandError(f"Некорректные параметры запроса: {e}")
+    total = await ASYNC_DB.count_cards(**filters)
+    
+    if not data.get("stream", True):
+        cards, next_cursor = await ASYNC_DB.list_cards_page(page_size=page_size, cursor=data.get("cursor"), **filters)
+        await request.send({
+            "status": "success",
+            "command": "list_cards",
+            "cards": cards,
+            "count": len(cards),
+            "total": total,
+            "next_cursor": next_cursor
+        })
+        return
+    
+    cursor = data.get("cursor")
+    chunk = 0
+    sent = 0
+    while True:
+        cards, cursor = await ASYNC_DB.list_cards_page(page_size=page_size, cursor=cursor, **filters)
+        if cards:
+            await request.send({
+                "status": "chunk",
+                "command": "list_cards",
+                "chunk": chunk,
+                "cards": cards
+            })
+            chunk += 1
+            sent += len(cards)
+        if cursor is None:
+            break
+    
+    await request.send({
+        "status": "end",
+        "command": "list_cards",
+        "chunks": chunk,
+        "count": sent,
+        "total": total
+    })
+
+async def send_card_export(request, data):
+    """Потоковая выгрузка карт в CSV/JSONL фрагментами по странице"""
+    fmt = data.get("format", "csv")
+    if fmt not in FORMATS:
+        raise CommandError(f"Неизвестный формат: {fmt}")
+    
+    cursor = None
+    chunk = 0
+    count = 0
+    while True:
+        cards, cursor = await ASYNC_DB.list_cards_page(page_size=LIST_PAGE_SIZE, cursor=cursor,
+                                                       card_type=data.get("card_type") or None)
+        await request.send({
+            "status": "chunk",
+            "command": "export_cards",
+            "format": fmt,
+            "chunk": chunk,
+            "data": format_cards(cards, fmt, header=(chunk == 0))
+        })
+        chunk += 1
+        count += len(cards)
+        if cursor is None:
+            break
+    
+    await request.send({
+        "status": "end",
+        "command": "export_cards",
+        "format": fmt,
+        "chunks": chunk,
+        "count": count
+    })
+
+def publish_card_change(op, card_type, uid):
+    """Публикует изменение карты в шину событий (вызывается из любого потока)"""
+    event_bus.publish("card_changed", {
+        "type": "card_changed",
+        "op": op,
+        "card_type": card_type,
+        "uid": uid,
+        "timestamp": datetime.now().isoformat()
+    })
+
+CARD_DB.add_change_listener(publish_card_change)
+
+async def run_event_relay():
+    """Пересылка событий шины клиентам WebSocket"""
+    subscription = event_bus.subscribe(
+        ("serial_data", "card_scanned", "card_changed"),
+        maxsize=EVENT_QUEUE_SIZE,
+        drop_policy=EVENT_DROP_POLICY
+    )
+    try:
+        while True:
+            topic, event = await subscription.get()
+            if topic == "serial_data":
+                monitor_feed.add(event)
+                continue
+            clients = CONNECTED_CLIENTS if topic == "card_changed" else SERIAL_MONITOR_CLIENTS
+            # Рассылка идёт в фоне: медленный клиент не задерживает следующие события для остальных
+            if not broadcaster.broadcast_nowait(clients, event):
+                log.warning("Слишком много незавершённых рассылок, событие %s отброшено", topic)
+    finally:
+        subscription.close()
@@ -0,0 +1,426 @@
+"""Сквозной нагрузочный тест: эмулятор ESP32 на COM-порту и клиенты WebSocket против настоящего сервера.
+
+Запуск из корня репозитория:
+    python bench/load_gen.py --duration 10 --rate 200 --clients 20 --output bench/results.json
+
+Сервер (main.py) запускается отдельным процессом во временном каталоге со своей
+cards.db, куда заранее загружаются известные карты. Эмулятор считывателя
+подключается через пару pty (по умолчанию) или через socket:// - URL pyserial.
+loop:// для этого не подходит: он замыкает порт сам на себя внутри одного
+процесса, и второй стороны у такого порта нет.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from collections import deque
+
+import websockets
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+KNOWN_UID_BASE = 0xA0000000
+UNKNOWN_UID_BASE = 0xB0000000
+
+
+def known_uid(index):
+    return f"{KNOWN_UID_BASE + index:08X}"
+
+
+def summarize(samples):
+    """Перцентили выборки задержек (в миллисекундах)"""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pick(p):
+        return round(ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] * 1000, 3)
+
+    return {
+        "count": len(ordered),
+        "avg_ms": round(sum(ordered) / len(ordered) * 1000, 3),
+        "p50_ms": pick(50),
+        "p95_ms": pick(95),
+        "p99_ms": pick(99),
+        "max_ms": round(ordered[-1] * 1000, 3)
+    }
+
+
+# --- серверный процесс -------------------------------------------------------
+
+def serve(args):
+    """Режим дочернего процесса: настоящий main.main() со своим портом и COM-портом эмулятора"""
+    os.chdir(args.workdir)
+    sys.path.insert(0, REPO_ROOT)
+    import logging
+    logging.disable(logging.INFO)
+
+    import main as server
+    from backend.settings import CARD_DB
+    from backend.reader_manager import reader_manager
+
+    CARD_DB.import_cards(
+        ((("KEY", "WORKER", "SECURITY")[index % 3], known_uid(index)) for index in range(args.known_cards)),
+        batch_size=10000
+    )
+    reader_manager.ports = [args.serial]
+    server.PORT = args.ws_port
+    try:
+        asyncio.run(server.main())
+    except KeyboardInterrupt:
+        reader_manager.stop()
+
+
+# --- эмулятор ESP32 ----------------------------------------------------------
+
+async def open_pty():
+    """Пара pty: (путь для сервера, StreamReader, StreamWriter, fd подчинённой стороны)"""
+    import pty
+    import tty
+    master, slave = pty.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=1 << 20)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader),
+                                 os.fdopen(master, "rb", buffering=0))
+    transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin,
+                                                        os.fdopen(os.dup(master), "wb", buffering=0))
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return os.ttyname(slave), reader, writer, slave
+
+
+class SocketPort:
+    """Эмулятор со стороны TCP: сервер подключается к нему по socket://"""
+
+    def __init__(self):
+        self.connected = None
+        self.server = None
+
+    async def open(self):
+        self.connected = asyncio.get_running_loop().create_future()
+        self.server = await asyncio.start_server(self._accept, "127.0.0.1", 0)
+        port = self.server.sockets[0].getsockname()[1]
+        return f"socket://127.0.0.1:{port}"
+
+    async def _accept(self, reader, writer):
+        if not self.connected.done():
+            self.connected.set_result((reader, writer))
+
+
+class Esp32Simulator:
+    """Эмулятор считывателя: шлёт cardData/ping с заданной частотой и сопоставляет ответы по порядку"""
+
+    def __init__(self, reader, writer, rate, readers, known_cards, known_ratio, hot_set, hot_ratio,
+                 ping_interval, seed):
+        self.reader = reader
+        self.writer = writer
+        self.rate = rate
+        self.readers = readers
+        self.known_cards = known_cards
+        self.known_ratio = known_ratio
+        self.hot = [known_uid(index) for index in range(min(hot_set, known_cards))]
+        self.hot_ratio = hot_ratio
+        self.ping_interval = ping_interval
+        self.rng = random.Random(seed)
+        self.pending_scans = deque()
+        self.pending_pings = deque()
+        self.latencies = []
+        self.ping_latencies = []
+        self.sent = 0
+        self.responses = 0
+        self.granted = 0
+        self.denied = 0
+        self.unmatched = 0
+        self.recording = False
+
+    def next_uid(self):
+        if self.hot and self.rng.random() < self.hot_ratio:
+            return self.rng.choice(self.hot)
+        if self.known_cards and self.rng.random() < self.known_ratio:
+            return known_uid(self.rng.randrange(self.known_cards))
+        return f"{UNKNOWN_UID_BASE + self.rng.getrandbits(24):08X}"
+
+    async def send_loop(self, duration):
+        interval = 1.0 / self.rate
+        started = time.perf_counter()
+        next_ping = started + self.ping_interval
+        index = 0
+        while time.perf_counter() - started < duration:
+            target = started + index * interval
+            delay = target - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            now = time.perf_counter()
+            if self.ping_interval and now >= next_ping:
+                next_ping = now + self.ping_interval
+                self.pending_pings.append(now)
+                self.writer.write(b'{"type":"ping","deviceId":"bench-esp32"}\n')
+            frame = {"type": "cardData", "cardUID": self.next_uid(), "readerId": f"bench-{index % self.readers}"}
+            self.pending_scans.append((time.perf_counter(), self.recording))
+            self.writer.write(json.dumps(frame).encode() + b"\n")
+            self.sent += 1
+            index += 1
+            await self.writer.drain()
+
+    async def receive_loop(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                return
+            received = time.perf_counter()
+            try:
+                message = json.loads(line)
+            except ValueError:
+                self.unmatched += 1
+                continue
+            if message.get("type") == "cardResponse" and self.pending_scans:
+                sent_at, recorded = self.pending_scans.popleft()
+                self.responses += 1
+                if message.get("accessGranted"):
+                    self.granted += 1
+                else:
+                    self.denied += 1
+                if recorded:
+                    self.latencies.append(received - sent_at)
+            elif message.get("type") == "pong" and self.pending_pings:
+                self.ping_latencies.append(received - self.pending_pings.popleft())
+            else:
+                self.unmatched += 1
+
+
+# --- клиенты WebSocket -------------------------------------------------------
+
+class MonitorClient:
+    """Клиент монитора порта: измеряет задержку доставки строк монитора"""
+
+    def __init__(self, url):
+        self.url = url
+        self.lags = []
+        self.lines = 0
+        self.frames = 0
+        self.scanned_events = 0
+        self.recording = False
+
+    async def run(self, stop):
+        async with websockets.connect(self.url, max_size=None) as ws:
+            await ws.send(json.dumps({"command": "start_serial_monitor", "replay": False}))
+            while not stop.is_set():
+                try:
+                    raw = await asyncio.wait_for(ws.recv(), 0.5)
+                except asyncio.TimeoutError:
+                    continue
+                message = json.loads(raw)
+                if message.get("type") == "serial_batch":
+                    now_ms = time.time() * 1000
+                    self.frames += 1
+                    self.lines += len(message["messages"])
+                    if self.recording:
+                        self.lags.extend((now_ms - entry[0]) / 1000 for entry in message["messages"])
+                elif message.get("type") == "card_scanned":
+                    self.scanned_events += 1
+
+
+class QueryClient:
+    """Клиент, попеременно запрашивающий list_cards и get_card_details_by_uid"""
+
+    def __init__(self, url, rate, known_cards, seed):
+        self.url = url
+        self.rate = rate
+        self.known_cards = known_cards
+        self.rng = random.Random(seed)
+        self.latencies = {"list_cards": [], "get_card_details_by_uid": []}
+        self.errors = 0
+        self.recording = False
+
+    async def run(self, stop):
+        async with websockets.connect(self.url, max_size=None) as ws:
+            while not stop.is_set():
+                if self.rng.random() < 0.2:
+                    command = "list_cards"
+                    request = {"command": command, "stream": False, "page_size": 100}
+                else:
+                    command = "get_card_details_by_uid"
+                    request = {"command": command, "uid": known_uid(self.rng.randrange(max(self.known_cards, 1)))}
+                started = time.perf_counter()
+                await ws.send(json.dumps(request))
+                while True:
+                    message = json.loads(await ws.recv())
+                    if message.get("command") == command:
+                        break
+                    # Ответ на get_card_details_by_uid - кадр card_scanned; широковещательные кадры сканирований отсеиваем по UID
+                    if command != "list_cards" and message.get("cardUID") == request["uid"]:
+                        break
+                if message.get("status") == "error":
+                    self.errors += 1
+                if self.recording:
+                    self.latencies[command].append(time.perf_counter() - started)
+                await asyncio.sleep(self.rng.expovariate(self.rate))
+
+
+async def request(url, payload):
+    async with websockets.connect(url, max_size=None) as ws:
+        await ws.send(json.dumps(payload))
+        return json.loads(await ws.recv())
+
+
+async def wait_for_server(url, process, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Процесс сервера завершился при запуске")
+        try:
+            async with websockets.connect(url):
+                return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError("Сервер не ответил вовремя")
+
+
+async def run_load(args):
+    workdir = tempfile.mkdtemp(prefix="load-gen-")
+    socket_port = None
+    slave_fd = None
+    if args.transport == "pty":
+        serial_url, reader, writer, slave_fd = await open_pty()
+    else:
+        socket_port = SocketPort()
+        serial_url = await socket_port.open()
+
+    process = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "--serve", "--workdir", workdir,
+         "--serial", serial_url, "--ws-port", str(args.ws_port), "--known-cards", str(args.known_cards)],
+        stdin=subprocess.DEVNULL
+    )
+    url = f"ws://127.0.0.1:{args.ws_port}"
+    try:
+        await wait_for_server(url, process)
+        if socket_port:
+            reader, writer = await asyncio.wait_for(socket_port.connected, 10)
+
+        simulator = Esp32Simulator(reader, writer, args.rate, args.readers, args.known_cards, args.known_ratio,
+                                   args.hot_set, args.hot_ratio, args.ping_interval, args.seed)
+        monitors = [MonitorClient(url) for _ in range(args.monitor_clients)]
+        queries = [QueryClient(url, args.client_rate, args.known_cards, args.seed + index)
+                   for index in range(args.clients)]
+
+        stop = asyncio.Event()
+        receiver = asyncio.create_task(simulator.receive_loop())
+        client_tasks = [asyncio.create_task(client.run(stop)) for client in monitors + queries]
+        await asyncio.sleep(0.5)
+
+        sender = asyncio.create_task(simulator.send_loop(args.warmup + args.duration))
+        await asyncio.sleep(args.warmup)
+        for participant in [simulator] + monitors + queries:
+            participant.recording = True
+        started = time.perf_counter()
+        responses_before = simulator.responses
+        await sender
+        deadline = time.monotonic() + 5
+        while simulator.pending_scans and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await asyncio.gather(*client_tasks, return_exceptions=True)
+        receiver.cancel()
+
+        server_latency = await request(url, {"command": "get_scan_latency"})
+        server_db = await request(url, {"command": "get_db_stats"})
+        server_broadcast = await request(url, {"command": "get_broadcast_stats"})
+    finally:
+        process.send_signal(signal.SIGINT)
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        if slave_fd is not None:
+            os.close(slave_fd)
+
+    query_latencies = {command: [] for command in ("list_cards", "get_card_details_by_uid")}
+    for client in queries:
+        for command, samples in client.latencies.items():
+            query_latencies[command].extend(samples)
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": {"python": platform.python_version(), "platform": platform.platform()},
+        "params": {key: value for key, value in vars(args).items() if key not in ("serve", "workdir", "serial")},
+        "scans": {
+            "sent": simulator.sent,
+            "responses": simulator.responses,
+            "lost": len(simulator.pending_scans),
+            "granted": simulator.granted,
+            "denied": simulator.denied,
+            "unmatched": simulator.unmatched,
+            "throughput_per_s": round((simulator.responses - responses_before) / elapsed, 1),
+            "latency": summarize(simulator.latencies),
+            "ping_latency": summarize(simulator.ping_latencies)
+        },
+        "monitor": {
+            "clients": len(monitors),
+            "lines": sum(client.lines for client in monitors),
+            "frames": sum(client.frames for client in monitors),
+            "card_scanned_events": sum(client.scanned_events for client in monitors),
+            "delivery_lag": summarize([lag for client in monitors for lag in client.lags])
+        },
+        "queries": {
+            "clients": len(queries),
+            "errors": sum(client.errors for client in queries),
+            **{command: summarize(samples) for command, samples in query_latencies.items()}
+        },
+        "server": {
+            "scan_latency": server_latency.get("readers"),
+            "db": {key: server_db.get(key) for key in ("queue", "cache")},
+            "broadcast": server_broadcast.get("broadcast")
+        }
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--duration", type=float, default=10.0, help="длительность измерения, с")
+    parser.add_argument("--warmup", type=float, default=2.0, help="прогрев без учёта в результатах, с")
+    parser.add_argument("--rate", type=float, default=100.0, help="сканирований в секунду")
+    parser.add_argument("--readers", type=int, default=4, help="число readerId на эмулируемом порту")
+    parser.add_argument("--known-cards", type=int, default=10000, help="карт в тестовой БД")
+    parser.add_argument("--known-ratio", type=float, default=0.8, help="доля известных UID вне горячего набора")
+    parser.add_argument("--hot-set", type=int, default=20, help="размер горячего набора UID")
+    parser.add_argument("--hot-ratio", type=float, default=0.5, help="доля сканирований из горячего набора")
+    parser.add_argument("--ping-interval", type=float, default=1.0, help="интервал ping, с (0 - без ping)")
+    parser.add_argument("--clients", type=int, default=10, help="клиентов с запросами list/get")
+    parser.add_argument("--client-rate", type=float, default=5.0, help="запросов в секунду на клиента")
+    parser.add_argument("--monitor-clients", type=int, default=5, help="клиентов монитора порта")
+    parser.add_argument("--transport", choices=("pty", "socket"), default="pty")
+    parser.add_argument("--ws-port", type=int, default=18765)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="load_results.json", help="файл результатов JSON")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    parser.add_argument("--serial", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    results = asyncio.run(run_load(args))
+    scans = results["scans"]
+    print(f"Сканирования: отправлено {scans['sent']}, ответов {scans['responses']}, потеряно {scans['lost']}, "
+          f"{scans['throughput_per_s']}/с")
+    print(f"Задержка cardResponse: {scans['latency']}")
+    print(f"Задержка доставки монитора: {results['monitor']['delivery_lag']}")
+    for command in ("list_cards", "get_card_details_by_uid"):
+        print(f"{command}: {results['queries'][command]}")
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    print(f"Результаты записаны в {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Микробенчмарк маршрута /media: исходный обработчик против кэширующего.
+
+Запуск из корня репозитория:
+    python bench/media_bench.py --requests 5000 --files 20 --size 200000
+
+Бенчмарк работает во временном каталоге (своя cards.db и media/), поэтому
+рабочая база и изображения не затрагиваются.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def legacy_serve_image(image_dir):
+    """Обработчик /media в том виде, в каком он был до кэширования"""
+    from flask import send_from_directory, abort
+
+    def serve_image(path):
+        image_path = os.path.join(image_dir, path)
+        if os.path.exists(image_path) and os.path.isfile(image_path):
+            return send_from_directory(image_dir, path)
+        else:
+            abort(404, description="Image not found")
+
+    return serve_image
+
+
+def run(client, names, count, headers=None):
+    """Выполняет count запросов к случайным файлам; возвращает запросов в секунду и статусы"""
+    rng = random.Random(1)
+    statuses = {}
+    started = time.perf_counter()
+    for _ in range(count):
+        name = rng.choice(names)
+        response = client.get(f"/media/{name}", headers=headers(name) if headers else None)
+        response.get_data()
+        response.close()
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+    elapsed = time.perf_counter() - started
+    return {"rps": round(count / elapsed, 1), "statuses": statuses}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--size", type=int, default=200_000, help="размер изображения в байтах")
+    parser.add_argument("--json", help="сохранить результаты в JSON-файл")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="media-bench-")
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+
+    import logging
+    logging.disable(logging.INFO)
+    from flask import Flask
+    from backend.settings import CARD_DB, MEDIA_CACHE
+    from backend.initial_media import IMAGE_DIR
+    from backend.urls import app_urls
+
+    names = []
+    for index in range(args.files):
+        data = b"\x89PNG\r\n\x1a\n" + os.urandom(args.size - 8)
+        names.append(CARD_DB.media.put_bytes(data, ".png"))
+
+    legacy_app = Flask("legacy", root_path=workdir)
+    legacy_app.add_url_rule("/media/<path:path>", view_func=legacy_serve_image(IMAGE_DIR))
+    cached_app = Flask("cached", root_path=workdir)
+    cached_app.register_blueprint(app_urls)
+
+    legacy, cached = legacy_app.test_client(), cached_app.test_client()
+    etags = {name: cached.get(f"/media/{name}").headers["ETag"] for name in names}
+
+    results = {
+        "params": vars(args),
+        "legacy_get": run(legacy, names, args.requests),
+        "cached_get": run(cached, names, args.requests),
+        "cached_if_none_match": run(cached, names, args.requests, lambda name: {"If-None-Match": etags[name]}),
+        "cached_range": run(cached, names, args.requests, lambda name: {"Range": "bytes=0-1023"}),
+        "hot_files": MEDIA_CACHE.stats()
+    }
+
+    base = results["legacy_get"]["rps"]
+    for key in ("legacy_get", "cached_get", "cached_if_none_match", "cached_range"):
+        result = results[key]
+        print(f"{key:<24} {result['rps']:>10.1f} req/s  x{result['rps'] / base:.2f}  {result['statuses']}")
+
+    if args.json:
+        with open(os.path.join(REPO_ROOT, args.json) if not os.path.isabs(args.json) else args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    CARD_DB.close()
+
+
+if __name__ == "__main__":
+    main()
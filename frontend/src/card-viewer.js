@@ -50,7 +50,7 @@ const imageContainer = document.getElementById('imageContainer');
 
 if (card.has_image && card.image_filename) {
     imageContainer.innerHTML = `
-    <img src="http://localhost:8080/media/${card.image_filename}" 
+    <img src="/media/${card.image_filename}" 
             alt="Изображение карты ${card.card_type}" 
             class="card-image">
     <p><small>Файл: ${card.image_filename}</small></p>
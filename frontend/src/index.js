@@ -1,6 +1,8 @@
 let ws;
 let monitorWs;
 let isMonitoring = false;
+let pendingCards = [];
+let refreshTimer = null;
 
 function connect() {
     ws = new WebSocket("ws://localhost:8765");
@@ -14,17 +16,20 @@ function connect() {
             const data = JSON.parse(event.data);
             console.log("Received:", data);
             
-            if (data.command === "list_cards" && data.status === "success") {
+            if (data.command === "list_cards" && data.status === "chunk") {
+                pendingCards = pendingCards.concat(data.cards);
+            } else if (data.command === "list_cards" && data.status === "end") {
+                updateTable(pendingCards);
+                pendingCards = [];
+            } else if (data.command === "list_cards" && data.status === "success") {
                 updateTable(data.cards);
             } else if (data.command === "upload_image") {
-                document.getElementById('uploadStatus').innerHTML = 
-                    `<p style="color: ${data.status === 'success' ? 'green' : 'red'}">${data.message}</p>`;
-                if (data.status === 'success') {
-                    fetchCards();
-                    document.getElementById('uploadForm').reset();
-                }
+                showUploadResult(data);
             } else if (data.type === "card_scanned") {
                 displayCurrentCard(data);
+            } else if (data.type === "card_changed") {
+                clearTimeout(refreshTimer);
+                refreshTimer = setTimeout(fetchCards, 500);
             } else if (data.status === "error") {
                 console.error("Ошибка от сервера:", data.message);
             }
@@ -62,11 +67,16 @@ function connectMonitor() {
     monitorWs.onmessage = (event) => {
         try {
             const data = JSON.parse(event.data);
-            if (data.type === "serial_data") {
-                addMonitorMessage(data.message, data.direction, data.timestamp);
-                
-                if (data.direction === "incoming" && data.message.includes('cardData')) {
-                    processCardDataMessage(data.message);
+            if (data.type === "serial_batch") {
+                data.messages.forEach(([timestamp, direction, message]) => {
+                    addMonitorMessage(message, direction, timestamp);
+                    
+                    if (!data.replay && direction === "incoming" && message.includes('cardData')) {
+                        processCardDataMessage(message);
+                    }
+                });
+                if (data.skipped) {
+                    addMonitorMessage(`... пропущено сообщений: ${data.skipped}`, 'error', Date.now());
                 }
             } else if (data.type === "card_scanned") {
                 displayCurrentCard(data);
@@ -174,6 +184,7 @@ function clearMonitor() {
 
 function fetchCards() {
     if (ws && ws.readyState === WebSocket.OPEN) {
+        pendingCards = [];
         ws.send(JSON.stringify({ command: "list_cards" }));
     } else {
         console.error("WebSocket не подключен");
@@ -195,7 +206,7 @@ function updateTable(cards) {
         
         const hasImage = card.image_filename || card.has_image;
         const imageCell = hasImage ? 
-            `<img src="http://localhost:8080/media/${card.image_filename}" class="thumbnail" alt="Card image">` : 
+            `<img src="/media/${card.image_filename}" class="thumbnail" alt="Card image">` : 
             'Нет изображения';
         
         tr.innerHTML = `
@@ -235,12 +246,37 @@ document.getElementById('uploadForm').addEventListener('submit', function(e) {
     }
 
     const file = fileInput.files[0];
+    document.getElementById('uploadStatus').innerHTML = '<p>Загрузка...</p>';
+
+    fetch(`/api/cards/${encodeURIComponent(cardType)}/${encodeURIComponent(uid)}/image`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': file.type || 'application/octet-stream',
+            'X-Filename': encodeURIComponent(file.name)
+        },
+        body: file
+    })
+        .then(response => response.json().then(data => showUploadResult(data)))
+        .catch(error => {
+            console.warn("HTTP-загрузка недоступна, отправка через WebSocket:", error);
+            uploadViaWebSocket(cardType, uid, file);
+        });
+});
+
+function showUploadResult(data) {
+    document.getElementById('uploadStatus').innerHTML = 
+        `<p style="color: ${data.status === 'success' ? 'green' : 'red'}">${data.message}</p>`;
+    if (data.status === 'success') {
+        fetchCards();
+        document.getElementById('uploadForm').reset();
+    }
+}
+
+function uploadViaWebSocket(cardType, uid, file) {
     const reader = new FileReader();
 
     reader.onload = function(e) {
         if (ws && ws.readyState === WebSocket.OPEN) {
-            document.getElementById('uploadStatus').innerHTML = '<p>Загрузка...</p>';
-            
             const uploadData = {
                 command: "upload_image",
                 card_type: cardType,
@@ -248,7 +284,6 @@ document.getElementById('uploadForm').addEventListener('submit', function(e) {
                 image_data: e.target.result,
                 filename: file.name
             };
-            console.log("Sending upload command:", uploadData);
             ws.send(JSON.stringify(uploadData));
         } else {
             alert('WebSocket не подключен. Попробуйте обновить страницу.');
@@ -261,7 +296,7 @@ document.getElementById('uploadForm').addEventListener('submit', function(e) {
     };
 
     reader.readAsDataURL(file);
-});
+}
 
 function quickUpload(cardType, uid) {
     document.getElementById('uploadCardType').value = cardType;
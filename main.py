@@ -2,23 +2,40 @@ import asyncio
 import websockets
 import logging
 import threading
-from flask import Flask
 
-from backend.settings import PORT, HTTP_PORT, CARD_DB
-from backend.views import handle_connection
-from backend.urls import app_urls
+from backend.settings import (
+    PORT, HTTP_PORT, HTTP_SERVER, CARD_DB, ASYNC_DB, MEDIA_GC_INTERVAL, MEDIA_CHECK_SHARDS, METRICS_LOOP_LAG_INTERVAL,
+    LOG_LEVEL, LOG_LEVELS, LOG_JSON, LOG_QUEUE_SIZE, LOG_MAX_FIELD, LOG_SAMPLE_WINDOW, LOG_SAMPLE_BURST
+)
+from backend.views import handle_connection, run_event_relay, monitor_feed
+from backend.event_bus import event_bus
+from backend.http_server import http_frontend
 from backend.cmd_handler import console_handler
-from backend.serial_handler import serial_handler
+from backend.reader_manager import reader_manager
+from backend.scan_journal import scan_journal
+from backend.change_feed import change_feed
+from backend.metrics import monitor_loop_lag
+from backend.profiling import profiler
+from backend.log_pipeline import setup_logging
 
-logging.basicConfig(
-    format="%(asctime)s %(message)s",
-    level=logging.INFO,
+log_listener = setup_logging(
+    level=LOG_LEVEL,
+    subsystem_levels=LOG_LEVELS,
+    json_lines=LOG_JSON,
+    queue_size=LOG_QUEUE_SIZE,
+    max_field=LOG_MAX_FIELD,
+    sample_window=LOG_SAMPLE_WINDOW,
+    sample_burst=LOG_SAMPLE_BURST
 )
-
-app = Flask(__name__, static_folder='frontend/static', static_url_path='/static')
-app.register_blueprint(app_urls)
+log = logging.getLogger("ws")
 
 def run_flask():
+    """Прежний режим: сервер разработки Flask в отдельном потоке на HTTP_PORT"""
+    from flask import Flask
+    from backend.urls import app_urls
+    
+    app = Flask(__name__, static_folder='frontend/static', static_url_path='/static')
+    app.register_blueprint(app_urls)
     app.run(host='0.0.0.0', port=HTTP_PORT, threaded=True, debug=False, use_reloader=False)
 
 async def main():
@@ -27,19 +44,37 @@ async def main():
     console_thread = threading.Thread(target=console_handler, daemon=True)
     console_thread.start()
     
-    serial_handler.start_background()
-    logging.info(f"COM-порт монитор запущен на {serial_handler.port}")
+    event_bus.bind(asyncio.get_running_loop())
+    profiler.bind(asyncio.get_running_loop())
+    scan_journal.start()
+    change_feed.start()
+    relay_task = asyncio.create_task(run_event_relay())
+    monitor_task = asyncio.create_task(monitor_feed.run())
+    media_task = asyncio.create_task(CARD_DB.media.run(MEDIA_GC_INTERVAL, MEDIA_CHECK_SHARDS))
+    loop_lag_task = asyncio.create_task(monitor_loop_lag(METRICS_LOOP_LAG_INTERVAL))
+    
+    readers_task = asyncio.create_task(reader_manager.run())
+    logging.getLogger("serial").info("COM-порт монитор запущен на %s", ', '.join(reader_manager.ports) or 'автообнаруженных портах')
     
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
-    logging.info(f"Flask HTTP сервер запущен на http://{server_ip}:{HTTP_PORT}")
-    logging.info(f"Откройте в браузере: http://localhost:{HTTP_PORT}")
+    if HTTP_SERVER == "flask":
+        flask_thread = threading.Thread(target=run_flask, daemon=True)
+        flask_thread.start()
+        log.info("Flask HTTP сервер запущен на http://%s:%s", server_ip, HTTP_PORT)
+        log.info("Откройте в браузере: http://localhost:%s", HTTP_PORT)
+        http_options = {}
+    else:
+        http_frontend.load_static()
+        http_options = {
+            "process_request": http_frontend.process_request,
+            "create_connection": http_frontend.create_connection
+        }
+        log.info("Откройте в браузере: http://localhost:%s", PORT)
     
-    async with websockets.serve(handle_connection, server_ip, PORT):
-        logging.info(f"WebSocket сервер запущен на ws://{server_ip}:{PORT}")
+    async with websockets.serve(handle_connection, server_ip, PORT, **http_options):
+        log.info("WebSocket сервер запущен на ws://%s:%s", server_ip, PORT)
         
-        cards = CARD_DB.list_cards()
-        logging.info(f"База данных карт SQLite: {len(cards)} карт")
+        cards_count = await ASYNC_DB.count_cards()
+        logging.getLogger("db").info("База данных карт SQLite: %s карт", cards_count)
         
         await asyncio.Future()
 
@@ -48,5 +83,9 @@ if __name__ == "__main__":
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
-        logging.info("Сервер остановлен.")
-        serial_handler.disconnect()
\ No newline at end of file
+        log.info("Сервер остановлен.")
+        reader_manager.stop()
+        scan_journal.stop()
+        change_feed.stop()
+        ASYNC_DB.shutdown()
+        CARD_DB.close()
\ No newline at end of file